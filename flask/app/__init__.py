@@ -2,6 +2,7 @@ import logging
 import os
 from stat import S_ISFIFO
 
+from . import slow_queries
 from .blueprints import register_blueprints
 from .manage import register_commands
 from .models import db
@@ -22,16 +23,15 @@ def create_app(config):
 
 def config_logger(app):
     """
-    SQLAlchemy logs can be very noisy and hard to filter out with grep because
-    the logged queries can span multiple lines. However, they are still useful
-    for auditing query efficiency and performance. Therefore, instead of using
-    basicConfig to configure the log handler and formatter at the root level,
-    which affects all loggers, the SQLAlchemy logger is configured separately
-    from the application logger.
+    Logging every statement SQLAlchemy executes is too noisy to be useful in
+    production, so only slow statements are logged, along with their query plans
+    (see slow_queries.py). These are still kept out of the application logs by
+    configuring the stager.slow_query logger separately rather than using
+    basicConfig at the root level, which affects all loggers.
 
     Configuring handlers to write to a file instead of stdout violates Docker's
     approach to logging. Instead, divert logs to a sidecar container so the
-    SQLAlchemy logs are separated from application logs. The application
+    slow query logs are separated from application logs. The application
     container and the sidecar container both mount the same volume to share the
     logs. This solution is adapted from a Kubernetes paradigm.
 
@@ -43,6 +43,7 @@ def config_logger(app):
     the sidecar can still output the logs the same way with `tail`.
     """
     if app.config["SQLALCHEMY_LOG"]:
+        slow_queries.init_app(app)
         sidecar = os.getenv("SQLALCHEMY_SIDECAR")
         if sidecar:
             try:
@@ -53,7 +54,11 @@ def config_logger(app):
             handler = logging.FileHandler(sidecar)
         else:
             handler = logging.StreamHandler()
-        handler.setFormatter(logging.Formatter("%(levelname)s [%(name)s] %(message)s"))
-        logging.getLogger("sqlalchemy").addHandler(handler)
-        logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
-        logging.getLogger("sqlalchemy.pool").setLevel(logging.INFO)
+        # each message is already a JSON object
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger = logging.getLogger("stager.slow_query")
+        # create_app can be called more than once in a process, e.g. in tests
+        if not logger.handlers:
+            logger.addHandler(handler)
+        logger.setLevel(logging.WARNING)
+        logger.propagate = False
@@ -0,0 +1,128 @@
+"""
+Vectorized group-wise collapse of a report DataFrame
+
+DataFrame.groupby().agg() with list and set reducers, then joining each cell with a Python lambda, runs Python
+code for every group and column. Here the rows are instead sorted once by the categorical codes of the keys, so
+every group is a contiguous run and its boundaries are found by comparing neighbouring codes. Each column is then
+collapsed in a single pass over the sorted values: "first" takes the value at each group start, and "list" and
+"unique" join every group at once by concatenating all values into one string, with the separator between values of
+a group and a sentinel between groups, which is split on afterwards.
+
+The result is the same as the groupby: groups ordered by their keys, values of a group in their original order.
+"unique" keeps the first occurrence of each value, rather than the arbitrary order of a Python set.
+"""
+
+from typing import Collection, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype
+
+FIRST = "first"
+LIST = "list"
+UNIQUE = "unique"
+
+# ends each group in the joined string of a column, the ASCII record separator
+_SENTINEL = "\x1e"
+
+
+def as_strings(df: pd.DataFrame, defer: Collection[str] = ()) -> pd.DataFrame:
+    """
+    The equivalent of df.fillna("").astype(str), without first copying every column to fill in the missing values.
+    Numeric and object columns are converted to strings as they are and the missing values blanked afterwards.
+    Those columns are converted value by value, so the ones in defer are left as they are, to be converted later
+    once only the values that are needed remain, e.g. the first of each group.
+    """
+    columns = {}
+    for name, column in df.items():
+        if column.dtype.kind not in "biufO":
+            # e.g. datetimes, which astype(str) formats differently once filled
+            columns[name] = column.fillna("").astype(str)
+            continue
+        if name in defer:
+            columns[name] = column
+            continue
+        missing = column.isna().to_numpy()
+        # astype(str) would copy every value of a column that is already strings
+        if column.dtype.kind != "O" or infer_dtype(column, skipna=True) != "string":
+            column = column.astype(str)
+        if missing.any():
+            column = column.mask(missing, "")
+        columns[name] = column
+    # the columns are already new, so they aren't copied again into one block
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def join_groups(values: np.ndarray, group_ids: np.ndarray, sep: str) -> List[str]:
+    """
+    Joins the values of each group with sep, given the sorted group id of each value.
+    Every group id from 0 to the last one must have at least one value.
+    """
+    ends = np.empty(len(values), dtype=bool)
+    ends[:-1] = group_ids[1:] != group_ids[:-1]
+    ends[-1] = True
+    # each value followed by the separator, or the sentinel if it is the last of its group
+    pieces = np.empty(2 * len(values), dtype=object)
+    pieces[::2] = values
+    pieces[1::2] = np.array([sep, _SENTINEL], dtype=object)[ends.view(np.int8)]
+    joined = "".join(pieces.tolist()).split(_SENTINEL)
+    joined.pop()  # after the last sentinel
+    if len(joined) == group_ids[-1] + 1:
+        return joined
+    # a value contained the sentinel, so slice the groups out instead
+    values = values.tolist()
+    stops = (np.flatnonzero(ends) + 1).tolist()
+    return [
+        sep.join(values[start:stop]) for start, stop in zip([0, *stops[:-1]], stops)
+    ]
+
+
+def collapse(
+    df: pd.DataFrame,
+    keys: List[str],
+    aggregations: Dict[str, str],
+    sep: str = "; ",
+    size: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    The equivalent of df.groupby(keys).agg(...).reset_index() where each column is reduced to the first value of
+    its group, or to the values of its group joined by sep, either all of them ("list") or without duplicates
+    ("unique"). If size is given, it names an additional column with the number of rows in each group.
+    The values to be joined must be strings without missing values, like those from clean_report_df.
+    """
+    columns = [*keys, *aggregations] + ([size] if size else [])
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+
+    codes = [pd.factorize(df[key].to_numpy(), sort=True)[0] for key in keys]
+    # lexsort is stable and sorts by its last key first
+    order = np.lexsort(codes[::-1])
+    boundary = np.zeros(len(order), dtype=bool)
+    boundary[0] = True
+    for key_codes in codes:
+        key_codes = key_codes[order]
+        boundary[1:] |= key_codes[1:] != key_codes[:-1]
+    starts = np.flatnonzero(boundary)
+    group_ids = np.cumsum(boundary) - 1
+
+    result = {}
+    firsts = order[starts]
+    for key in keys:
+        result[key] = df[key].to_numpy()[firsts]
+    for column, aggregation in aggregations.items():
+        if aggregation == FIRST:
+            result[column] = df[column].to_numpy()[firsts]
+            continue
+        values = df[column].to_numpy(dtype=object)[order]
+        if aggregation == LIST:
+            result[column] = join_groups(values, group_ids, sep)
+        elif aggregation == UNIQUE:
+            value_codes = pd.factorize(values)[0]
+            pairs = group_ids * (value_codes.max() + 1) + value_codes
+            first = ~pd.Series(pairs).duplicated().to_numpy()
+            result[column] = join_groups(values[first], group_ids[first], sep)
+        else:
+            raise ValueError(f"Unknown aggregation {aggregation} for {column}")
+    if size:
+        result[size] = np.diff(np.append(starts, len(order)))
+    return pd.DataFrame(result, columns=columns)
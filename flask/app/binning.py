@@ -0,0 +1,73 @@
+"""
+UCSC-style hierarchical binning of genomic intervals, for indexed range queries against the variant and gene tables
+
+Every interval is assigned the smallest bin that fully contains it. Bins are nested in five levels of 128 kb, 1 Mb,
+8 Mb, 64 Mb and 512 Mb, so any interval overlapping a region must be in one of the bins overlapping that region,
+and a region query only needs to look at a short list of bins. See https://genome.ucsc.edu/goldenPath/help/binning.html
+
+Stager stores 1-based inclusive coordinates (from VCFs and the GTF), whereas the binning scheme is defined on
+0-based half-open intervals, so the public functions here take 1-based inclusive coordinates and convert them.
+"""
+
+from typing import List
+
+from sqlalchemy.sql.expression import ColumnElement
+
+# Offsets of the first bin of each level, from the smallest bins to the largest
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+# How much to shift to get to the finest bin
+BIN_FIRST_SHIFT = 17
+# How much to shift to get to the next larger bin
+BIN_NEXT_SHIFT = 3
+# Coordinates past this (512 Mb) are not supported, comfortably more than any GRCh37 chromosome
+BIN_MAX_END = 1 << (BIN_FIRST_SHIFT + BIN_NEXT_SHIFT * (len(BIN_OFFSETS) - 1))
+
+
+def _check_interval(start: int, end: int) -> None:
+    if start < 1 or end < start or end > BIN_MAX_END:
+        raise ValueError(f"Cannot bin interval {start}-{end}")
+
+
+def bin_for_interval(start: int, end: int) -> int:
+    """
+    Returns the smallest bin that fully contains the 1-based inclusive interval [start, end].
+    """
+    _check_interval(start, end)
+    start_bin = (start - 1) >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if start_bin == end_bin:
+            return offset + start_bin
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    # unreachable since the largest bin spans every supported coordinate
+    raise ValueError(f"Cannot bin interval {start}-{end}")
+
+
+def overlapping_bins(start: int, end: int) -> List[int]:
+    """
+    Returns every bin that may contain an interval overlapping the 1-based inclusive interval [start, end].
+    """
+    _check_interval(start, end)
+    start_bin = (start - 1) >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    bins = []
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    return bins
+
+
+def containing_bins(position: ColumnElement) -> List[ColumnElement]:
+    """
+    Returns SQL expressions for the bins that may contain a 1-based position, one per level.
+    The bin of an interval containing the position must be one of these, which lets a join
+    against a binned table use an equality on its bin column instead of only a range predicate.
+    """
+    shift = BIN_FIRST_SHIFT
+    bins = []
+    for offset in BIN_OFFSETS:
+        bins.append((position - 1).op(">>")(shift) + offset)
+        shift += BIN_NEXT_SHIFT
+    return bins
@@ -1,17 +1,18 @@
-from dataclasses import asdict
 from datetime import datetime
-from typing import List, Union
+from typing import List, Optional, Set, Union
 
-from flask import Blueprint, Response, abort, current_app as app, jsonify, request
+from flask import Blueprint, Response, abort, current_app as app, request
 from flask_login import login_required
-from sqlalchemy import distinct, func, or_, select
-from sqlalchemy.orm import aliased, joinedload, selectinload
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import aliased, joinedload, lazyload, selectinload
 from sqlalchemy.sql.expression import cast
 
 from .. import models
+from ..generations import bump_generations
 from ..models import db
 from ..schemas import AnalysisSchema
 from ..slurm import run_crg2_on_family
+from ..serializers import field_names, json_response, to_dict
 from ..utils import (
     check_admin,
     clone_entity,
@@ -22,14 +23,126 @@ from ..utils import (
     filter_in_enum_or_abort,
     filter_updated_or_abort,
     get_current_user,
+    get_fields,
+    get_total_count,
     validate_enums_and_set_fields,
+    keyset_page,
     paged,
     paginated_response,
+    sparse_dict,
+    stream_query,
     transaction_or_abort,
     validate_filter_input,
     validate_json,
+    wants,
 )
 
+# The keys of each list_analyses result besides the analysis columns, all selectable with ?fields=
+LIST_GETTERS = {
+    "sequencing_id": lambda analysis: [d.sequencing_id for d in analysis.datasets],
+    "participant_codenames": lambda analysis: [
+        d.tissue_sample.participant.participant_codename for d in analysis.datasets
+    ],
+    "family_codenames": lambda analysis: [
+        d.tissue_sample.participant.family.family_codename for d in analysis.datasets
+    ],
+    "requester": lambda analysis: analysis.requester.username,
+    "updated_by": lambda analysis: analysis.updated_by.username,
+    "assignee": lambda analysis: analysis.assignee_id and analysis.assignee.username,
+}
+
+# The keys of the get_analysis result besides the analysis columns
+DETAIL_GETTERS = {
+    "requester": lambda analysis: analysis.requester_id and analysis.requester.username,
+    "updated_by": lambda analysis: analysis.updated_by_id
+    and analysis.updated_by.username,
+    "assignee": lambda analysis: analysis.assignee_id and analysis.assignee.username,
+    "datasets": lambda analysis: [
+        {
+            **to_dict(dataset),
+            "linked_files": dataset.linked_files,
+            "group_code": [group.group_code for group in dataset.groups],
+            "tissue_sample_type": dataset.tissue_sample.tissue_sample_type,
+            "participant_codename": dataset.tissue_sample.participant.participant_codename,
+            "participant_type": dataset.tissue_sample.participant.participant_type,
+            "participant_aliases": dataset.tissue_sample.participant.participant_aliases,
+            "family_aliases": dataset.tissue_sample.participant.family.family_aliases,
+            "institution": dataset.tissue_sample.participant.institution.institution
+            if dataset.tissue_sample.participant.institution
+            else None,
+            "sex": dataset.tissue_sample.participant.sex,
+            "family_codename": dataset.tissue_sample.participant.family.family_codename,
+            "updated_by": dataset.tissue_sample.updated_by.username,
+            "created_by": dataset.tissue_sample.created_by.username,
+            "participant_notes": dataset.tissue_sample.participant.notes,
+        }
+        for dataset in analysis.datasets
+    ],
+}
+
+# The keys of the result of creating an analysis or reanalysis besides the analysis columns
+CREATED_GETTERS = {
+    "requester": DETAIL_GETTERS["requester"],
+    "updated_by": DETAIL_GETTERS["updated_by"],
+    "assignee": DETAIL_GETTERS["assignee"],
+    "datasets": lambda analysis: [
+        {
+            **to_dict(dataset),
+            "tissue_sample_type": dataset.tissue_sample.tissue_sample_type,
+            "participant_codename": dataset.tissue_sample.participant.participant_codename,
+            "participant_type": dataset.tissue_sample.participant.participant_type,
+            "institution": dataset.tissue_sample.participant.institution.institution
+            if dataset.tissue_sample.participant.institution
+            else None,
+            "sex": dataset.tissue_sample.participant.sex,
+            "family_codename": dataset.tissue_sample.participant.family.family_codename,
+            "updated_by": dataset.tissue_sample.updated_by.username,
+            "created_by": dataset.tissue_sample.created_by.username,
+        }
+        for dataset in analysis.datasets
+    ],
+}
+
+ANALYSIS_COLUMNS = field_names(models.Analysis)
+
+# The users of an analysis, which are joined in by default
+USER_FIELDS = {
+    "requester": models.Analysis.requester,
+    "updated_by": models.Analysis.updated_by,
+    "assignee": models.Analysis.assignee,
+}
+
+
+def user_options(fields: Optional[Set[str]]) -> list:
+    """Skips joining in the users of an analysis that aren't requested by ?fields="""
+    return [
+        lazyload(relationship)
+        for key, relationship in USER_FIELDS.items()
+        if not wants(fields, key)
+    ]
+
+
+def load_datasets(*options):
+    """
+    Eagerly loads the datasets of an analysis with their tissue sample, participant and family, plus any other
+    given options for the datasets, rather than lazily loading them one dataset at a time
+    """
+    return selectinload(models.Analysis.datasets).options(
+        # the datasets' own users aren't part of any result
+        lazyload(models.Dataset.created_by),
+        lazyload(models.Dataset.updated_by),
+        joinedload(models.Dataset.tissue_sample).options(
+            joinedload(models.TissueSample.created_by),
+            joinedload(models.TissueSample.updated_by),
+            joinedload(models.TissueSample.participant).options(
+                joinedload(models.Participant.institution),
+                joinedload(models.Participant.family).lazyload("*"),
+            ),
+        ),
+        *options,
+    )
+
+
 analyses_blueprint = Blueprint(
     "analyses",
     __name__,
@@ -69,19 +182,23 @@ def list_analyses(page: int, limit: int) -> Response:
     else:
         abort(400, description=f"order_by must be one of {allowed_columns}")
 
+    order_dir = None
     if order:
         app.logger.debug("Validating 'order_dir' parameter..")
         order_dir = request.args.get("order_dir", type=str)
         # need to cast here because the cast value doesn't have a boolean representation
         order = cast(order, db.CHAR) if order_by == "analysis_state" else order
-        if order_dir == "desc":
-            order = order.desc()
-        elif order_dir == "asc":
-            order = order.asc()
-        else:
+        if order_dir not in ["desc", "asc"]:
             abort(400, description="order_dir must be either 'asc' or 'desc'")
         app.logger.debug("Ordering by '%s' in '%s' direction", order_by, order_dir)
 
+    order_column = order if order is not None else models.Analysis.analysis_id
+    # analysis_id breaks ties so that pages don't overlap
+    if order_dir == "desc":
+        order = (order_column.desc(), models.Analysis.analysis_id.desc())
+    else:
+        order = (order_column.asc(), models.Analysis.analysis_id.asc())
+
     app.logger.debug("Validating filter parameters..")
 
     filters = []
@@ -146,15 +263,50 @@ def list_analyses(page: int, limit: int) -> Response:
 
     app.logger.debug("Querying and applying filters..")
 
-    query = models.Analysis.query.options(
-        selectinload(models.Analysis.datasets).options(
+    fields = get_fields(ANALYSIS_COLUMNS + tuple(LIST_GETTERS))
+    csv_columns = [
+        "kind",
+        "analysis_state",
+        "participant_codenames",
+        "family_codenames",
+        "priority",
+        "requester",
+        "assignee",
+        "updated",
+        "result_path",
+        "notes",
+        "analysis_id",
+        "sequencing_id",
+    ]
+    if not expects_json(request) and expects_csv(request):
+        # the export only loads the columns it writes
+        csv_columns = [column for column in csv_columns if wants(fields, column)]
+        fields = set(csv_columns)
+
+    query = models.Analysis.query.options(*user_options(fields)).filter(*filters)
+
+    # only load the relationships that the requested fields need
+    if wants(fields, "family_codenames"):
+        family = [selectinload(models.Participant.family).lazyload("*")]
+    else:
+        family = []
+    if wants(fields, "participant_codenames", "family_codenames"):
+        tissue_sample = [
             selectinload(models.Dataset.tissue_sample).options(
-                selectinload(models.TissueSample.participant).options(
-                    selectinload(models.Participant.family)
-                )
+                selectinload(models.TissueSample.participant).options(*family)
+            )
+        ]
+    else:
+        tissue_sample = []
+    if wants(fields, "sequencing_id", "participant_codenames", "family_codenames"):
+        query = query.options(
+            selectinload(models.Analysis.datasets).options(
+                # the datasets' users aren't part of the result
+                lazyload(models.Dataset.created_by),
+                lazyload(models.Dataset.updated_by),
+                *tissue_sample,
             )
         )
-    ).filter(*filters)
 
     if assignee:
         query = query.join(assignee_user, models.Analysis.assignee)
@@ -240,9 +392,7 @@ def list_analyses(page: int, limit: int) -> Response:
             models.Analysis.analysis_id.in_(select(subquery.c.analysis_id))
         )
 
-    total_count = query.with_entities(
-        func.count(distinct(models.Analysis.analysis_id))
-    ).scalar()
+    total_count = get_total_count(query, models.Analysis.analysis_id, user)
 
     # this is needed to for sorting to work on assignee/requester
     query = (
@@ -256,51 +406,34 @@ def list_analyses(page: int, limit: int) -> Response:
         else query
     )
 
-    analyses = query.order_by(order).limit(limit).offset(page * (limit or 0)).all()
+    if "cursor" in request.args:
+        analyses, next_cursor = keyset_page(
+            query,
+            order_column,
+            models.Analysis.analysis_id,
+            order_dir == "desc",
+            limit,
+        )
+    elif expects_json(request):
+        analyses = query.order_by(*order).limit(limit).offset(page * (limit or 0)).all()
+        next_cursor = False
+    else:
+        # csv exports are written out as the rows are read instead of being loaded upfront
+        analyses = stream_query(
+            query.order_by(*order).limit(limit).offset(page * (limit or 0))
+        )
 
     app.logger.info("Query successful")
 
-    results = [
-        {
-            **asdict(analysis),
-            "sequencing_id": [d.sequencing_id for d in analysis.datasets],
-            "participant_codenames": [
-                d.tissue_sample.participant.participant_codename
-                for d in analysis.datasets
-            ],
-            "family_codenames": [
-                d.tissue_sample.participant.family.family_codename
-                for d in analysis.datasets
-            ],
-            "requester": analysis.requester.username,
-            "updated_by": analysis.updated_by.username,
-            "assignee": analysis.assignee_id and analysis.assignee.username,
-        }
-        for analysis in analyses
-    ]
+    results = (sparse_dict(analysis, LIST_GETTERS, fields) for analysis in analyses)
 
     if expects_json(request):
         app.logger.debug("Returning paginated response..")
-        return paginated_response(results, page, total_count, limit)
+        return paginated_response(list(results), page, total_count, limit, next_cursor)
     elif expects_csv(request):
-        app.logger.debug("Returning paginated response..")
+        app.logger.debug("Returning streamed csv response..")
         return csv_response(
-            results,
-            filename="analyses_report.csv",
-            colnames=[
-                "kind",
-                "analysis_state",
-                "participant_codenames",
-                "family_codenames",
-                "priority",
-                "requester",
-                "assignee",
-                "updated",
-                "result_path",
-                "notes",
-                "analysis_id",
-                "sequencing_id",
-            ],
+            results, filename="analyses_report.csv", colnames=csv_columns
         )
 
     abort(406, "Only 'text/csv' and 'application/json' HTTP accept headers supported")
@@ -312,7 +445,18 @@ def get_analysis(id: int):
 
     user = get_current_user()
 
-    query = models.Analysis.query.filter(models.Analysis.analysis_id == id)
+    fields = get_fields(ANALYSIS_COLUMNS + tuple(DETAIL_GETTERS))
+
+    query = models.Analysis.query.filter(models.Analysis.analysis_id == id).options(
+        *user_options(fields)
+    )
+    if wants(fields, "datasets"):
+        query = query.options(
+            load_datasets(
+                selectinload(models.Dataset.linked_files),
+                selectinload(models.Dataset.groups),
+            )
+        )
 
     if not user.is_admin:
         query = filter_datasets_by_user_groups(
@@ -326,35 +470,7 @@ def get_analysis(id: int):
 
     app.logger.debug("Query successful returning JSON..")
 
-    return jsonify(
-        {
-            **asdict(analysis),
-            "requester": analysis.requester_id and analysis.requester.username,
-            "updated_by": analysis.updated_by_id and analysis.updated_by.username,
-            "assignee": analysis.assignee_id and analysis.assignee.username,
-            "datasets": [
-                {
-                    **asdict(dataset),
-                    "linked_files": dataset.linked_files,
-                    "group_code": [group.group_code for group in dataset.groups],
-                    "tissue_sample_type": dataset.tissue_sample.tissue_sample_type,
-                    "participant_codename": dataset.tissue_sample.participant.participant_codename,
-                    "participant_type": dataset.tissue_sample.participant.participant_type,
-                    "participant_aliases": dataset.tissue_sample.participant.participant_aliases,
-                    "family_aliases": dataset.tissue_sample.participant.family.family_aliases,
-                    "institution": dataset.tissue_sample.participant.institution.institution
-                    if dataset.tissue_sample.participant.institution
-                    else None,
-                    "sex": dataset.tissue_sample.participant.sex,
-                    "family_codename": dataset.tissue_sample.participant.family.family_codename,
-                    "updated_by": dataset.tissue_sample.updated_by.username,
-                    "created_by": dataset.tissue_sample.created_by.username,
-                    "participant_notes": dataset.tissue_sample.participant.notes,
-                }
-                for dataset in analysis.datasets
-            ],
-        }
-    )
+    return json_response(sparse_dict(analysis, DETAIL_GETTERS, fields))
 
 
 analysis_schema = AnalysisSchema()
@@ -473,32 +589,17 @@ def create_analysis():
 
     start_any_pipelines(kind, analysis, found_datasets)
 
-    # TODO: inspect this response payload; it is causing several additional queries
+    # the commit expired everything, so reload what the response needs at once instead of lazily
+    analysis = (
+        models.Analysis.query.filter(
+            models.Analysis.analysis_id == analysis.analysis_id
+        )
+        .options(load_datasets())
+        .one()
+    )
+
     return (
-        jsonify(
-            {
-                **asdict(analysis),
-                "requester": analysis.requester_id and analysis.requester.username,
-                "updated_by": analysis.updated_by_id and analysis.updated_by.username,
-                "assignee": analysis.assignee_id and analysis.assignee.username,
-                "datasets": [
-                    {
-                        **asdict(dataset),
-                        "tissue_sample_type": dataset.tissue_sample.tissue_sample_type,
-                        "participant_codename": dataset.tissue_sample.participant.participant_codename,
-                        "participant_type": dataset.tissue_sample.participant.participant_type,
-                        "institution": dataset.tissue_sample.participant.institution.institution
-                        if dataset.tissue_sample.participant.institution
-                        else None,
-                        "sex": dataset.tissue_sample.participant.sex,
-                        "family_codename": dataset.tissue_sample.participant.family.family_codename,
-                        "updated_by": dataset.tissue_sample.updated_by.username,
-                        "created_by": dataset.tissue_sample.created_by.username,
-                    }
-                    for dataset in analysis.datasets
-                ],
-            }
-        ),
+        json_response(sparse_dict(analysis, CREATED_GETTERS)),
         201,
         {"location": f"/api/analyses/{analysis.analysis_id}"},
     )
@@ -554,33 +655,17 @@ def create_reanalysis(id: int):
     db.session.add(new_analysis)
     transaction_or_abort(db.session.commit)
 
+    # the commit expired everything, so reload what the response needs at once instead of lazily
+    new_analysis = (
+        models.Analysis.query.filter(
+            models.Analysis.analysis_id == new_analysis.analysis_id
+        )
+        .options(load_datasets())
+        .one()
+    )
+
     return (
-        jsonify(
-            {
-                **asdict(new_analysis),
-                "requester": new_analysis.requester_id
-                and new_analysis.requester.username,
-                "updated_by": new_analysis.updated_by_id
-                and new_analysis.updated_by.username,
-                "assignee": new_analysis.assignee_id and new_analysis.assignee.username,
-                "datasets": [
-                    {
-                        **asdict(dataset),
-                        "tissue_sample_type": dataset.tissue_sample.tissue_sample_type,
-                        "participant_codename": dataset.tissue_sample.participant.participant_codename,
-                        "participant_type": dataset.tissue_sample.participant.participant_type,
-                        "institution": dataset.tissue_sample.participant.institution.institution
-                        if dataset.tissue_sample.participant.institution
-                        else None,
-                        "sex": dataset.tissue_sample.participant.sex,
-                        "family_codename": dataset.tissue_sample.participant.family.family_codename,
-                        "updated_by": dataset.tissue_sample.updated_by.username,
-                        "created_by": dataset.tissue_sample.created_by.username,
-                    }
-                    for dataset in new_analysis.datasets
-                ],
-            }
-        ),
+        json_response(sparse_dict(new_analysis, CREATED_GETTERS)),
         201,
         {"location": f"/api/analyses/{new_analysis.analysis_id}"},
     )
@@ -612,7 +697,7 @@ def retroactively_run_pipeline(id: int):
     kind = kinds.pop()
     result = start_any_pipelines(kind, analysis, analysis.datasets)
     if isinstance(result, int):
-        return jsonify({"scheduler_id": result}), 202  # Accepted
+        return json_response({"scheduler_id": result}), 202  # Accepted
     abort(400, description=result)
 
 
@@ -629,10 +714,12 @@ def delete_analysis(id: int):
         db.session.delete(analysis)
         db.session.commit()
         app.logger.debug("Deletion successful")
-        return "Updated", 204
     except:
         db.session.rollback()
         abort(500)
+    # its calls and genotypes are gone from the summary reports
+    bump_generations("variants")
+    return "Updated", 204
 
 
 @analyses_blueprint.route("/api/analyses/<int:id>", methods=["PATCH"])
@@ -703,9 +790,9 @@ def update_analysis(id: int):
 
     app.logger.debug("Update successful, returning JSON..")
 
-    return jsonify(
+    return json_response(
         {
-            **asdict(analysis),
+            **to_dict(analysis),
             "assignee": analysis.assignee_id and analysis.assignee.username,
             "requester": analysis.requester_id and analysis.requester.username,
             "updated_by_id": analysis.updated_by_id and analysis.updated_by.username,
@@ -1,4 +1,3 @@
-from dataclasses import asdict
 from typing import List
 
 from flask import (
@@ -6,16 +5,22 @@ from flask import (
     Response,
     abort,
     current_app as app,
-    jsonify,
     request,
 )
 from flask_login import current_user, login_required
-from sqlalchemy import distinct, func, select
-from sqlalchemy.orm import contains_eager, joinedload, selectinload
+from sqlalchemy import func, select
+from sqlalchemy.orm import contains_eager, joinedload, lazyload, selectinload
 
 from .. import models
+from ..columnar import (
+    ARROW_MIMETYPE,
+    PARQUET_MIMETYPE,
+    columnar_records_response,
+    expects_columnar,
+)
 from ..models import db
 from ..schemas import RNASeqDatasetSchema
+from ..serializers import field_names, json_response, to_dict
 from ..utils import (
     check_admin,
     csv_response,
@@ -26,13 +31,19 @@ from ..utils import (
     filter_updated_or_abort,
     find,
     get_current_user,
+    get_fields,
+    get_total_count,
+    keyset_page,
     paged,
     paginated_response,
+    sparse_dict,
     transaction_or_abort,
     str_to_bool,
+    stream_query,
     validate_enums_and_set_fields,
     validate_filter_input,
     validate_json,
+    wants,
 )
 
 EDITABLE_COLUMNS = [
@@ -51,6 +62,67 @@ EDITABLE_COLUMNS = [
     "batch_id",
 ]
 
+# The keys of each list_datasets result besides the dataset columns, all selectable with ?fields=
+LIST_GETTERS = {
+    "linked_files": lambda dataset: dataset.linked_files,
+    "tissue_sample_type": lambda dataset: dataset.tissue_sample.tissue_sample_type,
+    "participant_aliases": lambda dataset: dataset.tissue_sample.participant.participant_aliases,
+    "participant_codename": lambda dataset: dataset.tissue_sample.participant.participant_codename,
+    "participant_type": lambda dataset: dataset.tissue_sample.participant.participant_type,
+    "institution": lambda dataset: dataset.tissue_sample.participant.institution
+    and dataset.tissue_sample.participant.institution.institution,
+    "sex": lambda dataset: dataset.tissue_sample.participant.sex,
+    "family_codename": lambda dataset: dataset.tissue_sample.participant.family.family_codename,
+    "family_aliases": lambda dataset: dataset.tissue_sample.participant.family.family_aliases,
+    "created_by": lambda dataset: dataset.created_by.username,
+    "updated_by": lambda dataset: dataset.updated_by.username,
+    "group_code": lambda dataset: [group.group_code for group in dataset.groups],
+    "analyses": lambda dataset: [to_dict(analysis) for analysis in dataset.analyses],
+}
+
+# The keys of the get_dataset result besides the dataset columns
+DETAIL_GETTERS = {
+    "linked_files": lambda dataset: dataset.linked_files,
+    "tissue_sample": lambda dataset: dataset.tissue_sample,
+    "tissue_sample_type": lambda dataset: dataset.tissue_sample.tissue_sample_type,
+    "participant_codename": lambda dataset: dataset.tissue_sample.participant.participant_codename,
+    "participant_aliases": lambda dataset: dataset.tissue_sample.participant.participant_aliases,
+    "participant_type": lambda dataset: dataset.tissue_sample.participant.participant_type,
+    "institution": lambda dataset: dataset.tissue_sample.participant.institution.institution
+    if dataset.tissue_sample.participant.institution
+    else None,
+    "sex": lambda dataset: dataset.tissue_sample.participant.sex,
+    "family_codename": lambda dataset: dataset.tissue_sample.participant.family.family_codename,
+    "family_aliases": lambda dataset: dataset.tissue_sample.participant.family.family_aliases,
+    "group_code": lambda dataset: [group.group_code for group in dataset.groups],
+    "created_by": lambda dataset: dataset.tissue_sample.participant.created_by.username,
+    "updated_by": lambda dataset: dataset.tissue_sample.participant.updated_by.username,
+    "analyses": lambda dataset: [
+        {
+            **to_dict(analysis),
+            "requester": analysis.requester.username,
+            "updated_by": analysis.updated_by.username,
+            "assignee": analysis.assignee_id and analysis.assignee.username,
+        }
+        for analysis in dataset.analyses
+    ],
+}
+
+# A dataset may be an RNASeqDataset, which has a few more columns
+DATASET_COLUMNS = field_names(models.RNASeqDataset)
+
+# Results that need the participant of each dataset, and the family of its participant
+PARTICIPANT_FIELDS = [
+    "participant_aliases",
+    "participant_codename",
+    "participant_type",
+    "institution",
+    "sex",
+    "family_codename",
+    "family_aliases",
+]
+FAMILY_FIELDS = ["family_codename", "family_aliases"]
+
 datasets_blueprint = Blueprint(
     "datasets",
     __name__,
@@ -85,7 +157,15 @@ def list_datasets(page: int, limit: int) -> Response:
     elif order_by == "updated_by":
         order = models.User.username
     elif order_by == "linked_files":
-        order = models.File.path
+        # a dataset can have several files, order by the first path
+        order = (
+            select(func.min(models.File.path))
+            .join_from(models.datasets_files_table, models.File)
+            .where(
+                models.datasets_files_table.c.dataset_id == models.Dataset.dataset_id
+            )
+            .scalar_subquery()
+        )
     elif order_by == "tissue_sample_type":
         order = models.TissueSample.tissue_sample_type
     elif order_by == "participant_codename":
@@ -99,7 +179,9 @@ def list_datasets(page: int, limit: int) -> Response:
     else:
         abort(400, description=f"order_by must be one of {allowed_columns}")
 
-    if order:
+    order_column = order if order is not None else models.Dataset.dataset_id
+
+    if order is not None:
         order_dir = request.args.get("order_dir", type=str)
         if order_dir == "desc":
             order = (order.desc(), models.Dataset.dataset_id.desc())
@@ -193,21 +275,65 @@ def list_datasets(page: int, limit: int) -> Response:
 
     user = get_current_user()
 
+    fields = get_fields(DATASET_COLUMNS + tuple(LIST_GETTERS))
+    csv_columns = [
+        "family_codename",
+        "participant_codename",
+        "tissue_sample_type",
+        "dataset_type",
+        "condition",
+        "notes",
+        "linked_files",
+        "updated",
+        "updated_by",
+        "dataset_id",
+    ]
+    columnar = expects_columnar(request)
+    if not expects_json(request) and (expects_csv(request) or columnar):
+        # the export only loads the columns it writes
+        csv_columns = [column for column in csv_columns if wants(fields, column)]
+        fields = set(csv_columns)
+
     query = (
-        models.Dataset.query.options(
-            contains_eager(models.Dataset.tissue_sample)
-            .contains_eager(models.TissueSample.participant)
-            .contains_eager(models.Participant.family),
-            selectinload(models.Dataset.groups),
-            selectinload(models.Dataset.linked_files),
-        )
-        .join(models.Dataset.tissue_sample)
+        models.Dataset.query.join(models.Dataset.tissue_sample)
         .join(models.TissueSample.participant)
         .join(models.Participant.family)
         .join(models.Dataset.updated_by)
         .filter(*filters)
     )
 
+    # only load the relationships that the requested fields need
+    if wants(fields, "tissue_sample_type", *PARTICIPANT_FIELDS):
+        query = query.options(contains_eager(models.Dataset.tissue_sample))
+    if wants(fields, *PARTICIPANT_FIELDS):
+        participant_options = []
+        if wants(fields, "institution"):
+            participant_options.append(selectinload(models.Participant.institution))
+        if wants(fields, *FAMILY_FIELDS):
+            # the family's users aren't part of the result
+            participant_options.append(
+                contains_eager(models.Participant.family).lazyload("*")
+            )
+        query = query.options(
+            contains_eager(models.Dataset.tissue_sample)
+            .contains_eager(models.TissueSample.participant)
+            .options(*participant_options)
+        )
+    query = query.options(
+        contains_eager(models.Dataset.updated_by)
+        if wants(fields, "updated_by")
+        else lazyload(models.Dataset.updated_by),
+        joinedload(models.Dataset.created_by)
+        if wants(fields, "created_by")
+        else lazyload(models.Dataset.created_by),
+    )
+    if wants(fields, "group_code"):
+        query = query.options(selectinload(models.Dataset.groups))
+    if wants(fields, "linked_files"):
+        query = query.options(selectinload(models.Dataset.linked_files))
+    if wants(fields, "analyses"):
+        query = query.options(selectinload(models.Dataset.analyses))
+
     if not user.is_admin:
         query = filter_datasets_by_user_groups(query, user)
 
@@ -237,61 +363,49 @@ def list_datasets(page: int, limit: int) -> Response:
         )
 
     # total_count always refers to the number of unique datasets in the database
-    total_count = query.with_entities(
-        func.count(distinct(models.Dataset.dataset_id))
-    ).scalar()
-
-    datasets = query.order_by(*order).limit(limit).offset(page * (limit or 0)).all()
-
-    results = [
-        {
-            **asdict(dataset),
-            "linked_files": dataset.linked_files,
-            "tissue_sample_type": dataset.tissue_sample.tissue_sample_type,
-            "participant_aliases": dataset.tissue_sample.participant.participant_aliases,
-            "participant_codename": dataset.tissue_sample.participant.participant_codename,
-            "participant_type": dataset.tissue_sample.participant.participant_type,
-            "institution": dataset.tissue_sample.participant.institution
-            and dataset.tissue_sample.participant.institution.institution,
-            "sex": dataset.tissue_sample.participant.sex,
-            "family_codename": dataset.tissue_sample.participant.family.family_codename,
-            "family_aliases": dataset.tissue_sample.participant.family.family_aliases,
-            "created_by": dataset.created_by.username,
-            "updated_by": dataset.updated_by.username,
-            "group_code": [group.group_code for group in dataset.groups],
-            "analyses": [{**asdict(analysis)} for analysis in dataset.analyses],
-        }
-        for dataset in datasets
-    ]
+    total_count = get_total_count(query, models.Dataset.dataset_id, user)
+
+    if "cursor" in request.args:
+        datasets, next_cursor = keyset_page(
+            query,
+            order_column,
+            models.Dataset.dataset_id,
+            order_dir == "desc",
+            limit,
+        )
+    elif expects_json(request):
+        datasets = query.order_by(*order).limit(limit).offset(page * (limit or 0)).all()
+        next_cursor = False
+    else:
+        # csv exports are written out as the rows are read instead of being loaded upfront
+        datasets = stream_query(
+            query.order_by(*order).limit(limit).offset(page * (limit or 0))
+        )
 
-    app.logger.debug(
-        "%d datasets to be returned; %d limit; %d total_count",
-        len(datasets),
-        limit or -1,
-        total_count,
-    )
+    results = (sparse_dict(dataset, LIST_GETTERS, fields) for dataset in datasets)
 
     if expects_json(request):
-        return paginated_response(results, page, total_count, limit)
+        results = list(results)
+        app.logger.debug(
+            "%d datasets to be returned; %d limit; %s total_count",
+            len(results),
+            limit or -1,
+            total_count,
+        )
+        return paginated_response(results, page, total_count, limit, next_cursor)
     elif expects_csv(request):
         return csv_response(
-            results,
-            filename="datasets_report.csv",
-            colnames=[
-                "family_codename",
-                "participant_codename",
-                "tissue_sample_type",
-                "dataset_type",
-                "condition",
-                "notes",
-                "linked_files",
-                "updated",
-                "updated_by",
-                "dataset_id",
-            ],
+            results, filename="datasets_report.csv", colnames=csv_columns
+        )
+    elif columnar:
+        return columnar_records_response(
+            results, csv_columns, columnar, "datasets_report"
         )
 
-    abort(406, "Only 'text/csv' and 'application/json' HTTP accept headers supported")
+    abort(
+        406,
+        f"Only 'text/csv', 'application/json', '{PARQUET_MIMETYPE}' and '{ARROW_MIMETYPE}' HTTP accept headers supported",
+    )
 
 
 @datasets_blueprint.route("/api/datasets/<int:id>", methods=["GET"])
@@ -300,13 +414,38 @@ def get_dataset(id: int):
 
     user = get_current_user()
 
-    query = models.Dataset.query.filter_by(dataset_id=id).options(
-        joinedload(models.Dataset.analyses),
-        joinedload(models.Dataset.created_by),
-        joinedload(models.Dataset.updated_by),
-        joinedload(models.Dataset.tissue_sample)
-        .joinedload(models.TissueSample.participant)
-        .joinedload(models.Participant.family),
+    fields = get_fields(DATASET_COLUMNS + tuple(DETAIL_GETTERS))
+
+    query = models.Dataset.query.filter_by(dataset_id=id)
+
+    # only load the relationships that the requested fields need
+    if wants(
+        fields,
+        "tissue_sample",
+        "tissue_sample_type",
+        "created_by",
+        "updated_by",
+        *PARTICIPANT_FIELDS,
+    ):
+        query = query.options(
+            joinedload(models.Dataset.tissue_sample)
+            .joinedload(models.TissueSample.participant)
+            .options(
+                joinedload(models.Participant.institution),
+                joinedload(models.Participant.family).lazyload("*"),
+                joinedload(models.Participant.created_by),
+                joinedload(models.Participant.updated_by),
+            )
+        )
+    if wants(fields, "analyses"):
+        query = query.options(joinedload(models.Dataset.analyses))
+    if wants(fields, "linked_files"):
+        query = query.options(selectinload(models.Dataset.linked_files))
+    if wants(fields, "group_code"):
+        query = query.options(selectinload(models.Dataset.groups))
+    # the dataset's own users aren't part of the result
+    query = query.options(
+        lazyload(models.Dataset.created_by), lazyload(models.Dataset.updated_by)
     )
 
     if not user.is_admin:
@@ -314,35 +453,7 @@ def get_dataset(id: int):
 
     dataset = query.first_or_404()
 
-    return jsonify(
-        {
-            **asdict(dataset),
-            "linked_files": dataset.linked_files,
-            "tissue_sample": dataset.tissue_sample,
-            "tissue_sample_type": dataset.tissue_sample.tissue_sample_type,
-            "participant_codename": dataset.tissue_sample.participant.participant_codename,
-            "participant_aliases": dataset.tissue_sample.participant.participant_aliases,
-            "participant_type": dataset.tissue_sample.participant.participant_type,
-            "institution": dataset.tissue_sample.participant.institution.institution
-            if dataset.tissue_sample.participant.institution
-            else None,
-            "sex": dataset.tissue_sample.participant.sex,
-            "family_codename": dataset.tissue_sample.participant.family.family_codename,
-            "family_aliases": dataset.tissue_sample.participant.family.family_aliases,
-            "group_code": [group.group_code for group in dataset.groups],
-            "created_by": dataset.tissue_sample.participant.created_by.username,
-            "updated_by": dataset.tissue_sample.participant.updated_by.username,
-            "analyses": [
-                {
-                    **asdict(analysis),
-                    "requester": analysis.requester.username,
-                    "updated_by": analysis.updated_by.username,
-                    "assignee": analysis.assignee_id and analysis.assignee.username,
-                }
-                for analysis in dataset.analyses
-            ],
-        }
-    )
+    return json_response(sparse_dict(dataset, DETAIL_GETTERS, fields))
 
 
 @datasets_blueprint.route("/api/datasets/<int:id>", methods=["PATCH"])
@@ -378,9 +489,9 @@ def update_dataset(id: int):
 
     transaction_or_abort(db.session.commit)
 
-    return jsonify(
+    return json_response(
         {
-            **asdict(dataset),
+            **to_dict(dataset),
             "linked_files": dataset.linked_files,
             "updated_by": dataset.updated_by.username,
             "created_by": dataset.created_by.username,
@@ -478,9 +589,9 @@ def create_dataset():
     transaction_or_abort(db.session.commit)
 
     return (
-        jsonify(
+        json_response(
             {
-                **asdict(dataset),
+                **to_dict(dataset),
                 "updated_by": dataset.updated_by.username,
                 "created_by": dataset.created_by.username,
             }
@@ -1,12 +1,11 @@
-from dataclasses import asdict
-
-from flask import abort, jsonify, request, Blueprint, current_app as app
+from flask import abort, request, Blueprint, current_app as app
 from flask_login import current_user, login_required
 from sqlalchemy.orm import joinedload
 
 from .. import models
 from ..models import db
 from ..schemas import FamilySchema
+from ..serializers import json_response, to_dict
 from ..utils import (
     check_admin,
     filter_datasets_by_user_groups,
@@ -70,7 +69,9 @@ def list_families():
     user = get_current_user()
 
     query = models.Family.query.options(
-        joinedload(models.Family.participants),
+        joinedload(models.Family.participants).joinedload(
+            models.Participant.institution
+        ),
         joinedload(models.Family.created_by),
         joinedload(models.Family.updated_by),
     ).filter(models.Family.family_codename.like(starts_with))
@@ -86,13 +87,13 @@ def list_families():
     families = query.order_by(column).limit(max_rows).all()
 
     app.logger.debug("Query successful, returning JSON...")
-    return jsonify(
+    return json_response(
         [
             {
-                **asdict(family),
+                **to_dict(family),
                 "participants": [
                     {
-                        **asdict(participant),
+                        **to_dict(participant),
                         "institution": participant.institution.institution
                         if participant.institution
                         else None,
@@ -114,8 +115,9 @@ def get_family(id: int):
     user = get_current_user()
 
     query = models.Family.query.filter_by(family_id=id).options(
-        joinedload(models.Family.participants).joinedload(
-            models.Participant.tissue_samples
+        joinedload(models.Family.participants).options(
+            joinedload(models.Participant.institution),
+            joinedload(models.Participant.tissue_samples),
         ),
         joinedload(models.Family.created_by),
         joinedload(models.Family.updated_by),
@@ -132,15 +134,15 @@ def get_family(id: int):
     family = query.first_or_404()
 
     app.logger.debug("Query successful, returning JSON...")
-    return jsonify(
+    return json_response(
         [
             {
-                **asdict(family),
+                **to_dict(family),
                 "updated_by": family.updated_by.username,
                 "created_by": family.created_by.username,
                 "participants": [
                     {
-                        **asdict(participant),
+                        **to_dict(participant),
                         "institution": participant.institution.institution
                         if participant.institution
                         else None,
@@ -148,7 +150,7 @@ def get_family(id: int):
                         "created_by": participant.created_by.username,
                         "tissue_samples": [
                             {
-                                **asdict(tissue_sample),
+                                **to_dict(tissue_sample),
                                 "updated_by": tissue_sample.updated_by.username,
                                 "created_by": tissue_sample.created_by.username,
                             }
@@ -226,10 +228,10 @@ def update_family(id: int):
 
     transaction_or_abort(db.session.commit)
 
-    return jsonify(
+    return json_response(
         [
             {
-                **asdict(family),
+                **to_dict(family),
                 "updated_by": family.updated_by.username,
                 "created_by": family.created_by.username,
             }
@@ -299,9 +301,9 @@ def create_family():
 
     app.logger.debug("Family successfully added to the database. Returning json..")
     return (
-        jsonify(
+        json_response(
             {
-                **asdict(fam_objs),
+                **to_dict(fam_objs),
                 "updated_by": fam_objs.updated_by.username,
                 "created_by": fam_objs.created_by.username,
             }
@@ -1,12 +1,12 @@
-from dataclasses import asdict
 from typing import Any, Dict
 
-from flask import abort, jsonify, request, Blueprint
+from flask import abort, request, Blueprint
 from flask_login import login_required
 from sqlalchemy import func
 from sqlalchemy.orm import contains_eager, joinedload
 
 from ..models import Gene, GeneAlias
+from ..serializers import json_response, to_dict
 from ..utils import csv_response, expects_csv, expects_json, paged, paginated_response
 
 genes_blueprint = Blueprint(
@@ -41,7 +41,7 @@ def genes(page: int, limit: int):
 
 def serialize(gene: Gene) -> Dict[str, Any]:
     return {
-        **asdict(gene),
+        **to_dict(gene),
         "aliases": [{"name": alias.name, "kind": alias.kind} for alias in gene.aliases],
     }
 
@@ -56,7 +56,7 @@ def get_gene_by_name(name: str):
         .filter(GeneAlias.name == name)
         .first_or_404()
     )
-    return jsonify(serialize(gene))
+    return json_response(serialize(gene))
 
 
 @genes_blueprint.route("/api/summary/genes/ensg/<int:ensembl_id>", methods=["GET"])
@@ -68,4 +68,4 @@ def get_gene_ensg_id(ensembl_id: int):
         .filter_by(ensembl_id=ensembl_id)
         .first_or_404()
     )
-    return jsonify(serialize(gene))
+    return json_response(serialize(gene))
@@ -1,24 +1,26 @@
-from dataclasses import asdict
+from datetime import date
 from enum import Enum
 import inspect
 from io import StringIO
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List, Tuple
 
-from flask import Blueprint, abort, current_app as app, jsonify, request, Request
+from flask import Blueprint, abort, current_app as app, request
 from flask.helpers import url_for
 from flask_login import current_user, login_required, login_user, logout_user
 import numpy as np
 import pandas as pd
+from sqlalchemy import select
 from sqlalchemy.orm import joinedload
 from .. import models, schemas
 from ..models import db
+from ..serializers import json_response, to_dict
 from ..utils import (
     get_current_user,
+    str_to_bool,
     transaction_or_abort,
     validate_json,
     validate_filter_input,
     update_last_login,
-    find,
 )
 
 
@@ -47,7 +49,7 @@ def version():
     }
     if app.config.get("ENABLE_OIDC"):
         api_info["oauth_provider"] = app.config.get("OIDC_PROVIDER")
-    return jsonify(api_info)
+    return json_response(api_info)
 
 
 @routes.route("/api/login", methods=["POST"])
@@ -181,7 +183,7 @@ def logout():
             except KeyError as err:
                 app.logger.error(err.args[0])
 
-    return ("", 204) if url == "" else (jsonify({"redirect_uri": url}), 200)
+    return ("", 204) if url == "" else (json_response({"redirect_uri": url}), 200)
 
 
 def validate_user(request_user: dict):
@@ -201,14 +203,13 @@ def get_institutions():
     app.logger.info("Retrieving all institutions..")
     db_institutions = models.Institution.query.all()
     app.logger.info("Returning institutions as JSON..")
-    return jsonify([x.institution for x in db_institutions])
+    return json_response([x.institution for x in db_institutions])
 
 
 @routes.route("/api/_bulk", methods=["POST"])
 @login_required
 def bulk_update():
     app.logger.info("Starting bulk upload...")
-    dataset_ids = []
 
     app.logger.info("Checking content type..")
     if request.content_type == "text/csv":
@@ -324,225 +325,31 @@ def bulk_update():
             )
             abort(403, description="User does not belong to any permission groups")
 
-    app.logger.info("Begin processing and inserting records into the database..")
-    for i, row in enumerate(dat):
-        app.logger.info("Start Record: %s", i)
-
-        row_family = validate_filter_input(row, models.Family)
-        error_family = family_schema.validate(row_family, session=db.session)
-
-        if error_family:
-            app.logger.error(error_family)
-            db.session.rollback()
-            abort(400, description=error_family)
-
-        # Find the family by codename or create it if it doesn't exist
-
-        app.logger.debug(
-            "\tChecking whether family already exists through codename '%s'..",
-            row.get("family_codename"),
-        )
-        family_id = (
-            db.session.query(models.Family.family_id)
-            .filter(models.Family.family_codename == row.get("family_codename"))
-            .scalar()
-        )
-        if not family_id:
-            app.logger.debug(
-                "\tFamily '%s' does not yet exist.., creating",
-                row.get("family_codename"),
-            )
-            family = models.Family(
-                family_codename=row.get("family_codename"),
-                created_by_id=created_by_id,
-                updated_by_id=updated_by_id,
-            )
-            db.session.add(family)
-            app.logger.debug("\tInserting instance into database..")
-            transaction_or_abort(db.session.flush)
-            family_id = family.family_id
-        else:
-            app.logger.debug(
-                "\tFamily ID '%s' already exists and won't be created.", family_id
-            )
-        row["family_id"] = family_id
-
-        app.logger.debug("\tRetrieving institution")
-        institution = row.get("institution")
-        if institution:
-            app.logger.debug(
-                "\tChecking supplied institution name, '%s', exists..", institution
-            )
-            institution_obj = models.Institution.query.filter(
-                models.Institution.institution == institution
-            ).one_or_none()
-            if institution_obj:
-                app.logger.debug("\tInstitution name exists, assigning its id")
-                institution_id = institution_obj.institution_id
-            else:
-                app.logger.debug(
-                    "\tInstitution name does not exist, creating a new entry in the database"
-                )
-                institution_obj = models.Institution(institution=institution)
-                db.session.add(institution_obj)
-                transaction_or_abort(db.session.flush)
-                institution_id = institution_obj.institution_id
-        else:
-            app.logger.debug("\tNo institution supplied")
-
-        row_participant = validate_filter_input(row, models.Participant)
-
-        error_participant = participant_schema.validate(
-            row_participant, session=db.session
-        )
-        if error_participant:
-            app.logger.error(error_participant)
-            db.session.rollback()
-            abort(400, description=error_participant)
-
-        # Find the participant by codename or create it if it doesn't exist
-        app.logger.debug(
-            "\tChecking participant exists through codename '%s'",
-            row.get("participant_codename"),
-        )
-        participant_id = (
-            db.session.query(models.Participant.participant_id)
-            .filter(
-                models.Participant.family_id == family_id,
-                models.Participant.participant_codename
-                == row.get("participant_codename"),
-            )
-            .scalar()
-        )
-        if not participant_id:
-            app.logger.debug("\tParticipant does not exist, creating")
-            participant = models.Participant(
-                family_id=row.get("family_id"),
-                participant_codename=row.get("participant_codename"),
-                sex=row.get("sex"),
-                affected=row.get("affected"),
-                solved=row.get("solved"),
-                participant_type=row.get("participant_type"),
-                institution_id=institution_id if institution else None,
-                month_of_birth=row.get("month_of_birth"),
-                created_by_id=created_by_id,
-                updated_by_id=updated_by_id,
-            )
-            app.logger.debug("\tCreating entry in the database..")
-            db.session.add(participant)
-            transaction_or_abort(db.session.flush)
-            participant_id = participant.participant_id
-
-        else:
-            app.logger.debug(
-                "\tParticipant already exists and will not be added to the database"
-            )
-        row["participant_id"] = participant_id
-
-        app.logger.debug("\tChecking duplicate dataset..")
-        db_datasets_number = (
-            db.session.query(models.Dataset)
-            .join(models.Dataset.tissue_sample)
-            .join(models.TissueSample.participant)
-            .join(models.Participant.family)
-            .filter(
-                models.Dataset.dataset_type == row.get("dataset_type"),
-                models.Participant.family_id == family_id,
-                models.Participant.participant_id == participant_id,
-                models.Dataset.sequencing_date == row.get("sequencing_date"),
-                models.TissueSample.tissue_sample_type == row.get("tissue_sample_type"),
-            )
-            .count()
-        )
-
-        if db_datasets_number > 0:
-            app.logger.error("\tThe dataset is a duplicate of an existing dataset.")
-            db.session.rollback()
-            abort(
-                400,
-                "One of the added datasets is a duplicate of an existing or added dataset.",
-            )
-        row_tissue_sample = validate_filter_input(row, models.TissueSample)
-
-        error_tissue_sample = tissue_sample_schema.validate(
-            row_tissue_sample, session=db.session
-        )
-        if error_tissue_sample:
-            app.logger.error(error_tissue_sample)
-            db.session.rollback()
-            abort(400, description=error_tissue_sample)
-
-        # Create a new tissue sample under this participant
-        app.logger.debug("\tCreating a new tissue sample..")
-        tissue_sample = models.TissueSample(
-            participant_id=participant_id,
-            tissue_sample_type=row.get("tissue_sample_type"),
-            notes=row.get("notes"),
+    if request.args.get("async", type=str_to_bool, default=False):
+        app.logger.info("Queueing the upload to be processed in the background..")
+        job = models.BulkUploadJob(
+            status=models.BulkUploadStatus.Queued,
+            rows=dat,
+            content_type=request.content_type,
+            group_ids=[group.group_id for group in groups],
+            rows_total=len(dat),
             created_by_id=created_by_id,
-            updated_by_id=updated_by_id,
-        )
-        app.logger.debug("\tCreating tissue sample entry in the database..")
-        db.session.add(tissue_sample)
-        transaction_or_abort(db.session.flush)
-        row["tissue_sample_id"] = tissue_sample.tissue_sample_id
-        app.logger.debug("\tDone")
-
-        row_dataset = validate_filter_input(
-            row, models.RNASeqDataset, ["discriminator", "linked_files"]
         )
-
-        error_dataset = dataset_schema.validate(row_dataset, session=db.session)
-        if error_dataset:
-            app.logger.error(error_dataset)
-            db.session.rollback()
-            abort(400, description=error_dataset)
-
-        app.logger.debug("\tCreating a new dataset..")
-
-        base_fields = {
-            "batch_id": row.get("batch_id"),
-            "capture_kit": row.get("capture_kit"),
-            "condition": row.get("condition"),
-            "created_by_id": created_by_id,
-            "dataset_type": row.get("dataset_type"),
-            "extraction_protocol": row.get("extraction_protocol"),
-            "library_prep_method": row.get("library_prep_method"),
-            "notes": row.get("notes"),
-            "read_length": row.get("read_length"),
-            "read_type": row.get("read_type"),
-            "sequencing_centre": row.get("sequencing_centre"),
-            "sequencing_date": row.get("sequencing_date"),
-            "sequencing_id": row.get("sequencing_id"),
-            "tissue_sample_id": tissue_sample.tissue_sample_id,
-            "updated_by_id": updated_by_id,
-        }
-
-        rna_seq_fields = {
-            **base_fields,
-            "candidate_genes": row.get("candidate_genes"),
-            "vcf_available": row.get("vcf_available"),
-        }
-
-        dataset = (
-            models.RNASeqDataset(**rna_seq_fields)
-            if row.get("dataset_type") == "RRS"
-            else models.Dataset(**base_fields)
+        db.session.add(job)
+        transaction_or_abort(db.session.commit)
+        location = url_for("routes.get_bulk_job", job_id=job.bulk_upload_job_id)
+        return (
+            json_response(
+                {"bulk_upload_job_id": job.bulk_upload_job_id, "status": job.status}
+            ),
+            202,
+            {"location": location},
         )
 
-        app.logger.debug("\tLinking files to dataset..")
-
-        dataset = link_files_to_dataset(request, dataset, row)
-
-        app.logger.debug("\tAdding users groups to the dataset")
-        dataset.groups += groups
-        app.logger.debug("\tCreating dataset entry in the database..")
-        app.logger.debug(dataset.__dict__)
-        db.session.add(dataset)
-        transaction_or_abort(db.session.flush)
-        app.logger.debug("\tDone")
-        dataset_ids.append(dataset.dataset_id)
-
-        app.logger.info("End Record: %s", i)
+    app.logger.info("Begin processing and inserting records into the database..")
+    dataset_ids = insert_bulk_rows(
+        dat, groups, created_by_id, updated_by_id, request.content_type
+    )
 
     transaction_or_abort(db.session.commit)
     app.logger.debug("%s datasets added", len(dataset_ids))
@@ -561,7 +368,7 @@ def bulk_update():
 
     datasets = [
         {
-            **asdict(dataset),
+            **to_dict(dataset),
             "tissue_sample_type": dataset.tissue_sample.tissue_sample_type,
             "participant_codename": dataset.tissue_sample.participant.participant_codename,
             "participant_type": dataset.tissue_sample.participant.participant_type,
@@ -575,14 +382,322 @@ def bulk_update():
         for dataset in db_datasets
     ]
     app.logger.info("Done, returning JSON..")
-    return jsonify(datasets)
+    return json_response(datasets)
 
 
-def link_files_to_dataset(
-    req: Request, dataset: models.Dataset, row: Dict[str, Any]
-) -> models.Dataset:
-    """validate filepaths and link to a dataset"""
-    if req.content_type == "text/csv":
+@routes.route("/api/_bulk/<int:job_id>", methods=["GET"])
+@login_required
+def get_bulk_job(job_id: int):
+    """
+    Progress of an upload made with POST /api/_bulk?async=true, which is visible to its uploader and admins.
+    """
+    user = get_current_user()
+    job = models.BulkUploadJob.query.filter(
+        models.BulkUploadJob.bulk_upload_job_id == job_id
+    ).first_or_404()
+    if job.created_by_id != user.user_id and not user.is_admin:
+        abort(404)
+    return json_response(job)
+
+
+def set_parent_id(row: Dict[str, Any], key: str, parent: Any) -> Tuple[str, ...]:
+    """
+    Sets the foreign key of an uploaded row to the id of its parent, if the parent already exists.
+    Parents created earlier in the same upload are only assigned ids by the single flush at the end, so the key is
+    removed instead and returned, to be skipped when the row is validated.
+    """
+    if isinstance(parent, int):
+        row[key] = parent
+        return ()
+    row.pop(key, None)
+    return (key,)
+
+
+def as_date(value: Any) -> Any:
+    """parse an ISO date the way MySQL would when comparing it against a DATE column"""
+    if isinstance(value, str):
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            pass
+    return value
+
+
+def casefold(value: Any) -> Any:
+    """string keys are compared case-insensitively, like the database's default collation"""
+    return value.casefold() if isinstance(value, str) else value
+
+
+def insert_bulk_rows(
+    rows: List[Dict[str, Any]],
+    groups: List[models.Group],
+    created_by_id: int,
+    updated_by_id: int,
+    content_type: str,
+    progress: Callable[[int], None] = None,
+) -> List[int]:
+    """
+    Validate and insert the rows of a bulk upload, creating families, participants and institutions as needed,
+    and a tissue sample and dataset for every row. Returns the ids of the created datasets, in row order.
+
+    Everything the rows refer to is fetched upfront in a fixed number of queries and the rows are validated in order
+    against it in memory, so that the first invalid row aborts the upload with the same error as if the rows had been
+    inserted one by one. The new records are then inserted in a single flush.
+    If given, progress is called with the number of rows validated so far after every row.
+    """
+    family_codenames = {casefold(row.get("family_codename")) for row in rows}
+    family_codenames.discard(None)
+    families = {
+        casefold(family_codename): family_id
+        for family_id, family_codename in db.session.query(
+            models.Family.family_id, models.Family.family_codename
+        ).filter(models.Family.family_codename.in_(list(family_codenames)))
+    }
+
+    institution_names = {casefold(row.get("institution")) for row in rows}
+    institution_names.discard(None)
+    institutions = {
+        casefold(institution.institution): institution
+        for institution in models.Institution.query.filter(
+            models.Institution.institution.in_(list(institution_names))
+        )
+    }
+
+    # participants are keyed by their family's codename so that they can be matched before new families have ids
+    family_codenames_by_id = {
+        family_id: family_codename for family_codename, family_id in families.items()
+    }
+    participants = {
+        (
+            family_codenames_by_id[family_id],
+            casefold(participant_codename),
+        ): participant_id
+        for participant_id, family_id, participant_codename in db.session.query(
+            models.Participant.participant_id,
+            models.Participant.family_id,
+            models.Participant.participant_codename,
+        ).filter(models.Participant.family_id.in_(list(family_codenames_by_id)))
+    }
+
+    participant_keys_by_id = {
+        participant_id: participant_key
+        for participant_key, participant_id in participants.items()
+    }
+    # select from the base table to avoid joining every polymorphic subclass
+    dataset_table = models.Dataset.__table__
+    existing_datasets = {
+        (
+            participant_keys_by_id[participant_id],
+            casefold(dataset_type),
+            sequencing_date,
+            casefold(tissue_sample_type),
+        )
+        for participant_id, dataset_type, sequencing_date, tissue_sample_type in db.session.execute(
+            select(
+                models.TissueSample.participant_id,
+                dataset_table.c.dataset_type,
+                dataset_table.c.sequencing_date,
+                models.TissueSample.tissue_sample_type,
+            )
+            .join_from(
+                dataset_table,
+                models.TissueSample,
+                dataset_table.c.tissue_sample_id
+                == models.TissueSample.tissue_sample_id,
+            )
+            .where(models.TissueSample.participant_id.in_(list(participant_keys_by_id)))
+        )
+    }
+
+    linked_files = [parse_linked_files(content_type, row) for row in rows]
+    files = {
+        file.path: file
+        for file in models.File.query.filter(
+            models.File.path.in_(
+                list({file["path"] for row_files in linked_files for file in row_files})
+            )
+        )
+    }
+
+    datasets = []
+    with db.session.no_autoflush:
+        for i, row in enumerate(rows):
+            app.logger.info("Start Record: %s", i)
+
+            row_family = validate_filter_input(row, models.Family)
+            error_family = family_schema.validate(row_family, session=db.session)
+
+            if error_family:
+                app.logger.error(error_family)
+                db.session.rollback()
+                abort(400, description=error_family)
+
+            # Find the family by codename or create it if it doesn't exist
+            family_key = casefold(row.get("family_codename"))
+            family = families.get(family_key)
+            if not family:
+                app.logger.debug(
+                    "\tFamily '%s' does not yet exist.., creating",
+                    row.get("family_codename"),
+                )
+                family = models.Family(
+                    family_codename=row.get("family_codename"),
+                    created_by_id=created_by_id,
+                    updated_by_id=updated_by_id,
+                )
+                db.session.add(family)
+                families[family_key] = family
+            pending_family = set_parent_id(row, "family_id", family)
+
+            institution = row.get("institution")
+            if institution:
+                institution_obj = institutions.get(casefold(institution))
+                if not institution_obj:
+                    app.logger.debug(
+                        "\tInstitution name '%s' does not exist, creating a new entry in the database",
+                        institution,
+                    )
+                    institution_obj = models.Institution(institution=institution)
+                    db.session.add(institution_obj)
+                    institutions[casefold(institution)] = institution_obj
+
+            row_participant = validate_filter_input(row, models.Participant)
+
+            error_participant = participant_schema.validate(
+                row_participant, session=db.session, partial=pending_family
+            )
+            if error_participant:
+                app.logger.error(error_participant)
+                db.session.rollback()
+                abort(400, description=error_participant)
+
+            # Find the participant by codename or create it if it doesn't exist
+            participant_key = (family_key, casefold(row.get("participant_codename")))
+            participant = participants.get(participant_key)
+            if not participant:
+                app.logger.debug("\tParticipant does not exist, creating")
+                participant = models.Participant(
+                    participant_codename=row.get("participant_codename"),
+                    sex=row.get("sex"),
+                    affected=row.get("affected"),
+                    solved=row.get("solved"),
+                    participant_type=row.get("participant_type"),
+                    institution=institution_obj if institution else None,
+                    month_of_birth=row.get("month_of_birth"),
+                    created_by_id=created_by_id,
+                    updated_by_id=updated_by_id,
+                )
+                if isinstance(family, int):
+                    participant.family_id = family
+                else:
+                    participant.family = family
+                db.session.add(participant)
+                participants[participant_key] = participant
+            pending_participant = set_parent_id(row, "participant_id", participant)
+
+            app.logger.debug("\tChecking duplicate dataset..")
+            dataset_key = (
+                participant_key,
+                casefold(row.get("dataset_type")),
+                as_date(row.get("sequencing_date")),
+                casefold(row.get("tissue_sample_type")),
+            )
+            if dataset_key in existing_datasets:
+                app.logger.error("\tThe dataset is a duplicate of an existing dataset.")
+                db.session.rollback()
+                abort(
+                    400,
+                    "One of the added datasets is a duplicate of an existing or added dataset.",
+                )
+            existing_datasets.add(dataset_key)
+
+            row_tissue_sample = validate_filter_input(row, models.TissueSample)
+
+            error_tissue_sample = tissue_sample_schema.validate(
+                row_tissue_sample, session=db.session, partial=pending_participant
+            )
+            if error_tissue_sample:
+                app.logger.error(error_tissue_sample)
+                db.session.rollback()
+                abort(400, description=error_tissue_sample)
+
+            # Create a new tissue sample under this participant
+            tissue_sample = models.TissueSample(
+                tissue_sample_type=row.get("tissue_sample_type"),
+                notes=row.get("notes"),
+                created_by_id=created_by_id,
+                updated_by_id=updated_by_id,
+            )
+            if isinstance(participant, int):
+                tissue_sample.participant_id = participant
+            else:
+                tissue_sample.participant = participant
+            db.session.add(tissue_sample)
+            pending_tissue_sample = set_parent_id(
+                row, "tissue_sample_id", tissue_sample
+            )
+
+            row_dataset = validate_filter_input(
+                row, models.RNASeqDataset, ["discriminator", "linked_files"]
+            )
+
+            error_dataset = dataset_schema.validate(
+                row_dataset, session=db.session, partial=pending_tissue_sample
+            )
+            if error_dataset:
+                app.logger.error(error_dataset)
+                db.session.rollback()
+                abort(400, description=error_dataset)
+
+            base_fields = {
+                "batch_id": row.get("batch_id"),
+                "capture_kit": row.get("capture_kit"),
+                "condition": row.get("condition"),
+                "created_by_id": created_by_id,
+                "dataset_type": row.get("dataset_type"),
+                "extraction_protocol": row.get("extraction_protocol"),
+                "library_prep_method": row.get("library_prep_method"),
+                "notes": row.get("notes"),
+                "read_length": row.get("read_length"),
+                "read_type": row.get("read_type"),
+                "sequencing_centre": row.get("sequencing_centre"),
+                "sequencing_date": row.get("sequencing_date"),
+                "sequencing_id": row.get("sequencing_id"),
+                "tissue_sample": tissue_sample,
+                "updated_by_id": updated_by_id,
+            }
+
+            rna_seq_fields = {
+                **base_fields,
+                "candidate_genes": row.get("candidate_genes"),
+                "vcf_available": row.get("vcf_available"),
+            }
+
+            dataset = (
+                models.RNASeqDataset(**rna_seq_fields)
+                if row.get("dataset_type") == "RRS"
+                else models.Dataset(**base_fields)
+            )
+
+            app.logger.debug("\tLinking files to dataset..")
+            link_files(dataset, linked_files[i], files)
+
+            dataset.groups += groups
+            db.session.add(dataset)
+            datasets.append(dataset)
+
+            app.logger.info("End Record: %s", i)
+            if progress:
+                progress(i + 1)
+
+    app.logger.debug("Inserting %s datasets into the database..", len(datasets))
+    transaction_or_abort(db.session.flush)
+    return [dataset.dataset_id for dataset in datasets]
+
+
+def parse_linked_files(content_type: str, row: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """read the linked files of an uploaded row, which are | separated paths in CSV uploads"""
+    if content_type == "text/csv":
         linked_files = (row.get("linked_files") or "").split("|")
         app.logger.debug(
             "\tContent type is `text/csv` and linked files are expected to be | separated: '%s'",
@@ -598,25 +713,28 @@ def link_files_to_dataset(
                         "multiplexed": is_multiplex,
                     }
                 )
+        return files
 
-    else:
-        app.logger.debug(
-            "\tContent type is NOT `test/csv` and linked files are expected to be in a list: '%s'",
-            row.get("linked_files", []),
-        )
-        files = row.get("linked_files", [])
+    app.logger.debug(
+        "\tContent type is NOT `test/csv` and linked files are expected to be in a list: '%s'",
+        row.get("linked_files", []),
+    )
+    return row.get("linked_files", [])
 
-    extant_files = models.File.query.filter(
-        models.File.path.in_([f["path"] for f in files])
-    ).all()
 
+def link_files(
+    dataset: models.Dataset,
+    files: List[Dict[str, Any]],
+    extant_files: Dict[str, models.File],
+) -> models.Dataset:
+    """
+    Link files to a dataset given the already known files by path. Files that are created are added to extant_files,
+    so that linking them again later in the same upload is subject to the same multiplexing rules.
+    """
     dataset.linked_files = []
 
     for file in files:
-        extant = find(
-            extant_files,
-            lambda extant, path=file["path"]: extant.path == path,
-        )
+        extant = extant_files.get(file["path"])
         if extant and (not extant.multiplexed or not file["multiplexed"]):
             path = file.get("path")
             abort(
@@ -626,10 +744,10 @@ def link_files_to_dataset(
         elif extant:
             dataset.linked_files.append(extant)
         else:
-            dataset.linked_files.append(
-                models.File(
-                    path=file["path"],
-                    multiplexed=file.get("multiplexed"),
-                )
+            created = models.File(
+                path=file["path"],
+                multiplexed=file.get("multiplexed"),
             )
+            dataset.linked_files.append(created)
+            extant_files[created.path] = created
     return dataset
@@ -1,14 +1,20 @@
-from dataclasses import asdict
-
-from flask import Blueprint, Response, abort, jsonify, request
+from flask import Blueprint, Response, abort, request
 from flask import current_app as app
 from flask_login import current_user, login_required
-from sqlalchemy import distinct, func, select
-from sqlalchemy.orm import contains_eager, joinedload
+from sqlalchemy import func, select
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+from sqlalchemy.sql import Select
 
 from .. import models
+from ..columnar import (
+    ARROW_MIMETYPE,
+    PARQUET_MIMETYPE,
+    columnar_records_response,
+    expects_columnar,
+)
 from ..models import db
 from ..schemas import ParticipantSchema
+from ..serializers import field_names, json_response, to_dict
 from ..utils import (
     check_admin,
     csv_response,
@@ -19,13 +25,19 @@ from ..utils import (
     filter_nullable_bool_or_abort,
     filter_updated_or_abort,
     get_current_user,
+    get_fields,
+    get_total_count,
+    keyset_page,
     paged,
     paginated_response,
+    sparse_dict,
     transaction_or_abort,
     str_to_bool,
+    stream_query,
     validate_enums_and_set_fields,
     validate_json,
     validate_filter_input,
+    wants,
 )
 
 editable_columns = [
@@ -40,6 +52,77 @@ editable_columns = [
 ]
 
 
+# The keys of each list_participants result besides the participant columns, all selectable with ?fields=
+LIST_GETTERS = {
+    "family_codename": lambda participant: participant.family.family_codename,
+    "family_aliases": lambda participant: participant.family.family_aliases,
+    "family_id": lambda participant: participant.family.family_id,
+    "institution": lambda participant: participant.institution.institution
+    if participant.institution
+    else None,
+    "updated_by": lambda participant: participant.updated_by.username,
+    "created_by": lambda participant: participant.created_by.username,
+    "tissue_samples": lambda participant: [
+        {
+            **to_dict(tissue_sample),
+            "datasets": [
+                {**to_dict(d), "linked_files": d.linked_files}
+                for d in tissue_sample.datasets
+            ],
+        }
+        for tissue_sample in participant.tissue_samples
+    ],
+}
+
+# The keys of the get_participant result besides the participant columns
+DETAIL_GETTERS = {
+    "family_codename": lambda participant: participant.family.family_codename,
+    "family_aliases": lambda participant: participant.family.family_aliases,
+    "institution": lambda participant: participant.institution.institution
+    if participant.institution
+    else None,
+    "updated_by": lambda participant: participant.updated_by.username,
+    "created_by": lambda participant: participant.created_by.username,
+    "tissue_samples": lambda participant: [
+        {
+            **to_dict(tissue_sample),
+            "created_by": tissue_sample.created_by.username,
+            "updated_by": tissue_sample.updated_by.username,
+            "datasets": [
+                {
+                    **to_dict(d),
+                    "linked_files": d.linked_files,
+                    "created_by": d.created_by.username,
+                    "updated_by": d.updated_by.username,
+                }
+                for d in tissue_sample.datasets
+            ],
+        }
+        for tissue_sample in participant.tissue_samples
+    ],
+}
+
+PARTICIPANT_COLUMNS = field_names(models.Participant)
+
+FAMILY_FIELDS = ["family_codename", "family_aliases", "family_id"]
+
+
+def visible_participant_ids(user: models.User) -> Select:
+    """The participants with any dataset in the user's groups"""
+    # the table rather than the model, which would join against rnaseq_dataset too
+    dataset_table = models.Dataset.__table__
+    return (
+        select(models.TissueSample.participant_id)
+        .join_from(models.TissueSample, dataset_table)
+        .join(
+            models.user_dataset_visibility_table,
+            dataset_table.c.dataset_id
+            == models.user_dataset_visibility_table.c.dataset_id,
+        )
+        .where(models.user_dataset_visibility_table.c.user_id == user.user_id)
+    )
+
+
 participants_blueprint = Blueprint(
     "participants",
     __name__,
@@ -83,9 +166,13 @@ def list_participants(page: int, limit: int) -> Response:
     if order_dir and order_dir not in ["desc", "asc"]:
         abort(400, description="order_dir must be either 'asc' or 'desc'")
 
-    if order:
-        if order_dir == "desc":
-            order = order.desc()
+    order_column = order if order is not None else models.Participant.participant_id
+
+    # participant_id breaks ties so that pages don't overlap
+    if order_dir == "desc":
+        order = (order_column.desc(), models.Participant.participant_id.desc())
+    else:
+        order = (order_column.asc(), models.Participant.participant_id.asc())
 
     filters = []
     family_codename = request.args.get("family_codename", type=str)
@@ -146,42 +233,68 @@ def list_participants(page: int, limit: int) -> Response:
 
     user = get_current_user()
 
-    if user.is_admin:
-        query = (
-            models.Participant.query.options(
-                joinedload(models.Participant.institution),
-                contains_eager(models.Participant.family),
-                joinedload(models.Participant.tissue_samples)
-                .joinedload(models.TissueSample.datasets)
-                .joinedload(models.Dataset.linked_files),
+    fields = get_fields(PARTICIPANT_COLUMNS + tuple(LIST_GETTERS))
+    csv_columns = [
+        "participant_codename",
+        "family_codename",
+        "participant_type",
+        "affected",
+        "solved",
+        "sex",
+        "notes",
+        "updated_by",
+        "created_by",
+    ]
+    columnar = expects_columnar(request)
+    export_csv = not expects_json(request) and (expects_csv(request) or columnar)
+    if export_csv:
+        # the export only loads the columns it writes
+        csv_columns = [column for column in csv_columns if wants(fields, column)]
+        fields = set(csv_columns)
+
+    query = models.Participant.query.join(models.Participant.family).filter(*filters)
+
+    # only load the relationships that the requested fields need
+    if wants(fields, *FAMILY_FIELDS):
+        # the family's users aren't part of the result
+        query = query.options(contains_eager(models.Participant.family).lazyload("*"))
+    if wants(fields, "institution"):
+        query = query.options(joinedload(models.Participant.institution))
+    if wants(fields, "updated_by"):
+        query = query.options(joinedload(models.Participant.updated_by))
+    if wants(fields, "created_by"):
+        query = query.options(joinedload(models.Participant.created_by))
+
+    if not wants(fields, "tissue_samples"):
+        if not user.is_admin:
+            query = query.filter(
+                models.Participant.participant_id.in_(visible_participant_ids(user))
             )
-            .join(models.Participant.family)
-            .filter(*filters)
+    elif user.is_admin:
+        query = query.options(
+            joinedload(models.Participant.tissue_samples)
+            .joinedload(models.TissueSample.datasets)
+            .joinedload(models.Dataset.linked_files)
         )
     else:
+        # only the tissue samples and datasets that the user can see are included
         query = (
-            models.Participant.query.options(
-                joinedload(models.Participant.institution),
-                contains_eager(models.Participant.family),
-                contains_eager(models.Participant.tissue_samples)
-                .contains_eager(models.TissueSample.datasets)
-                .contains_eager(models.Dataset.linked_files),
-            )
-            .join(models.Participant.family)
-            .outerjoin(models.Participant.tissue_samples)
+            query.outerjoin(models.Participant.tissue_samples)
             .outerjoin(models.TissueSample.datasets)
             .outerjoin(models.Dataset.linked_files)
             .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
+                models.user_dataset_visibility_table,
+                (
+                    models.Dataset.dataset_id
+                    == models.user_dataset_visibility_table.c.dataset_id
+                )
+                & (models.user_dataset_visibility_table.c.user_id == user.user_id),
             )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
+            .options(
+                contains_eager(models.Participant.tissue_samples)
+                .contains_eager(models.TissueSample.datasets)
+                .contains_eager(models.Dataset.linked_files)
             )
-            .filter(models.users_groups_table.columns.user_id == user.user_id, *filters)
         )
 
     dataset_type = request.args.get("dataset_types", type=str)
@@ -203,55 +316,43 @@ def list_participants(page: int, limit: int) -> Response:
     # mapped objects. In addition, .count() just wraps the main query in a subquery, so it can be
     # inefficient. Luckily, we can sidestep this whole problem efficiently by having the database
     # count the number of distinct parent primary keys returned. https://gist.github.com/hest/8798884
-    total_count = query.with_entities(
-        func.count(distinct(models.Participant.participant_id))
-    ).scalar()
-    participants = query.order_by(order).limit(limit).offset(page * (limit or 0)).all()
-    results = [
-        {
-            **asdict(participant),
-            "family_codename": participant.family.family_codename,
-            "family_aliases": participant.family.family_aliases,
-            "family_id": participant.family.family_id,
-            "institution": participant.institution.institution
-            if participant.institution
-            else None,
-            "updated_by": participant.updated_by.username,
-            "created_by": participant.created_by.username,
-            "tissue_samples": [
-                {
-                    **asdict(tissue_sample),
-                    "datasets": [
-                        {**asdict(d), "linked_files": d.linked_files}
-                        for d in tissue_sample.datasets
-                    ],
-                }
-                for tissue_sample in participant.tissue_samples
-            ],
-        }
-        for participant in participants
-    ]
+    total_count = get_total_count(query, models.Participant.participant_id, user)
+    if "cursor" in request.args:
+        participants, next_cursor = keyset_page(
+            query,
+            order_column,
+            models.Participant.participant_id,
+            order_dir == "desc",
+            limit,
+        )
+    elif export_csv:
+        # written out as the rows are read instead of being loaded upfront
+        participants = stream_query(
+            query.order_by(*order).limit(limit).offset(page * (limit or 0))
+        )
+    else:
+        participants = (
+            query.order_by(*order).limit(limit).offset(page * (limit or 0)).all()
+        )
+        next_cursor = False
+
+    results = (
+        sparse_dict(participant, LIST_GETTERS, fields) for participant in participants
+    )
 
     if expects_json(request):
-        return paginated_response(results, page, total_count, limit)
+        return paginated_response(list(results), page, total_count, limit, next_cursor)
     elif expects_csv(request):
-        return csv_response(
-            results,
-            "participants_report.csv",
-            [
-                "participant_codename",
-                "family_codename",
-                "participant_type",
-                "affected",
-                "solved",
-                "sex",
-                "notes",
-                "updated_by",
-                "created_by",
-            ],
+        return csv_response(results, "participants_report.csv", csv_columns)
+    elif columnar:
+        return columnar_records_response(
+            results, csv_columns, columnar, "participants_report"
         )
 
-    abort(406, "Only 'text/csv' and 'application/json' HTTP accept headers supported")
+    abort(
+        406,
+        f"Only 'text/csv', 'application/json', '{PARQUET_MIMETYPE}' and '{ARROW_MIMETYPE}' HTTP accept headers supported",
+    )
 
 
 @participants_blueprint.route("/api/participants/<int:id>", methods=["GET"])
@@ -260,14 +361,29 @@ def get_participant(id: int):
 
     user = get_current_user()
 
-    query = models.Participant.query.filter(
-        models.Participant.participant_id == id
-    ).options(
-        joinedload(models.Participant.family),
-        joinedload(models.Participant.institution),
-    )
+    fields = get_fields(PARTICIPANT_COLUMNS + tuple(DETAIL_GETTERS))
 
-    if not user.is_admin:
+    query = models.Participant.query.filter(models.Participant.participant_id == id)
+
+    # only load the relationships that the requested fields need
+    if wants(fields, "family_codename", "family_aliases"):
+        query = query.options(joinedload(models.Participant.family).lazyload("*"))
+    if wants(fields, "institution"):
+        query = query.options(joinedload(models.Participant.institution))
+
+    if not wants(fields, "tissue_samples"):
+        if not user.is_admin:
+            query = query.filter(
+                models.Participant.participant_id.in_(visible_participant_ids(user))
+            )
+    elif user.is_admin:
+        query = query.options(
+            selectinload(models.Participant.tissue_samples)
+            .selectinload(models.TissueSample.datasets)
+            .selectinload(models.Dataset.linked_files)
+        )
+    else:
+        # only the tissue samples and datasets that the user can see are included
         query = filter_datasets_by_user_groups(
             query.join(models.Participant.tissue_samples)
             .join(models.TissueSample.datasets)
@@ -284,35 +400,7 @@ def get_participant(id: int):
     if not participant:
         abort(404)
 
-    return jsonify(
-        {
-            **asdict(participant),
-            "family_codename": participant.family.family_codename,
-            "family_aliases": participant.family.family_aliases,
-            "institution": participant.institution.institution
-            if participant.institution
-            else None,
-            "updated_by": participant.updated_by.username,
-            "created_by": participant.created_by.username,
-            "tissue_samples": [
-                {
-                    **asdict(tissue_sample),
-                    "created_by": tissue_sample.created_by.username,
-                    "updated_by": tissue_sample.updated_by.username,
-                    "datasets": [
-                        {
-                            **asdict(d),
-                            "linked_files": d.linked_files,
-                            "created_by": d.created_by.username,
-                            "updated_by": d.updated_by.username,
-                        }
-                        for d in tissue_sample.datasets
-                    ],
-                }
-                for tissue_sample in participant.tissue_samples
-            ],
-        }
-    )
+    return json_response(sparse_dict(participant, DETAIL_GETTERS, fields))
 
 
 @participants_blueprint.route("/api/participants/<int:id>", methods=["DELETE"])
@@ -362,10 +450,10 @@ def update_participant(id: int):
 
     transaction_or_abort(db.session.commit)
 
-    return jsonify(
+    return json_response(
         [
             {
-                **asdict(participant),
+                **to_dict(participant),
                 "institution": participant.institution.institution
                 if participant.institution
                 else None,
@@ -448,9 +536,9 @@ def create_participant():
     location_header = "/api/participants/{}".format(ptp_objs.participant_id)
 
     return (
-        jsonify(
+        json_response(
             {
-                **asdict(ptp_objs),
+                **to_dict(ptp_objs),
                 "institution": ptp_objs.institution.institution
                 if ptp_objs.institution
                 else None,
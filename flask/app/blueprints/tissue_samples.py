@@ -1,12 +1,11 @@
-from dataclasses import asdict
-
-from flask import abort, jsonify, request, Blueprint, current_app as app
+from flask import abort, request, Blueprint, current_app as app
 from flask_login import current_user, login_required
 
 from .. import models
 from ..models import db
 from sqlalchemy.orm import contains_eager, joinedload
 from ..schemas import TissueSampleSchema
+from ..serializers import json_response, to_dict
 from ..utils import (
     check_admin,
     filter_datasets_by_user_groups,
@@ -62,16 +61,13 @@ def get_tissue_sample(id: int):
             )
             .join(models.Dataset)
             .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
+                models.user_dataset_visibility_table,
+                (
+                    models.Dataset.dataset_id
+                    == models.user_dataset_visibility_table.c.dataset_id
+                )
+                & (models.user_dataset_visibility_table.c.user_id == user.user_id),
             )
-            .filter(models.users_groups_table.columns.user_id == user.user_id)
             .one_or_none()
         )
 
@@ -80,14 +76,14 @@ def get_tissue_sample(id: int):
         abort(404)
 
     app.logger.info("Query successful returning JSON..")
-    return jsonify(
+    return json_response(
         {
-            **asdict(tissue_sample),
+            **to_dict(tissue_sample),
             "created_by": tissue_sample.created_by.username,
             "updated_by": tissue_sample.updated_by.username,
             "datasets": [
                 {
-                    **asdict(dataset),
+                    **to_dict(dataset),
                 }
                 for dataset in tissue_sample.datasets
             ],
@@ -175,9 +171,9 @@ def create_tissue_sample():
         location_header = "/api/tissue_samples/{}".format(ts_id)
         app.logger.debug("Entry successfully created, returning JSON")
         return (
-            jsonify(
+            json_response(
                 {
-                    **asdict(tissue_sample),
+                    **to_dict(tissue_sample),
                     "created_by": tissue_sample.created_by.username,
                     "updated_by": tissue_sample.updated_by.username,
                 }
@@ -220,9 +216,9 @@ def update_tissue_sample(id: int):
     app.logger.debug("Commiting edit to tissue sample in the database..")
     transaction_or_abort(db.session.commit)
     app.logger.debug("Edit successful, returning json..")
-    return jsonify(
+    return json_response(
         {
-            **asdict(tissue_sample),
+            **to_dict(tissue_sample),
             "created_by": tissue_sample.created_by.username,
             "updated_by": tissue_sample.updated_by.username,
         }
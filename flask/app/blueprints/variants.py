@@ -1,20 +1,48 @@
-from dataclasses import asdict
+from datetime import timedelta
 import re
-
-from flask import Blueprint, Response, abort, current_app as app, jsonify, request
+from typing import Any, Iterator, List, Mapping, Optional, Tuple
+
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app as app,
+    request,
+    stream_with_context,
+    url_for,
+)
 from flask_login import login_required
 import pandas as pd
-from sqlalchemy import distinct, func
+from sqlalchemy import distinct, func, select
 from sqlalchemy.orm import aliased, contains_eager
-from sqlalchemy.sql import and_, or_
+from sqlalchemy.sql import and_, or_, true
 
 from .. import models
+from ..aggregation import FIRST, LIST, UNIQUE, as_strings, collapse
+from ..binning import BIN_MAX_END, overlapping_bins
+from ..columnar import (
+    ARROW_MIMETYPE,
+    EXTENSIONS,
+    PARQUET_MIMETYPE,
+    columnar_response,
+    expects_columnar,
+    frame_to_table,
+    pa,
+    table_to_bytes,
+)
 from ..models import db
+from ..report_cache import cache_report, get_cached_report
+from ..serializers import dumps, json_response, to_dict
 from ..utils import (
     expects_csv,
     expects_json,
+    expects_ndjson,
     filter_datasets_by_user_groups,
     get_current_user,
+    get_minio_client,
+    str_to_bool,
+    transaction_or_abort,
+    validate_json,
 )
 
 
@@ -23,6 +51,15 @@ variants_blueprint = Blueprint(
     __name__,
 )
 
+SEARCH_TYPES = ["genes", "positions", "regions", "rsids"]
+REPORT_TYPES = ["variants", "participants"]
+# the formats that POST /api/summary/jobs can write reports in, and their mimetypes
+REPORT_JOB_FORMATS = {
+    "csv": "text/csv",
+    "parquet": PARQUET_MIMETYPE,
+    "arrow": ARROW_MIMETYPE,
+}
+
 relevant_cols = [
     "ensembl_id",
     "name",
@@ -81,114 +118,187 @@ relevant_cols = [
 ]
 
 
-def get_report_df(df: pd.DataFrame, type: str, relevant_cols=relevant_cols):
+# the variant-wise report has one row per variant, identified by
+VARIANT_KEYS = ["position", "reference_allele", "alt_allele"]
+# and collapses the other columns of its genotypes like so, where multiple values are delimited by a ';'
+VARIANT_AGGREGATIONS = {
+    "ensembl_id": UNIQUE,
+    "chromosome": FIRST,
+    "ucsc_link": FIRST,
+    "gnomad_link": FIRST,
+    "clinvar": FIRST,
+    "gnomad_af_popmax": FIRST,
+    "gnomad_ac": FIRST,
+    "gnomad_hom": FIRST,
+    "report_ensembl_gene_id": UNIQUE,
+    "ensembl_transcript_id": UNIQUE,
+    "aa_position": FIRST,
+    "exon": FIRST,
+    "protein_domains": FIRST,
+    "rsids": UNIQUE,
+    "gnomad_oe_lof_score": FIRST,
+    "gnomad_oe_mis_score": FIRST,
+    "exac_pli_score": FIRST,
+    "exac_prec_score": FIRST,
+    "exac_pnull_score": FIRST,
+    "spliceai_impact": FIRST,
+    "spliceai_score": FIRST,
+    "vest3_score": FIRST,
+    "revel_score": FIRST,
+    "gerp_score": FIRST,
+    "imprinting_status": FIRST,
+    "imprinting_expressed_allele": FIRST,
+    "pseudoautosomal": FIRST,
+    # "number_of_callers"
+    # "old_multiallelic": LIST,
+    "uce_100bp": FIRST,
+    "uce_200bp": FIRST,
+    "genotype": LIST,
+    "coverage": LIST,
+    "info": LIST,
+    "quality": LIST,
+    "gene": LIST,
+    "variation": FIRST,
+    "refseq_change": FIRST,
+    "depth": LIST,
+    "conserved_in_20_mammals": FIRST,
+    "sift_score": FIRST,
+    "polyphen_score": FIRST,
+    "cadd_score": FIRST,
+    "gnomad_af": FIRST,
+    "zygosity": LIST,
+    "burden": LIST,
+    "alt_depths": LIST,
+    "dataset_id": LIST,
+    "participant_codename": LIST,
+    "family_codename": UNIQUE,
+    "name": FIRST,
+}
+
+
+def clean_report_df(
+    df: pd.DataFrame, relevant_cols=relevant_cols, defer=()
+) -> pd.DataFrame:
     """
-    The expected input is a de-normalized ('tidy') dataframe returned by pd.read_sql. This function subsets relevant columns and retains variants with sufficient depth to annotate zygosity.
-    It then returns a sample (participant)  wise dataframe, where each row is a participant's variant, the variant annotations, and their genotype,
-    or aggregates by variant, where each row is identified by a unique variant and various fields such as depth, zygosity and codenames are concatenated into a single list, delimited by a ';'.
+    Subsets relevant columns of a de-normalized dataframe returned by pd.read_sql and retains variants with sufficient depth to annotate zygosity.
+    Every step is row-wise, so this can be applied to each chunk of a streamed query result independently.
+    Columns in defer may be left to be converted to strings by the caller, see aggregation.as_strings.
     """
+    # subsetting by a list of col names ensures ordering is consistent between the two report types
 
-    app.logger.debug(df.head(3))
+    # some columns are duplicated eg. dataset_id, is there a way to query so that this doesn't happen?
+    # the first of each is kept, and the rows and columns are taken at once rather than copying the frame twice
+    positions = {}
+    for position, column in enumerate(df.columns):
+        positions.setdefault(column, position)
+    sufficient = ~df.iloc[:, positions["zygosity"]].str.contains("-|Insufficient")
+    df = df.iloc[sufficient.to_numpy(), [positions[column] for column in relevant_cols]]
+    df = as_strings(df, defer)
+    df["ensembl_id"] = "ENSG" + df["ensembl_id"].str.rjust(11, "0")
+    return df
+
+
+def get_report_columns(columns: str, valid_columns: List[str]) -> List[str]:
+    """
+    Parses the query string parameter ?columns=a,b,c against the columns available in a report.
+    Invalid columns are ignored and the order set by relevant_cols is maintained.
+    """
+    if columns is None:
+        return [col for col in relevant_cols if col in valid_columns]
+    columns = {*columns.split(",")}
+    # filter out faulty columns
+    fixed_columns = [
+        col for col in relevant_cols if col in valid_columns and col in columns
+    ]
+    if len(fixed_columns) < len(columns):
+        app.logger.warn(
+            "Ignoring invalid columns from request: {}".format(
+                columns ^ set(fixed_columns)
+            )
+        )
+    return fixed_columns
 
-    # subsetting by a list of col names ensures ordering is consistent between the two report types
 
-    df = df.loc[:, ~df.columns.duplicated()]
-    df = df[relevant_cols]
+def stream_participant_report(query, format: str, columns: List[str]) -> Iterator[str]:
+    """
+    Yields the participant-wise report in chunks of REPORT_CHUNK_SIZE rows, as either csv or newline-delimited json.
 
-    # some columns are duplicated eg. dataset_id, is there a way to query so that this doesn't happen?
+    The query is executed on a separate connection with a server-side cursor, so that the database driver
+    does not buffer the entire result set, and each chunk is written out before the next one is fetched.
+    Peak memory is therefore bounded by the chunk size rather than by the number of matching rows.
+
+    The csv chunks are cleaned the same way as the participant-wise csv report, whereas the json lines match
+    the records of the participant-wise json report.
+    """
+    chunksize = app.config["REPORT_CHUNK_SIZE"]
+    header = True
+    with db.engine.connect().execution_options(stream_results=True) as connection:
+        for chunk in pd.read_sql(query.statement, connection, chunksize=chunksize):
+            if format == "csv":
+                chunk = clean_report_df(chunk)
+                yield chunk.loc[:, columns].to_csv(
+                    encoding="utf-8", index=False, header=header
+                )
+                header = False
+            else:
+                chunk = chunk.loc[:, ~chunk.columns.duplicated()][relevant_cols]
+                lines = chunk.to_json(orient="records", lines=True, date_format="iso")
+                yield lines if lines.endswith("\n") else lines + "\n"
+    # no rows were visible to the user, but the csv should still have a header
+    if format == "csv" and header:
+        yield pd.DataFrame(columns=columns).to_csv(index=False)
+
+
+def get_report_df(
+    df: pd.DataFrame, type: str, relevant_cols=relevant_cols, typed: bool = False
+):
+    """
+    The expected input is a de-normalized ('tidy') dataframe returned by pd.read_sql. This function subsets relevant columns and retains variants with sufficient depth to annotate zygosity.
+    It then returns a sample (participant)  wise dataframe, where each row is a participant's variant, the variant annotations, and their genotype,
+    or aggregates by variant, where each row is identified by a unique variant and various fields such as depth, zygosity and codenames are concatenated into a single list, delimited by a ';'.
+    Every column is converted to strings as for the csv, unless typed, in which case only the ensembl_id and the ';' delimited columns are.
+    """
 
-    df = df[~df["zygosity"].str.contains("-|Insufficient")]
-    df = df.fillna("")
-    df = df.astype(str)
-    df["ensembl_id"] = df["ensembl_id"].apply(lambda x: "ENSG" + x.rjust(11, "0"))
+    app.logger.debug(df.head(3))
 
     if type == "participants":
-        return df
+        if typed:
+            return clean_report_df(
+                df, relevant_cols, defer=[c for c in relevant_cols if c != "ensembl_id"]
+            )
+        return clean_report_df(df, relevant_cols)
 
     elif type == "variants":
-        df = (
-            df.groupby(["position", "reference_allele", "alt_allele"])
-            .agg(
-                {
-                    "ensembl_id": set,
-                    "chromosome": "first",
-                    "ucsc_link": "first",
-                    "gnomad_link": "first",
-                    "clinvar": "first",
-                    "gnomad_af_popmax": "first",
-                    "gnomad_ac": "first",
-                    "gnomad_hom": "first",
-                    "report_ensembl_gene_id": set,
-                    "ensembl_transcript_id": set,
-                    "aa_position": "first",
-                    "exon": "first",
-                    "protein_domains": "first",
-                    "rsids": set,
-                    "gnomad_oe_lof_score": "first",
-                    "gnomad_oe_mis_score": "first",
-                    "exac_pli_score": "first",
-                    "exac_prec_score": "first",
-                    "exac_pnull_score": "first",
-                    "spliceai_impact": "first",
-                    "spliceai_score": "first",
-                    "vest3_score": "first",
-                    "revel_score": "first",
-                    "gerp_score": "first",
-                    "imprinting_status": "first",
-                    "imprinting_expressed_allele": "first",
-                    "pseudoautosomal": "first",
-                    # "number_of_callers"
-                    # "old_multiallelic": list,
-                    "uce_100bp": "first",
-                    "uce_200bp": "first",
-                    "genotype": list,
-                    "coverage": list,
-                    "info": list,
-                    "quality": list,
-                    "gene": list,
-                    "variation": "first",
-                    "refseq_change": "first",
-                    "depth": list,
-                    "conserved_in_20_mammals": "first",
-                    "sift_score": "first",
-                    "polyphen_score": "first",
-                    "cadd_score": "first",
-                    "gnomad_af": "first",
-                    "zygosity": list,
-                    "burden": list,
-                    "alt_depths": list,
-                    "dataset_id": list,
-                    "participant_codename": list,
-                    "family_codename": set,
-                    "name": "first",
-                },
-                axis="columns",
-            )
-            .reset_index()
-        )
-        df = df[relevant_cols]
-
-        df["frequency"] = df["participant_codename"].str.len()
-        for col in [
-            "ensembl_id",
-            "zygosity",
-            "burden",
-            "alt_depths",
-            "depth",
-            "genotype",
-            "coverage",
-            "info",
-            "quality",
-            "gene",
-            "rsids",
-            "report_ensembl_gene_id",
-            "ensembl_transcript_id",
-            "participant_codename",
-            "family_codename",
-            "dataset_id",
-        ]:
-            df[col] = df[col].apply(lambda g: "; ".join(g))
-        return df
+        # only the first value of most columns is kept, so only those are converted to strings
+        first = [
+            column
+            for column, aggregation in VARIANT_AGGREGATIONS.items()
+            if aggregation == FIRST
+        ]
+        if typed:
+            first += VARIANT_KEYS
+        df = clean_report_df(df, relevant_cols, defer=first)
+        df = collapse(df, VARIANT_KEYS, VARIANT_AGGREGATIONS, size="frequency")
+        if typed:
+            return df[[*relevant_cols, "frequency"]]
+        report = as_strings(df[relevant_cols])
+        report["frequency"] = df["frequency"]
+        return report
+
+
+def report_response(data: bytes, format: str, type: str) -> Response:
+    """The response of a report rendered as json, csv or a columnar format, whether it was just built or cached"""
+    if format == "json":
+        return Response(data, mimetype="application/json")
+    if format in EXTENSIONS:
+        return columnar_response(data, format, "{}_wise_report".format(type[:-1]))
+    response = Response(data, mimetype="text/csv")
+    response.headers.set(
+        "Content-Disposition",
+        "attachment",
+        filename="{}_wise_report.csv".format(type[:-1]),
+    )
+    return response
 
 
 def parse_gene_panel(genes: str):
@@ -196,8 +306,8 @@ def parse_gene_panel(genes: str):
     Parses query string parameter ?panel=ENSGXXXXXXXX,ENSGXXXXXXX.
     We abort if the panel parameter is missing or malformed. If any specified gene isn't
     in our database, we also abort.
-    Returns a list of filters for use against the variant table to find corresponding variants
-    based on gene start and end positions.
+    Returns a filter for use against the variant_gene table to find corresponding variants
+    based on their precomputed gene overlaps.
     """
     genes_list = genes.lower().split(",")
     app.logger.info("Requested gene panel: %s", genes_list)
@@ -235,7 +345,27 @@ def parse_gene_panel(genes: str):
 
     app.logger.debug("Found %d genes with panel %s", found_genes, ensgs)
 
-    return gene_filter
+    return models.variant_gene_table.c.ensembl_id.in_(ensgs)
+
+
+# Regions overlapping more bins than this are filtered by position only, as listing
+# every bin of eg. a whole chromosome doesn't narrow the index range any further
+MAX_FILTER_BINS = 256
+
+
+def variant_bin_filter(start: int, end: int):
+    """
+    Returns a filter restricting variants to the bins that may overlap the 1-based inclusive
+    interval [start, end], so that the (chromosome, bin, position) index can be used for range
+    scans. This is only an index hint and must be combined with the exact position predicate.
+    """
+    start, end = max(start, 1), min(end, BIN_MAX_END)
+    if start > end:
+        return true()
+    bins = overlapping_bins(start, end)
+    if len(bins) > MAX_FILTER_BINS:
+        return true()
+    return models.Variant.bin.in_(bins)
 
 
 def parse_region(region: str):
@@ -270,6 +400,7 @@ def parse_region(region: str):
         *[
             and_(
                 models.Variant.chromosome == tup[CHR],
+                variant_bin_filter(int(tup[START]), int(tup[END])),
                 int(tup[START]) <= models.Variant.position,
                 models.Variant.position <= int(tup[END]),
             )
@@ -306,6 +437,7 @@ def parse_position(position: str):
         *[
             and_(
                 models.Variant.chromosome == tup[CHR].upper(),
+                variant_bin_filter(int(tup[POS]), int(tup[POS])),
                 models.Variant.position == tup[POS],
             )
             for tup in position_set
@@ -316,6 +448,11 @@ def parse_position(position: str):
 
 
 def parse_rsid(rsid: str):
+    """
+    Parses a given list of rsIDs (eg. "rs123,rs4567").
+    Returns a filter for use against the variant table to find variants with exactly these rsIDs,
+    looked up through the normalized variant_rsid table.
+    """
     rsid_pattern = re.compile(r"^rs[\d]+$")
     matches = [rsid_pattern.match(p) for p in rsid.split(",")]
 
@@ -323,9 +460,13 @@ def parse_rsid(rsid: str):
         app.logger.error("Invalid rsID format: %s", rsid)
         abort(400, description="Invalid rsID format")
 
-    rsid_set = set(["%{}%".format(match.group()) for match in matches])
+    rsid_set = set([match.group() for match in matches])
 
-    rsid_filter = or_(*[models.Variant.rsids.like(r) for r in rsid_set])
+    rsid_filter = models.Variant.variant_id.in_(
+        select(models.variant_rsid_table.c.variant_id).where(
+            models.variant_rsid_table.c.rsid.in_(rsid_set)
+        )
+    )
 
     return rsid_filter
 
@@ -345,55 +486,43 @@ def parse_requested_filter(search_type: str, param: str):
     abort(400, description="Invalid parameter")
 
 
-@variants_blueprint.route("/api/summary/<string:type>", methods=["GET"])
-@login_required
-def summary(type: str):
+def get_requested_search(params: Mapping[str, Any]) -> Tuple[str, str]:
     """
-    GET /api/summary/participants?genes=ENSG00000138131
-    GET /api/summary/participants?positions=chr1:5000,chr2:6000
-    GET /api/summary/participants?regions=chr1:5000-6000,chrX:5000-6000
-
-    The same sqlalchemy query is used for both endpoints as the participant-wise report is the precursor to the variant-wise report.
-
-    The JSON response for participants is de-normalized such that each object is a participant and a variant,
-    whereas for the variant JSON response, each object is a variant, the annotations, and an array of genotypes for the involved participants.
-
-    Similarly, the csv output for the participants is de-normalized such that each row is a participant's variant. If the requested genes span similar coordinates duplicated variants will be returned, for each gene.
-    The variant csv output is a summary - each row is a unique variant with various columns collapsed and ';' delimited indicating for example, all participants that had such a variant.
-
+    The search type of a summary report and its comma-separated values, from the query string or a JSON body.
+    We abort unless exactly one search type is requested.
     """
-    # validate parameters such that only one search type is requested
-    valid_search_types = {"genes", "positions", "regions", "rsids"}
-    requested_types = list(
-        filter(lambda type: request.args.get(type) is not None, valid_search_types)
-    )
+    requested_types = [
+        search_type
+        for search_type in SEARCH_TYPES
+        if params.get(search_type) is not None
+    ]
     if len(requested_types) > 1:
         app.logger.error("Too many search types requested: %s", str(requested_types))
         abort(400, description="Too many search types requested")
     if len(requested_types) == 0:
         app.logger.error("No search types requested")
         abort(400, description="No search types requested")
-
     search_type = requested_types[0]
+    if not isinstance(params[search_type], str):
+        abort(400, description=f"{search_type} must be a comma-separated string")
+    return search_type, params[search_type]
 
-    if type not in ["variants", "participants"]:
-        abort(404)
-
-    user = get_current_user()
-
-    variant_filter = parse_requested_filter(
-        search_type, request.args.get(search_type, type=str)
-    )
 
+def get_summary_query(variant_filter, user: models.User):
+    """
+    The genes, variants and genotypes, with their datasets, participants and families, of a summary report.
+    Only the datasets visible to the user are included, and we abort if no variants match the filter.
+    """
+    # variants are matched to the genes they overlap through the precomputed variant_gene table
     query = (
         db.session.query(models.Variant, models.Gene)
         .join(
-            models.Variant,
-            and_(
-                models.Gene.chromosome == models.Variant.chromosome,
-                models.Gene.start <= models.Variant.position,
-                models.Variant.position <= models.Gene.end,
-            ),
+            models.variant_gene_table,
+            models.variant_gene_table.c.variant_id == models.Variant.variant_id,
+        )
+        .join(
+            models.Gene,
+            models.Gene.ensembl_id == models.variant_gene_table.c.ensembl_id,
         )
         .filter(variant_filter)
     )
@@ -418,6 +547,9 @@ def summary(type: str):
     query = (
         db.session.query(models.Gene, models.Variant)
         .options(
+            contains_eager(models.Variant.genotype).contains_eager(
+                models.Genotype.call
+            ),
             contains_eager(models.Variant.genotype)
             .contains_eager(models.Genotype.analysis)
             .contains_eager(models.Analysis.datasets)
@@ -426,15 +558,17 @@ def summary(type: str):
             .contains_eager(models.Participant.family),
             contains_eager(models.Gene.aliases.of_type(alias_subquery)),
         )
+        .join(
+            models.variant_gene_table,
+            models.variant_gene_table.c.ensembl_id == models.Gene.ensembl_id,
+        )
         .join(
             models.Variant,
-            and_(
-                models.Gene.chromosome == models.Variant.chromosome,
-                models.Gene.start <= models.Variant.position,
-                models.Variant.position <= models.Gene.end,
-            ),
+            models.Variant.variant_id == models.variant_gene_table.c.variant_id,
         )
         .join(models.Variant.genotype)
+        # the depth and quality of the variant in the genotype's analysis
+        .join(models.Genotype.call)
         .join(models.Genotype.analysis, models.Genotype.dataset)
         .join(models.Dataset.tissue_sample)
         .join(models.TissueSample.participant)
@@ -446,6 +580,118 @@ def summary(type: str):
     if not user.is_admin:
         query = filter_datasets_by_user_groups(query, user)
 
+    return query
+
+
+def get_report_frame(
+    query, type: str, columns: Optional[str] = None, typed: bool = False
+) -> pd.DataFrame:
+    """A participant-wise or variant-wise report, with only the given ?columns=a,b,c if any"""
+    try:
+        sql_df = pd.read_sql(query.statement, query.session.bind)
+    except:
+        app.logger.error(
+            "Unexpected error resulting from sqlalchemy query", exc_info=True
+        )
+        abort(500, "Unexpected error")
+
+    agg_df = get_report_df(sql_df, type=type, typed=typed)
+
+    if columns is not None:
+        agg_df = agg_df.loc[:, get_report_columns(columns, list(agg_df.columns.values))]
+
+    return agg_df
+
+
+def get_csv_report(query, type: str, columns: Optional[str] = None) -> bytes:
+    return (
+        get_report_frame(query, type, columns)
+        .to_csv(encoding="utf-8", index=False)
+        .encode()
+    )
+
+
+def get_report_bytes(
+    query, type: str, mimetype: str, columns: Optional[str] = None
+) -> bytes:
+    """A report as a csv, or as parquet or an Arrow IPC stream where the columns keep their types"""
+    if mimetype == "text/csv":
+        return get_csv_report(query, type, columns)
+    df = get_report_frame(query, type, columns, typed=True)
+    return table_to_bytes(frame_to_table(df), mimetype)
+
+
+@variants_blueprint.route("/api/summary/<string:type>", methods=["GET"])
+@login_required
+def summary(type: str):
+    """
+    GET /api/summary/participants?genes=ENSG00000138131
+    GET /api/summary/participants?positions=chr1:5000,chr2:6000
+    GET /api/summary/participants?regions=chr1:5000-6000,chrX:5000-6000
+    GET /api/summary/participants?genes=ENSG00000138131&stream=true
+
+    The same sqlalchemy query is used for both endpoints as the participant-wise report is the precursor to the variant-wise report.
+
+    The JSON response for participants is de-normalized such that each object is a participant and a variant,
+    whereas for the variant JSON response, each object is a variant, the annotations, and an array of genotypes for the involved participants.
+
+    Similarly, the csv output for the participants is de-normalized such that each row is a participant's variant. If the requested genes span similar coordinates duplicated variants will be returned, for each gene.
+    The variant csv output is a summary - each row is a unique variant with various columns collapsed and ';' delimited indicating for example, all participants that had such a variant.
+
+    The participant-wise report can also be streamed, since it does not need to be aggregated. Requesting 'application/x-ndjson'
+    streams one json object per line, and ?stream=true streams the csv output. Either way, rows are fetched from the database
+    in fixed-size chunks through a server-side cursor and written out as a chunked response.
+
+    Either report can also be downloaded as parquet or an Arrow IPC stream, by requesting 'application/vnd.apache.parquet'
+    or 'application/vnd.apache.arrow.stream', where the columns keep their types instead of being formatted as strings.
+
+    """
+    search_type, search_values = get_requested_search(request.args)
+
+    if type not in REPORT_TYPES:
+        abort(404)
+
+    user = get_current_user()
+
+    variant_filter = parse_requested_filter(search_type, search_values)
+
+    stream = request.args.get("stream", type=str_to_bool, default=False)
+    columnar = expects_columnar(request)
+
+    # reports that are built in full rather than streamed are cached, see report_cache.py
+    cache_name = None
+    if expects_json(request):
+        report_format = "json"
+    elif type == "participants" and (
+        expects_ndjson(request) or (stream and expects_csv(request))
+    ):
+        report_format = None
+    elif expects_csv(request):
+        report_format = "csv"
+    else:
+        report_format = columnar
+    if report_format:
+        columns = request.args.get("columns", type=str)
+        cache_name, cached = get_cached_report(
+            (
+                search_type,
+                sorted({value.strip() for value in search_values.split(",")}),
+                type,
+                report_format,
+                None
+                if report_format == "json" or columns is None
+                else get_report_columns(columns, [*relevant_cols, "frequency"]),
+                "admin"
+                if user.is_admin
+                else sorted(group.group_id for group in user.groups),
+            )
+        )
+        if cached is not None:
+            app.logger.info("Returning cached %s report", report_format)
+            return report_response(cached, report_format, type)
+
+    query = get_summary_query(variant_filter, user)
+
     # defaults to json unless otherwise specified
     app.logger.info(request.accept_mimetypes)
 
@@ -454,15 +700,16 @@ def summary(type: str):
 
         if type == "variants":
 
-            return jsonify(
+            body = dumps(
                 [
                     {
-                        **asdict(tup[0]),  # gene
+                        **to_dict(tup[0]),  # gene
                         "name": tup[0].aliases[0].name if tup[0].aliases else None,
-                        **asdict(tup[1]),  # variants
+                        **to_dict(tup[1]),  # variants
                         "genotype": [
                             {
-                                **asdict(genotype),
+                                **to_dict(genotype),
+                                **to_dict(genotype.call),
                                 "participant_codename": genotype.dataset.tissue_sample.participant.participant_codename,
                             }
                             for genotype in tup[1].genotype
@@ -471,6 +718,8 @@ def summary(type: str):
                     for tup in query.all()
                 ]
             )
+            cache_report(cache_name, body)
+            return report_response(body, "json", type)
 
         elif type == "participants":
             try:
@@ -484,50 +733,142 @@ def summary(type: str):
             ptp_dict = sql_df.loc[:, ~sql_df.columns.duplicated()][
                 relevant_cols
             ].to_dict(orient="records")
-            return jsonify(ptp_dict)
+            body = dumps(ptp_dict)
+            cache_report(cache_name, body)
+            return report_response(body, "json", type)
+
+    elif expects_ndjson(request) and type == "participants":
+        app.logger.info("application/x-ndjson Accept header requested")
+        return Response(
+            stream_with_context(
+                stream_participant_report(query, "ndjson", relevant_cols)
+            ),
+            mimetype="application/x-ndjson",
+        )
 
     elif expects_csv(request):
         app.logger.info("text/csv Accept header requested")
-        try:
-            sql_df = pd.read_sql(query.statement, query.session.bind)
-        except:
-            app.logger.error(
-                "Unexpected error resulting from sqlalchemy query", exc_info=True
+
+        if type == "participants" and stream:
+            columns = get_report_columns(
+                request.args.get("columns", type=str), relevant_cols
+            )
+            response = Response(
+                stream_with_context(stream_participant_report(query, "csv", columns)),
+                mimetype="text/csv",
+            )
+            response.headers.set(
+                "Content-Disposition",
+                "attachment",
+                filename="participant_wise_report.csv",
             )
-            abort(500, "Unexpected error")
+            return response
 
-        agg_df = get_report_df(sql_df, type=type)
+        csv_data = get_csv_report(query, type, request.args.get("columns", type=str))
+        cache_report(cache_name, csv_data)
+        return report_response(csv_data, "csv", type)
 
-        columns = request.args.get("columns", type=str)
-        if columns is not None:
-            columns = {*columns.split(",")}
-            # filter out faulty columns
-            valid_columns = {col for col in agg_df.columns.values}
-            # maintain the order set by relevant_cols
-            fixed_columns = [
-                col for col in relevant_cols if col in valid_columns and col in columns
-            ]
-            if len(fixed_columns) < len(columns):
-                app.logger.warn(
-                    "Ignoring invalid columns from request: {}".format(
-                        columns ^ set(fixed_columns)
-                    )
-                )
-            agg_df = agg_df.loc[:, fixed_columns]
+    elif columnar:
+        app.logger.info("%s Accept header requested", columnar)
+        data = get_report_bytes(
+            query, type, columnar, request.args.get("columns", type=str)
+        )
+        cache_report(cache_name, data)
+        return report_response(data, columnar, type)
+    else:
+        message = f"Only 'text/csv', 'application/json', '{PARQUET_MIMETYPE}' and '{ARROW_MIMETYPE}' HTTP accept headers supported"
+        app.logger.error(message)
+        abort(406, message)
 
-        csv_data = agg_df.to_csv(encoding="utf-8", index=False)
 
-        response = Response(csv_data, mimetype="text/csv")
-        response.headers.set(
-            "Content-Disposition",
-            "attachment",
-            filename="{}_wise_report.csv".format(type[:-1]),
-        )
-        return response
+@variants_blueprint.route("/api/summary/jobs", methods=["POST"])
+@login_required
+@validate_json
+def create_summary_job():
+    """
+    POST /api/summary/jobs
+    {"type": "variants", "genes": "ENSG00000138131,ENSG00000258366", "columns": "ensembl_id,position", "group": "code"}
+
+    Queues a report that would take too long to build within a request, with the same parameters as
+    GET /api/summary/<type>. It is built in the background as the requesting user, and written to the
+    results-<group> bucket of one of their groups, which can be omitted if they belong to only one.
+    It is a csv unless "format" is "parquet" or "arrow".
+    Poll GET /api/summary/jobs/<id>, given by the Location header, for its status and a download link.
+    """
+    params = request.get_json()
+    if not isinstance(params, dict):
+        abort(400, description="Expected a JSON object")
+    type = params.get("type")
+    if type not in REPORT_TYPES:
+        abort(400, description=f"type must be one of {', '.join(REPORT_TYPES)}")
+    search_type, search_values = get_requested_search(params)
+    # invalid searches are rejected now rather than when the job runs
+    parse_requested_filter(search_type, search_values)
+    columns = params.get("columns")
+    if columns is not None and not isinstance(columns, str):
+        abort(400, description="columns must be a comma-separated string")
+    format = params.get("format", "csv")
+    if format not in REPORT_JOB_FORMATS:
+        abort(400, description=f"format must be one of {', '.join(REPORT_JOB_FORMATS)}")
+    if format != "csv" and pa is None:
+        abort(400, description=f"{format} reports are not supported by this server")
+
+    user = get_current_user()
+    group_code = params.get("group")
+    if group_code is not None:
+        group = models.Group.query.filter(models.Group.group_code == group_code).first()
+        if group is None:
+            abort(404, description="Invalid group code provided")
+        if not user.is_admin and group not in user.groups:
+            abort(403, description="User does not belong to the provided group")
+    elif len(user.groups) == 1:
+        group = user.groups[0]
     else:
-        app.logger.error(
-            "Only 'text/csv' and 'application/json' HTTP accept headers supported"
-        )
         abort(
-            406, "Only 'text/csv' and 'application/json' HTTP accept headers supported"
+            400,
+            description="User does not belong to exactly one group, so a group must be specified",
+        )
+
+    job = models.SummaryReportJob(
+        status=models.SummaryReportStatus.Queued,
+        type=type,
+        search_type=search_type,
+        search=search_values,
+        columns=columns,
+        format=format,
+        group_id=group.group_id,
+        created_by_id=user.user_id,
+    )
+    db.session.add(job)
+    transaction_or_abort(db.session.commit)
+    location = url_for("variants.get_summary_job", job_id=job.summary_report_job_id)
+    return (
+        json_response(
+            {"summary_report_job_id": job.summary_report_job_id, "status": job.status}
+        ),
+        202,
+        {"location": location},
+    )
+
+
+@variants_blueprint.route("/api/summary/jobs/<int:job_id>", methods=["GET"])
+@login_required
+def get_summary_job(job_id: int):
+    """
+    Status of a report queued with POST /api/summary/jobs, which is visible to its requester and admins.
+    Once it is done, url is a presigned link to download the report from MinIO for REPORT_JOB_URL_SECONDS.
+    """
+    user = get_current_user()
+    job = models.SummaryReportJob.query.filter(
+        models.SummaryReportJob.summary_report_job_id == job_id
+    ).first_or_404()
+    if job.created_by_id != user.user_id and not user.is_admin:
+        abort(404)
+    url = None
+    if job.status == models.SummaryReportStatus.Done:
+        url = get_minio_client().presigned_get_object(
+            f"results-{job.group.group_code}",
+            job.object_name,
+            expires=timedelta(seconds=app.config["REPORT_JOB_URL_SECONDS"]),
         )
+    return json_response({**to_dict(job), "url": url})
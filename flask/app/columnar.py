@@ -0,0 +1,209 @@
+"""
+Parquet and Arrow IPC responses for the reports and list exports
+
+A csv turns every value into text that clients have to parse back, and the variant scores lose their types on the
+way. With an Accept header of application/vnd.apache.parquet or application/vnd.apache.arrow.stream, the same rows
+are instead written out as a typed Arrow table, whose string columns are dictionary-encoded since most of them repeat
+a handful of values, e.g. codenames, zygosity and dataset types. The list exports are written out a batch of
+REPORT_CHUNK_SIZE rows at a time as the rows are read, like their csv counterparts.
+
+pyarrow is only needed for these formats, which are not acceptable if it isn't installed.
+"""
+
+from dataclasses import is_dataclass
+from enum import Enum
+from io import RawIOBase
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from flask import Request, Response, current_app as app, stream_with_context
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from .serializers import to_dict
+
+PARQUET_MIMETYPE = "application/vnd.apache.parquet"
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+EXTENSIONS = {PARQUET_MIMETYPE: "parquet", ARROW_MIMETYPE: "arrow"}
+
+
+def expects_columnar(req: Request) -> Optional[str]:
+    """The columnar mimetype that a request accepts, if any"""
+    if pa is None:
+        return None
+    for mimetype in EXTENSIONS:
+        if mimetype in req.accept_mimetypes:
+            return mimetype
+    return None
+
+
+def dictionary_encode(table: "pa.Table") -> "pa.Table":
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type):
+            table = table.set_column(i, field.name, table.column(i).dictionary_encode())
+    return table
+
+
+def frame_to_table(df: pd.DataFrame) -> "pa.Table":
+    return dictionary_encode(pa.Table.from_pandas(df, preserve_index=False))
+
+
+def _plain(value: Any) -> Any:
+    """the value of a mapping from sparse_dict as the nested lists and dicts that pyarrow can infer a type for"""
+    if isinstance(value, Enum):
+        return value.value
+    if is_dataclass(value):
+        return {key: _plain(item) for key, item in to_dict(value).items()}
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
+
+
+def _array(values: List[Any], type: Optional["pa.DataType"] = None) -> "pa.Array":
+    """
+    The values as an array of the given type, or of the type inferred from them. Values that don't share a type are
+    written as strings, like they would be in a csv, unless the type says otherwise.
+    """
+    try:
+        return pa.array(values, type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if type is not None and not pa.types.is_string(type):
+            raise
+        return pa.array(
+            [None if value is None else str(value) for value in values], pa.string()
+        )
+
+
+def records_to_table(
+    rows: Iterable[Dict[str, Any]],
+    colnames: List[str],
+    schema: Optional["pa.Schema"] = None,
+) -> "pa.Table":
+    """
+    A table of the colnames of each mapping, with the type of each column inferred from its values,
+    or given by the schema of an earlier table of the same rows.
+    """
+    columns = {name: [] for name in colnames}
+    for row in rows:
+        for name, values in columns.items():
+            values.append(_plain(row[name]))
+    if schema is None:
+        arrays = {name: _array(values) for name, values in columns.items()}
+    else:
+        arrays = {
+            name: _array(values, schema.field(name).type.value_type)
+            if pa.types.is_dictionary(schema.field(name).type)
+            else _array(values, schema.field(name).type)
+            for name, values in columns.items()
+        }
+    return dictionary_encode(pa.table(arrays))
+
+
+def _resolve_nulls(schema: "pa.Schema") -> "pa.Schema":
+    """
+    The schema with the columns that were all null in the first batch, whose type couldn't be inferred, as strings.
+    """
+    for i, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(i, field.with_type(pa.string()))
+        elif pa.types.is_list(field.type) and pa.types.is_null(field.type.value_type):
+            schema = schema.set(i, field.with_type(pa.list_(pa.string())))
+    return schema
+
+
+class _Chunks(RawIOBase):
+    """A sink that keeps what's written to it until it is drained"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_records(
+    rows: Iterable[Dict[str, Any]], colnames: List[str], mimetype: str, batch_size: int
+) -> Iterator[bytes]:
+    """
+    Writes the colnames of each mapping as parquet, one row group per batch_size rows, or as an Arrow IPC stream,
+    one record batch per batch_size rows, yielding the bytes of each as it is written.
+    The column types are inferred from the first batch.
+    """
+    rows = iter(rows)
+    sink = _Chunks()
+    writer = None
+    try:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if writer is None:
+                schema = _resolve_nulls(records_to_table(batch, colnames).schema)
+                table = records_to_table(batch, colnames, schema)
+                if mimetype == PARQUET_MIMETYPE:
+                    writer = pq.ParquetWriter(sink, table.schema)
+                else:
+                    writer = pa.ipc.new_stream(sink, table.schema)
+            elif batch:
+                table = records_to_table(batch, colnames, schema)
+            else:
+                break
+            writer.write_table(table)
+            yield sink.drain()
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.drain()
+
+
+def table_to_bytes(table: "pa.Table", mimetype: str) -> bytes:
+    sink = pa.BufferOutputStream()
+    if mimetype == PARQUET_MIMETYPE:
+        pq.write_table(table, sink)
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def columnar_response(data: bytes, mimetype: str, filename: str) -> Response:
+    """A parquet or arrow download, where filename has no extension"""
+    response = Response(data, mimetype=mimetype)
+    response.headers.set(
+        "Content-Disposition",
+        "attachment",
+        filename=f"{filename}.{EXTENSIONS[mimetype]}",
+    )
+    return response
+
+
+def columnar_records_response(
+    rows: Iterable[Dict[str, Any]], colnames: List[str], mimetype: str, filename: str
+) -> Response:
+    """A parquet or arrow download of mappings, which may be a generator, streamed a batch at a time"""
+    response = Response(
+        stream_with_context(
+            stream_records(rows, colnames, mimetype, app.config["REPORT_CHUNK_SIZE"])
+        ),
+        mimetype=mimetype,
+    )
+    response.headers.set(
+        "Content-Disposition",
+        "attachment",
+        filename=f"{filename}.{EXTENSIONS[mimetype]}",
+    )
+    return response
@@ -0,0 +1,131 @@
+"""
+Cache generations shared by every gunicorn worker
+
+Each row of the cache_generation table counts the commits that changed what a cache holds, and cache entries are keyed
+by, or stamped with, the generations they were built in. An entry built before a write is therefore never used once
+the write has committed, whichever worker or command made it.
+
+- metadata: bumped after every transaction that wrote to METADATA_TABLES
+- variants: bumped by bump_generations once variants, their calls, genotypes, genes or rsids have been inserted or
+  deleted, by the ingest-reports and map-variants-genes commands or by deleting an analysis
+
+A generation is bumped in its own short transaction once the writes it covers have committed. Metadata writes are
+tracked on their connection, which bumps the generation itself once it has been returned to the pool, without checking
+out a second one. Writers never hold a lock on the counter rows, so they don't wait on each other for them.
+
+Generations are read at most once per request.
+"""
+
+import logging
+from typing import Dict, Optional, Set
+
+from flask import has_request_context, request
+from sqlalchemy import event, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from sqlalchemy.sql.dml import UpdateBase
+
+from .models import cache_generation_table, db
+
+# Tables the paged list endpoints count across, see utils.get_total_count.
+# user is left out since every login writes to it, and usernames aren't expected to change.
+METADATA_TABLES = {
+    "analysis",
+    "datasets_analyses",
+    "dataset",
+    "rnaseq_dataset",
+    "datasets_files",
+    "file",
+    "family",
+    "groups_datasets",
+    "group",
+    "institution",
+    "participant",
+    "tissue_sample",
+    "users_groups",
+}
+
+# The generations bumped by writes to each table
+TABLE_GENERATIONS: Dict[str, Set[str]] = {}
+for table in METADATA_TABLES:
+    TABLE_GENERATIONS.setdefault(table, set()).add("metadata")
+
+logger = logging.getLogger("stager.generations")
+
+
+def bump_statement(names: Set[str]) -> str:
+    # the names are ours, so they are inlined for the raw DBAPI cursor, whose paramstyle depends on the driver
+    return str(
+        cache_generation_table.update()
+        .values(generation=cache_generation_table.c.generation + 1)
+        .where(cache_generation_table.c.name.in_(sorted(names)))
+        .compile(compile_kwargs={"literal_binds": True})
+    )
+
+
+@event.listens_for(Engine, "after_execute")
+def track_writes(conn, clauseelement, multiparams, params, execution_options, result):
+    if isinstance(clauseelement, UpdateBase):
+        names = TABLE_GENERATIONS.get(clauseelement.table.name)
+        if names:
+            conn.info.setdefault("generations_written", set()).update(names)
+
+
+@event.listens_for(Engine, "commit")
+def commit_writes(conn):
+    written = conn.info.pop("generations_written", None)
+    if written:
+        conn.info.setdefault("generations_committed", set()).update(written)
+
+
+@event.listens_for(Engine, "rollback")
+def discard_writes(conn):
+    conn.info.pop("generations_written", None)
+
+
+@event.listens_for(Pool, "checkin")
+def bump_committed(dbapi_connection, connection_record):
+    committed = connection_record.info.pop("generations_committed", None)
+    if not committed or dbapi_connection is None:
+        return
+    try:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(bump_statement(committed))
+        finally:
+            cursor.close()
+        dbapi_connection.commit()
+    except Exception:
+        # entries are still expired by COUNT_CACHE_SECONDS and REPORT_CACHE_MAX_AGE_SECONDS
+        logger.warning("Could not bump %s", sorted(committed), exc_info=True)
+        try:
+            dbapi_connection.rollback()
+        except Exception:
+            pass
+
+
+def bump_generations(*names: str) -> None:
+    """Bumps the generations in a transaction of their own, once the writes they cover have committed"""
+    with db.engine.begin() as conn:
+        conn.execute(
+            cache_generation_table.update()
+            .values(generation=cache_generation_table.c.generation + 1)
+            .where(cache_generation_table.c.name.in_(names))
+        )
+
+
+def get_generation(name: str) -> Optional[int]:
+    """The current generation, read once per request, or None if the cache_generation row is missing"""
+    # not g, which outlives requests when they share an app context, as in the tests
+    generations = (
+        request.environ.setdefault("stager.cache_generations", {})
+        if has_request_context()
+        else {}
+    )
+    if name not in generations:
+        generations[name] = db.session.execute(
+            select(cache_generation_table.c.generation).where(
+                cache_generation_table.c.name == name
+            )
+        ).scalar()
+    return generations[name]
@@ -7,18 +7,33 @@ from click.exceptions import ClickException
 from flask import Flask, current_app as app
 from flask.cli import with_appcontext
 import pandas as pd
-from sqlalchemy import exc
+from sqlalchemy import exc, func
 
+from .generations import bump_generations
 from .models import *
 from .madmin import stager_buckets_policy
 from .utils import get_minio_admin, get_minio_client, stager_is_keycloak_admin
 from .manage_keycloak import *
 from .mapping_utils import (
+    VARIANT_ALLELE_COLUMNS,
+    IngestStats,
+    assign_variant_ids,
+    build_genotype_rows,
+    build_variant_call_rows,
+    build_variant_rows,
+    bulk_insert,
     get_report_paths,
-    preprocess_report,
-    get_analysis_ids,
+    iter_preprocessed_reports,
+    AnalysisIndex,
     check_result_paths,
-    try_int,
+    check_report_unchanged,
+    delete_analysis_variants,
+    hash_report,
+    map_variants_to_genes,
+    rebuild_variant_genes,
+    replace_variant_rsids,
+    report_stat,
+    upsert_variants,
 )
 
 
@@ -27,6 +42,7 @@ def register_commands(app: Flask) -> None:
     app.cli.add_command(seed_database_for_development)
     app.cli.add_command(seed_database_minio_groups)
     app.cli.add_command(map_insert_c4r_reports)
+    app.cli.add_command(map_variants_genes)
     app.cli.add_command(migrate_minio_policies)
     if app.config.get("ENABLE_OIDC"):
         app.cli.add_command(update_user)
@@ -59,8 +75,28 @@ def migrate_minio_policies() -> None:
 
 @click.command("map-insert-c4r-reports")
 @click.argument("report_root_path")
+@click.option(
+    "--batch-size",
+    default=5000,
+    show_default=True,
+    help="Number of rows per multi-row INSERT",
+)
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    help="Number of processes parsing reports in parallel with the database writer",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Only insert reports that are new or changed since they were last inserted",
+)
 @with_appcontext
-def map_insert_c4r_reports(report_root_path) -> None:
+def map_insert_c4r_reports(
+    report_root_path, batch_size: int, workers: int, incremental: bool
+) -> None:
     """
     Map dccforge C4R WES reports back to Stager, collapse datasets to a single analysis, and inserts reports
 
@@ -82,8 +118,20 @@ def map_insert_c4r_reports(report_root_path) -> None:
         - ie. the sample name matches the alias, not the participant_codename field in Stager, this currently affects 2 reports?
     If a report's family and samples matches the above condition, then
     - the analyses for the datasets under the family will be collapsed such that the same analysis id is given to the datasets involved in the analysis
-    - inserts the report, variant by variant into the Variant table
-    - updates the genotype for each dataset, for each analysis ,for each variant
+    - inserts the report's variants into the Variant table, in batches of --batch-size rows, where a variant is
+      an allele shared by every analysis calling it, whose annotations are updated to those of the latest report
+    - inserts the analysis' call of each variant into the VariantCall table, with its depth and quality
+    - inserts the genotype for each dataset, for each analysis, for each variant, also in batches
+    - records the report's path, size, modification time, content hash and analysis id in the IngestedReport manifest
+    Reports are parsed one after another in this process, or with --workers N, in parallel in a pool of N processes.
+    Either way, this process is the only one writing to the database and it inserts the reports in order.
+    The throughput of each stage (parsing, and inserting each table) is logged in rows/second at the end.
+
+    By default, all variants and genotypes are deleted first and every report is re-inserted. With --incremental,
+    reports whose size and modification time match the manifest are skipped without being read, as are those whose
+    content hash still matches otherwise, and for changed or new reports, only the variants of the analysis they
+    map to are replaced. Each report is committed together with its manifest entry, so an
+    interrupted run can be resumed by re-running with --incremental.
     Currently maps ~1100 reports using a Stager production dump from 06-28-2021.
     """
     click.echo(report_root_path)
@@ -98,35 +146,75 @@ def map_insert_c4r_reports(report_root_path) -> None:
     engine = db.session.get_bind()
     conn = engine.connect()
 
-    app.logger.info("Deleting Genotype table..")
-    Genotype.query.delete()
-    db.session.commit()
-    app.logger.info("Done")
+    if not incremental:
+        app.logger.info("Deleting Genotype table..")
+        Genotype.query.delete()
+        db.session.commit()
+        app.logger.info("Done")
 
-    app.logger.info("Deleting Variant table..")
-    Variant.query.delete()
-    db.session.commit()
-    app.logger.info("Done")
+        app.logger.info("Deleting VariantCall and Variant tables..")
+        VariantCall.query.delete()
+        Variant.query.delete()
+        IngestedReport.query.delete()
+        db.session.commit()
+        bump_generations("variants")
+        app.logger.info("Done")
 
     mapped_inserted_reports = []
 
-    for i, report in enumerate(report_paths):
+    # this command is assumed to be the only writer to the variant table while it runs
+    next_variant_id = (db.session.query(func.max(Variant.variant_id)).scalar() or 0) + 1
+    stats = IngestStats()
 
-        app.logger.info(report)
-        if report in [
+    # stager has 141584 as ptp instead of CH0567 -> these reports match aliases but can't be subsetted as the sample name in report doesn't match the participant_codename
+    report_paths = [
+        report
+        for report in report_paths
+        if report
+        not in [
             "./results/9x/933R/933R.wes.2019-07-24.csv",
             "./results/4x/411/411.wes.2019-07-24.csv",
-        ]:
-            # stager has 141584 as ptp instead of CH0567 -> these reports match aliases but can't be subsetted as the sample name in report doesn't match the participant_codename
-            continue
+        ]
+    ]
+
+    def load_manifest():
+        return {ingested.path: ingested for ingested in IngestedReport.query.all()}
+
+    manifest = load_manifest()
+    report_hashes = {}
+    if incremental:
+        unchanged = set()
+        for report in report_paths:
+            if report not in manifest:
+                continue
+            is_unchanged, content_hash = check_report_unchanged(
+                report, manifest[report]
+            )
+            if content_hash is not None:
+                report_hashes[report] = content_hash
+            if is_unchanged:
+                unchanged.add(report)
+        # keeps the new size and modification time of reports that were only touched
+        db.session.commit()
+        app.logger.info("Skipping {} unchanged reports".format(len(unchanged)))
+        report_paths = [report for report in report_paths if report not in unchanged]
+
+    # the family -> analysis hierarchy is loaded once rather than queried for every sample of every report
+    analysis_index = AnalysisIndex()
+
+    # ---- obtain sample and family codenames from reports -----
+    # with more than one worker, reports are parsed ahead in a process pool while this process inserts them
+    for report, samples, df, parse_seconds in iter_preprocessed_reports(
+        report_paths, workers
+    ):
 
-        # ---- obtain sample and family codenames from reports -----
-        samples, df = preprocess_report(report)
+        app.logger.info(report)
+        stats.count("parse", len(df), parse_seconds)
         family_codename = str(os.path.basename(os.path.dirname(report)))
 
         pprint(samples)
 
-        dataset_analysis_ids = get_analysis_ids(
+        dataset_analysis_ids = analysis_index.get_analysis_ids(
             family_codename, samples, report, verbose=True
         )
 
@@ -172,6 +260,9 @@ def map_insert_c4r_reports(report_root_path) -> None:
 
                 conn.execute(update_stmt)
                 db.session.flush()
+                analysis_index.collapse_analysis(
+                    dataset_ptp_id, analysis_ptp_id, family_analyses[0]
+                )
 
             # ---- updating the result path -----
             # only update if the paths don't already end in the family folder eg. .../2x/216/
@@ -184,131 +275,91 @@ def map_insert_c4r_reports(report_root_path) -> None:
                     analysis_query.result_path = os.path.dirname(
                         analysis_query.result_path
                     )
+                    analysis_index.set_result_path(
+                        analysis_query.analysis_id, analysis_query.result_path
+                    )
                 db.session.flush()
                 pprint(analysis_query.result_path)
                 print("\n")
 
-            # --- inserting a variant -----
-            # convert dataframe to a dict to iterate over
-            # app.logger.debug(df.head(5))
-            sample_dict = df.to_dict(orient="records")
-
-            for i, row in enumerate(sample_dict):
-
-                if i % 1000 == 0:
-                    print("\t\t Variant # {}".format(str(i)))
-
-                # ---- variant logic ----
-
-                variant_obj = Variant(
-                    analysis_id=family_analyses[0],
-                    chromosome=row.get("chromosome"),
-                    position=row.get("position"),
-                    reference_allele=row.get("reference_allele"),
-                    alt_allele=row.get("alt_allele"),
-                    variation=row.get("variation"),
-                    refseq_change=row.get("refseq_change"),
-                    depth=row.get("depth"),
-                    conserved_in_20_mammals=row.get("conserved_in_20_mammals"),
-                    sift_score=row.get("sift_score"),
-                    polyphen_score=row.get("polyphen_score"),
-                    cadd_score=row.get("cadd_score"),
-                    gnomad_af=row.get("gnomad_af"),
-                    ucsc_link=row.get("ucsc_link"),
-                    gnomad_link=row.get("gnomad_link"),
-                    gene=row.get("gene"),
-                    info=row.get("info"),
-                    quality=row.get("quality"),
-                    clinvar=row.get("clinvar"),
-                    gnomad_af_popmax=row.get("gnomad_af_popmax"),
-                    gnomad_ac=row.get("gnomad_ac"),
-                    gnomad_hom=row.get("gnomad_hom"),
-                    report_ensembl_gene_id=row.get("ensembl_gene_id"),
-                    ensembl_transcript_id=row.get("ensembl_transcript_id"),
-                    aa_position=row.get("aa_position"),
-                    exon=row.get("exon"),
-                    protein_domains=row.get("protein_domains"),
-                    rsids=row.get("rsids"),
-                    gnomad_oe_lof_score=row.get("gnomad_oe_lof_score"),
-                    gnomad_oe_mis_score=row.get("gnomad_oe_mis_score"),
-                    exac_pli_score=row.get("gnomad_oe_mis_score"),
-                    exac_prec_score=row.get("exac_prec_score"),
-                    exac_pnull_score=row.get("exac_pnull_score"),
-                    spliceai_impact=row.get("spliceai_impact"),
-                    spliceai_score=row.get("spliceai_score"),
-                    vest3_score=row.get("vest3_score"),
-                    revel_score=row.get("revel_score"),
-                    gerp_score=row.get("gerp_score"),
-                    imprinting_status=row.get("imprinting_status"),
-                    imprinting_expressed_allele=row.get("imprinting_expressed_allele"),
-                    pseudoautosomal=row.get("pseudoautosomal"),
-                    number_of_callers=try_int(row.get("number_of_callers")),
-                    old_multiallelic=row.get("old_multiallelic"),
-                    uce_100bp=row.get("uce_100bp"),
-                    uce_200bp=row.get("uce_200bp"),
-                )
-
-                db.session.add(variant_obj)
-                db.session.flush()
-
-                # convert to str incase it's a singleton
-                gts_row = str(row.get("gts"))
-                coverage_row = str(row.get("trio_coverage"))
-
-                # assume the ordering of the samples in the columns matches these two fields
-                if gts_row is not None:
-                    gts_list = gts_row.split(",")
-
-                if coverage_row is not None:
-                    # replace forward slashes with underscores where applicable
-                    coverage_row = coverage_row.replace("/", "_")
-                    coverage_list = coverage_row.split("_")
-
-                for i, sample in enumerate(samples):
-                    # replaces family name and underscore prefixed to sample
-                    sample_for_datasetid = str(
-                        sample.replace(str(family_codename) + "_", "")
+            # --- inserting the variants and genotypes -----
+            # variants, calls and genotypes are built in memory with the ids of existing variants
+            # and pre-allocated ids for new ones, then inserted in batches rather than flushed one by one
+            analysis_id = family_analyses[0]
+
+            if incremental:
+                # replace what was previously inserted for this report or its analysis
+                replaced_analyses = {analysis_id}
+                if report in manifest and manifest[report].analysis_id is not None:
+                    replaced_analyses.add(manifest[report].analysis_id)
+                with stats.stage("delete"):
+                    stats.count(
+                        "delete", delete_analysis_variants(list(replaced_analyses))
                     )
-                    # if any underscores in the name they are dashes in the database, likely because of the R script used to generate the reports
-                    sample_for_datasetid = sample_for_datasetid.replace("_", "-")
-
-                    # get participant id from dict
-                    dataset_ptp_id = None
-                    dataset_ptp_id = fam_dict[family_codename][sample_for_datasetid][3]
-
-                    gt_cols = [
-                        "%s%s" % (col, sample)
-                        for col in ["zygosity.", "burden.", "alt_depths."]
-                    ]
-
-                    zygosity, burden, alt_depths = [
-                        row.get(col.lower()) for col in gt_cols
-                    ]
-
-                    analyzed_variant_dataset = Genotype(
-                        variant_id=variant_obj.variant_id,
-                        analysis_id=family_analyses[0],
-                        dataset_id=dataset_ptp_id,
-                        zygosity=zygosity,
-                        burden=try_int(burden),
-                        alt_depths=try_int(alt_depths),
-                        coverage=try_int(coverage_list[i]),
-                        genotype=gts_list[i],
+                # other reports of the same analysis have been superseded by this one
+                for path, superseded in list(manifest.items()):
+                    if path != report and superseded.analysis_id in replaced_analyses:
+                        db.session.delete(superseded)
+                        del manifest[path]
+
+            unique = df.drop_duplicates(VARIANT_ALLELE_COLUMNS)
+            if len(unique) < len(df):
+                app.logger.warning(
+                    "Skipping {} repeated variants in {}".format(
+                        len(df) - len(unique), report
                     )
-                    db.session.add(analyzed_variant_dataset)
+                )
+            records = unique.to_dict(orient="records")
+            variant_rows = build_variant_rows(records)
+            next_variant_id = assign_variant_ids(
+                variant_rows, next_variant_id, batch_size
+            )
+            call_rows = build_variant_call_rows(records, variant_rows, analysis_id)
+            genotype_rows = build_genotype_rows(
+                records,
+                variant_rows,
+                samples,
+                family_codename,
+                fam_dict[family_codename],
+                analysis_id,
+            )
 
-                try:
-                    db.session.flush()
-                #   db.session.commit()
-                except exc.IntegrityError as e:
-                    db.session.rollback()
-                    app.logger.error(str(e))
+            try:
+                with stats.stage("variant", len(variant_rows)):
+                    upsert_variants(variant_rows, batch_size)
+                with stats.stage("variant_call", len(call_rows)):
+                    bulk_insert(VariantCall.__table__, call_rows, batch_size)
+                with stats.stage("genotype", len(genotype_rows)):
+                    bulk_insert(Genotype.__table__, genotype_rows, batch_size)
+                with stats.stage("variant_rsid"):
+                    stats.count(
+                        "variant_rsid", replace_variant_rsids(variant_rows, batch_size)
+                    )
+                with stats.stage("variant_gene"):
+                    stats.count("variant_gene", map_variants_to_genes([analysis_id]))
+
+                ingested = manifest.get(report) or IngestedReport(path=report)
+                ingested.size, ingested.mtime = report_stat(report)
+                ingested.content_hash = report_hashes.get(report) or hash_report(report)
+                ingested.analysis_id = analysis_id
+                ingested.ingested = datetime.utcnow()
+                db.session.add(ingested)
+                db.session.flush()
+                manifest[report] = ingested
+            except exc.IntegrityError as e:
+                db.session.rollback()
+                app.logger.error(str(e))
+                # the entries of superseded reports are back in the database
+                manifest = load_manifest()
 
         try:
             db.session.commit()
         except exc.IntegrityError as e:
             db.session.rollback()
             app.logger.error(str(e))
+            manifest = load_manifest()
+        # cached summary reports are built again with this report's variants
+        bump_generations("variants")
 
         mapped_inserted_reports.append(report)
         print("Done inserting %s" % report)
@@ -317,6 +368,7 @@ def map_insert_c4r_reports(report_root_path) -> None:
     end = time.time()
 
     app.logger.info("Done inserting reports in {} minutes".format((end - start) / 60))
+    stats.log()
     app.logger.info("Mapped Families: {}".format(len(mappable_families)))
     app.logger.info("Total Families: {}".format(len(fam_dict)))
 
@@ -333,6 +385,26 @@ def map_insert_c4r_reports(report_root_path) -> None:
         pickle.dump(fam_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
 
+@click.command("map-variants-genes")
+@with_appcontext
+def map_variants_genes() -> None:
+    """
+    Rebuild the precomputed variant to gene overlaps used by the variant summary endpoints.
+
+    Variants are mapped as reports are inserted, so this only needs to be run to backfill
+    existing variants or after the gene table has been reloaded.
+    """
+    start = time.time()
+    inserted = rebuild_variant_genes()
+    db.session.commit()
+    bump_generations("variants")
+    app.logger.info(
+        "Mapped {} variant-gene pairs in {:.1f} seconds".format(
+            inserted, time.time() - start
+        )
+    )
+
+
 @click.command("db-seed")
 @click.option("--force", is_flag=True, default=False)
 @with_appcontext
@@ -2,16 +2,30 @@
 Various functions for assisting in mapping reports back to and collapsing datasets and analyses in Stager
 """
 
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
 from glob import glob
+import hashlib
+from itertools import islice
+import multiprocessing
 import os
-from typing import List
+import re
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from flask import current_app as app
 
 import numpy as np
 import pandas as pd
 from sqlalchemy.orm.exc import MultipleResultsFound
-from sqlalchemy import or_
+from sqlalchemy import Table, and_, exists, select, tuple_
+from sqlalchemy.dialects import mysql
+from sqlalchemy.sql import Insert, Select
 
 from . import models
+from .binning import bin_for_interval, containing_bins
 from .models import db
 
 
@@ -26,6 +40,16 @@ def try_int(value: str):
         return value
 
 
+def normalize_sample_name(sample: str, family_codename: str) -> str:
+    """
+    Converts a sample name from a report's columns to the participant codename it should have in Stager.
+    """
+    # replaces family name and underscore prefixed to sample
+    sample = str(sample.replace(str(family_codename) + "_", ""))
+    # if any underscores in the name they are dashes in the database, likely because of the R script used to generate the reports
+    return sample.replace("_", "-")
+
+
 def get_report_paths(
     results_path: List[str],
     ignore_folders: List[str] = ["calx/", "misc/", "run_statistics/", "database/"],
@@ -192,157 +216,327 @@ def preprocess_report(
     return samples, df
 
 
-def get_analysis_ids(
-    family_codename: str, samples: List[str], report_path: str, verbose: bool = False
-) -> List[str]:
+def hash_report(report: str) -> str:
+    """
+    Returns the SHA-256 hex digest of a report's contents, to detect changed reports.
     """
-    Given a family codename and list of samples from a report, traverses the Family -> Analysis Stager schema, accounting for family and participant aliases,
-    to identify whether the metadata structure in the database matches the report and can be collapsed.
+    digest = hashlib.sha256()
+    with open(report, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
 
-    - returns None if family is not found at all
-    - Returns 'No match' for a participant if the family is found, but the participant isn't
-    - if participant is found, tissue sample is found, and dataset and analysis is found, takes the latest analysis and returns
-    an array of length 4 (see below)
+def report_stat(report: str) -> Tuple[int, datetime]:
+    """
+    Returns the size and modification time of a report, the latter to the second as stored in the manifest.
+    """
+    stat = os.stat(report)
+    return stat.st_size, datetime.fromtimestamp(int(stat.st_mtime))
 
-    dataset_analysis_d[sample] = (analyses.analysis_id, analyses.updated, analyses.result_path, dataset.dataset_id)
 
-    TODO: return a dict instead of an array -> need to re-factor the variant insertion code
+def check_report_unchanged(
+    report: str, ingested: models.IngestedReport
+) -> Tuple[bool, Optional[str]]:
     """
+    Returns whether a report is unchanged since its manifest entry was recorded, and its content hash if it had to
+    be computed. A report with the same size and modification time is assumed unchanged without being read.
+    Otherwise it is hashed, and if its content is the same after all, eg. it was touched or copied over, the entry
+    is updated to its new size and modification time so that it isn't hashed again by the next run.
+    """
+    size, mtime = report_stat(report)
+    if ingested.size == size and ingested.mtime == mtime:
+        return True, None
+    content_hash = hash_report(report)
+    if content_hash != ingested.content_hash:
+        return False, content_hash
+    ingested.size, ingested.mtime = size, mtime
+    return True, content_hash
 
-    # traverses hierarchy and obtains latest analysis id for family and participants
-    dataset_analysis_d = {}
 
-    fam_codename = family_codename
+def timed_preprocess_report(report: str) -> Tuple[List[str], pd.DataFrame, float]:
+    """
+    preprocess_report, also returning how long it took in seconds.
+    """
+    start = time.perf_counter()
+    samples, df = preprocess_report(report)
+    return samples, df, time.perf_counter() - start
 
-    print("Family Codename: {}".format(fam_codename))
 
-    try:
-        family = models.Family.query.filter(
-            or_(
-                models.Family.family_codename == fam_codename,
-                models.Family.family_aliases.like(fam_codename),
+def iter_preprocessed_reports(
+    report_paths: List[str], workers: int = 1
+) -> Iterator[Tuple[str, List[str], pd.DataFrame, float]]:
+    """
+    Yields (report path, samples, dataframe, seconds spent parsing) for each report, in order.
+
+    With a single worker, reports are parsed lazily in this process as they are consumed. Otherwise, they are
+    parsed in a pool of that many processes, with at most two reports per worker parsed ahead of the consumer,
+    so the dataframes waiting to be consumed stay bounded no matter how far behind the consumer is.
+    """
+    if workers <= 1:
+        for report in report_paths:
+            yield (report, *timed_preprocess_report(report))
+        return
+
+    # spawn rather than fork, as the parent process holds database connections and Flask state
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        paths = iter(report_paths)
+        pending = deque(
+            (report, executor.submit(timed_preprocess_report, report))
+            for report in islice(paths, 2 * workers)
+        )
+        while pending:
+            report, future = pending.popleft()
+            for next_report in islice(paths, 1):
+                pending.append(
+                    (next_report, executor.submit(timed_preprocess_report, next_report))
+                )
+            yield (report, *future.result())
+
+
+def matches_like(pattern: str, value: str) -> bool:
+    """
+    Whether value matches a SQL LIKE pattern, case-insensitively like MySQL's default collation.
+    """
+    if value is None:
+        return False
+    regex = "".join(
+        ".*" if char == "%" else "." if char == "_" else re.escape(char)
+        for char in pattern
+    )
+    return re.fullmatch(regex, value, re.IGNORECASE | re.DOTALL) is not None
+
+
+class AnalysisIndex:
+    """
+    In-memory index of the Family -> Participant -> TissueSample -> Dataset -> Analysis hierarchy and the family and
+    participant aliases, loaded once with a query per table so that every report can be mapped without touching the database.
+
+    The collapsing of analyses and result path updates done by map-insert-c4r-reports must be mirrored with
+    collapse_analysis and set_result_path to keep the index consistent with the database.
+    """
+
+    def __init__(self):
+        families = db.session.query(
+            models.Family.family_id,
+            models.Family.family_codename,
+            models.Family.family_aliases,
+        ).all()
+        self.families_by_codename = defaultdict(set)
+        self.families_by_alias = defaultdict(set)
+        for family_id, codename, aliases in families:
+            self.families_by_codename[codename.casefold()].add(family_id)
+            if aliases is not None:
+                self.families_by_alias[aliases.casefold()].add(family_id)
+
+        self.participants_by_family = defaultdict(list)
+        for participant in db.session.query(
+            models.Participant.participant_id,
+            models.Participant.family_id,
+            models.Participant.participant_codename,
+            models.Participant.participant_aliases,
+        ).order_by(models.Participant.participant_id):
+            self.participants_by_family[participant.family_id].append(participant)
+
+        self.tissue_samples_by_participant = defaultdict(list)
+        for tissue_sample_id, participant_id in db.session.query(
+            models.TissueSample.tissue_sample_id, models.TissueSample.participant_id
+        ).order_by(models.TissueSample.tissue_sample_id):
+            self.tissue_samples_by_participant[participant_id].append(tissue_sample_id)
+
+        # select from the base table to avoid joining every polymorphic subclass
+        dataset_table = models.Dataset.__table__
+        self.datasets_by_tissue_sample = defaultdict(list)
+        for dataset_id, tissue_sample_id in db.session.execute(
+            select(
+                dataset_table.c.dataset_id, dataset_table.c.tissue_sample_id
+            ).order_by(dataset_table.c.dataset_id)
+        ):
+            self.datasets_by_tissue_sample[tissue_sample_id].append(dataset_id)
+
+        self.analyses_by_dataset = defaultdict(list)
+        for dataset_id, analysis_id in db.session.execute(
+            select(
+                models.datasets_analyses_table.c.dataset_id,
+                models.datasets_analyses_table.c.analysis_id,
+            )
+        ):
+            self.analyses_by_dataset[dataset_id].append(analysis_id)
+
+        self.analyses = {
+            analysis_id: [updated, result_path]
+            for analysis_id, updated, result_path in db.session.query(
+                models.Analysis.analysis_id,
+                models.Analysis.updated,
+                models.Analysis.result_path,
             )
-        ).one_or_none()
-    except MultipleResultsFound:
-        msg = "Multiple family ids found for {}".format(fam_codename)
-        if verbose:
-            print(msg)
-        family = None
-
-    if family is None:
+        }
+
+    def find_family(self, codename: str) -> int:
+        """
+        The equivalent of matching family_codename == codename OR family_aliases LIKE codename.
+        Raises MultipleResultsFound if more than one family matches.
+        """
+        family_ids = set(self.families_by_codename.get(codename.casefold(), ()))
+        if "%" in codename or "_" in codename:
+            for aliases, ids in self.families_by_alias.items():
+                if matches_like(codename, aliases):
+                    family_ids |= ids
+        else:
+            family_ids |= self.families_by_alias.get(codename.casefold(), set())
+        if len(family_ids) > 1:
+            raise MultipleResultsFound()
+        return next(iter(family_ids), None)
+
+    def find_participant(self, family_id: int, sample: str) -> int:
+        """
+        The equivalent of matching participant_codename == sample OR participant_aliases LIKE %sample% within a family,
+        taking the first participant if more than one matches.
+        """
+        for participant in self.participants_by_family.get(family_id, ()):
+            if (
+                participant.participant_codename.casefold() == sample.casefold()
+                or matches_like(f"%{sample}%", participant.participant_aliases)
+            ):
+                return participant.participant_id
         return None
 
-    for sample in samples:
+    def latest_analysis(self, dataset_id: int) -> int:
+        """
+        Returns the most recently updated analysis of a dataset.
+        """
+        analysis_ids = self.analyses_by_dataset.get(dataset_id)
+        if not analysis_ids:
+            return None
+        return max(analysis_ids, key=lambda analysis_id: self.analyses[analysis_id][0])
 
-        sample = str(
-            sample.replace(str(fam_codename) + "_", "")
-        )  # replaces family name and underscore prefixed to sample
-        sample = sample.replace(
-            "_", "-"
-        )  # if any underscores in the name they are dashes in the database, likely because of the R script used to generate the reports
+    def collapse_analysis(self, dataset_id: int, analysis_id: int, into: int) -> None:
+        analysis_ids = self.analyses_by_dataset[dataset_id]
+        self.analyses_by_dataset[dataset_id] = [
+            into if mapped == analysis_id else mapped for mapped in analysis_ids
+        ]
 
-        if verbose:
-            print("\tSample/Participant: {}".format(sample))
+    def set_result_path(self, analysis_id: int, result_path: str) -> None:
+        self.analyses[analysis_id][1] = result_path
 
-        participant_id = models.Participant.query.filter(
-            models.Participant.family_id == family.family_id,
-            or_(
-                models.Participant.participant_codename == sample,
-                models.Participant.participant_aliases.like("%{}%".format(sample)),
-            ),
-        ).value("participant_id")
+    def get_analysis_ids(
+        self,
+        family_codename: str,
+        samples: List[str],
+        report_path: str,
+        verbose: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Given a family codename and list of samples from a report, traverses the Family -> Analysis Stager schema, accounting for family and participant aliases,
+        to identify whether the metadata structure in the database matches the report and can be collapsed.
 
-        if participant_id is None:
-            print("\t\tNo match for participant in database")
-            dataset_analysis_d[sample] = "No match"
-            continue  #     return all ptps in the dict, hopefully doesn't break anything
+        - returns None if family is not found at all
+        - Returns 'No match' for a participant if the family is found, but the participant isn't
+        - if participant is found, tissue sample is found, and dataset and analysis is found, takes the latest analysis and returns
+        an array of length 4 (see below)
 
-        if verbose:
-            print("\t\tParticipant ID: {}".format(participant_id))
+        dataset_analysis_d[sample] = (analyses.analysis_id, analyses.updated, analyses.result_path, dataset.dataset_id)
 
-        tissues = models.TissueSample.query.filter(
-            models.TissueSample.participant_id == participant_id
-        ).all()
+        TODO: return a dict instead of an array -> need to re-factor the variant insertion code
+        """
 
-        for tissue in tissues:
+        # traverses hierarchy and obtains latest analysis id for family and participants
+        dataset_analysis_d = {}
 
-            if verbose:
-                print("\t\tTissue ID: {}".format(tissue.tissue_sample_id))
+        fam_codename = family_codename
 
-            datasets = tissue.datasets
+        print("Family Codename: {}".format(fam_codename))
 
-            for dataset in datasets:
+        try:
+            family_id = self.find_family(fam_codename)
+        except MultipleResultsFound:
+            msg = "Multiple family ids found for {}".format(fam_codename)
+            if verbose:
+                print(msg)
+            family_id = None
 
-                if verbose:
-                    print("\t\tDataset ID: {}".format(dataset.dataset_id))
+        if family_id is None:
+            return None
 
-                mapped_analysis_ids_gen = (
-                    db.session.query(models.datasets_analyses_table)
-                    .filter(
-                        models.datasets_analyses_table.c.dataset_id
-                        == dataset.dataset_id
-                    )
-                    .values("analysis_id")
-                )
+        for sample in samples:
 
-                mapped_analysis_ids = [x for x, in mapped_analysis_ids_gen]
+            sample = normalize_sample_name(sample, fam_codename)
 
-                if verbose:
-                    print(
-                        "\t\tFound {} analysis IDs: {}".format(
-                            len(mapped_analysis_ids), mapped_analysis_ids
-                        )
-                    )
+            if verbose:
+                print("\tSample/Participant: {}".format(sample))
 
-                analyses = (
-                    models.Analysis.query.filter(
-                        models.Analysis.analysis_id.in_(mapped_analysis_ids)
-                    )
-                    .order_by(models.Analysis.updated.desc())
-                    .first()
-                )
+            participant_id = self.find_participant(family_id, sample)
 
-                if not analyses:
+            if participant_id is None:
+                print("\t\tNo match for participant in database")
+                dataset_analysis_d[sample] = "No match"
+                continue  #     return all ptps in the dict, hopefully doesn't break anything
 
-                    if verbose:
-                        print("\t\tNo analyses found for {}".format(dataset))
-                    continue
+            if verbose:
+                print("\t\tParticipant ID: {}".format(participant_id))
 
-                #                 print(analyses.updated)
+            for tissue_sample_id in self.tissue_samples_by_participant.get(
+                participant_id, ()
+            ):
 
                 if verbose:
-                    print(
-                        "\t\tAnalysis ID '{}' is the most recent".format(
-                            analyses.analysis_id
-                        )
-                    )
+                    print("\t\tTissue ID: {}".format(tissue_sample_id))
 
-                # check if the participant already has a dataset. if yes, check when the analysis was updated.
-                if dataset_analysis_d.get(sample):
+                for dataset_id in self.datasets_by_tissue_sample.get(
+                    tissue_sample_id, ()
+                ):
 
                     if verbose:
-                        print("\t\tSample '{}' already has an analysis.".format(sample))
-                    if analyses.updated > dataset_analysis_d[sample][1]:
+                        print("\t\tDataset ID: {}".format(dataset_id))
+
+                    analysis_id = self.latest_analysis(dataset_id)
+
+                    if analysis_id is None:
+
                         if verbose:
-                            print("\t\tExisting analysis is newer, not replacing..")
+                            print("\t\tNo analyses found for {}".format(dataset_id))
                         continue
 
-                dataset_analysis_d[sample] = (
-                    analyses.analysis_id,
-                    analyses.updated,
-                    analyses.result_path,
-                    dataset.dataset_id,
-                    report_path,
-                )
-                # dataset_analysis_d[sample] = {'analysis_id': analyses.analysis_id, 'analysis_updated': analyses.updated, 'result_path' : analyses.result_path, 'dataset_id' : dataset.dataset_id}
-    return dataset_analysis_d
+                    updated, result_path = self.analyses[analysis_id]
+
+                    if verbose:
+                        print(
+                            "\t\tAnalysis ID '{}' is the most recent".format(
+                                analysis_id
+                            )
+                        )
+
+                    # check if the participant already has a dataset. if yes, check when the analysis was updated.
+                    if dataset_analysis_d.get(sample):
+
+                        if verbose:
+                            print(
+                                "\t\tSample '{}' already has an analysis.".format(
+                                    sample
+                                )
+                            )
+                        if updated > dataset_analysis_d[sample][1]:
+                            if verbose:
+                                print("\t\tExisting analysis is newer, not replacing..")
+                            continue
+
+                    dataset_analysis_d[sample] = (
+                        analysis_id,
+                        updated,
+                        result_path,
+                        dataset_id,
+                        report_path,
+                    )
+        return dataset_analysis_d
 
 
 def check_result_paths(
     dataset_analysis_ids: List[str], samples: List[str], family_codename: str
 ):
     """
-    dataset_analysis_ids - list returned from get_analysis_ids()
+    dataset_analysis_ids - list returned from AnalysisIndex.get_analysis_ids()
     samples - list of samples returned from preprocess_report()
     family_codename - family codename returned from report path
 
@@ -388,3 +582,346 @@ def check_result_paths(
                 if result_paths_same == True:
                     return True, ends_in_fam_folder
     return False, None
+
+
+def called_variant_ids(analysis_ids: List[int]) -> Select:
+    """The ids of the variants called in any of the given analyses, as a subquery"""
+    return select(models.VariantCall.variant_id).where(
+        models.VariantCall.analysis_id.in_(analysis_ids)
+    )
+
+
+def map_variants_to_genes(analysis_ids: List[int] = None) -> int:
+    """
+    Fills the variant_gene table with every gene overlapping each variant, optionally only for the variants
+    of the given analyses. Pairs that are already mapped are left as is.
+
+    Returns the number of variant-gene pairs inserted.
+    """
+    # a gene containing the variant position must be in one of the bins containing that position
+    overlaps = select(models.Variant.variant_id, models.Gene.ensembl_id).join(
+        models.Gene,
+        and_(
+            models.Gene.chromosome == models.Variant.chromosome,
+            models.Gene.bin.in_(containing_bins(models.Variant.position)),
+            models.Gene.start <= models.Variant.position,
+            models.Variant.position <= models.Gene.end,
+        ),
+    )
+    if analysis_ids is not None:
+        overlaps = overlaps.where(
+            models.Variant.variant_id.in_(called_variant_ids(analysis_ids))
+        )
+
+    result = db.session.execute(
+        models.variant_gene_table.insert()
+        .prefix_with("IGNORE")
+        .from_select(["variant_id", "ensembl_id"], overlaps)
+    )
+    return result.rowcount
+
+
+def rebuild_variant_genes() -> int:
+    """
+    Recomputes the variant_gene table from scratch, eg. after the gene table has been reloaded.
+
+    Returns the number of variant-gene pairs inserted.
+    """
+    db.session.execute(models.variant_gene_table.delete())
+    return map_variants_to_genes()
+
+
+RSID_PATTERN = re.compile(r"^rs\d+$")
+
+
+def split_rsids(rsids: str) -> List[str]:
+    """
+    Splits the comma delimited rsIDs of a variant from a report, discarding anything that isn't an rsID.
+    """
+    if not rsids:
+        return []
+    return sorted(
+        {
+            rsid
+            for rsid in (token.strip().lower() for token in str(rsids).split(","))
+            if RSID_PATTERN.match(rsid)
+        }
+    )
+
+
+def map_variant_rsids(analysis_ids: List[int] = None) -> int:
+    """
+    Fills the variant_rsid table from the comma delimited Variant.rsids, optionally only for the variants
+    of the given analyses. rsIDs that are already mapped are left as is.
+
+    Returns the number of variant-rsID pairs inserted.
+    """
+    query = select(models.Variant.variant_id, models.Variant.rsids).where(
+        models.Variant.rsids != None
+    )
+    if analysis_ids is not None:
+        query = query.where(
+            models.Variant.variant_id.in_(called_variant_ids(analysis_ids))
+        )
+
+    rows = [
+        {"variant_id": variant_id, "rsid": rsid}
+        for variant_id, rsids in db.session.execute(query)
+        for rsid in split_rsids(rsids)
+    ]
+    if not rows:
+        return 0
+    db.session.execute(models.variant_rsid_table.insert().prefix_with("IGNORE"), rows)
+    return len(rows)
+
+
+# Variant columns which are named differently in the reports
+VARIANT_REPORT_COLUMNS = {"report_ensembl_gene_id": "ensembl_gene_id"}
+# Variant columns which are not taken as is from the reports
+VARIANT_COMPUTED_COLUMNS = {"variant_id", "bin"}
+# Variant columns which identify an allele, unique together
+VARIANT_ALLELE_COLUMNS = ["chromosome", "position", "reference_allele", "alt_allele"]
+
+
+def build_variant_rows(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Converts the records of a preprocessed report into rows for the variant table, in the same order.
+    Their variant ids are then set by assign_variant_ids.
+    """
+    columns = [
+        column.name
+        for column in models.Variant.__table__.columns
+        if column.name not in VARIANT_COMPUTED_COLUMNS
+    ]
+    rows = []
+    for record in records:
+        row = {
+            column: record.get(VARIANT_REPORT_COLUMNS.get(column, column))
+            for column in columns
+        }
+        position = int(row["position"])
+        # as read back from the database when looking up existing alleles
+        row["chromosome"] = str(row["chromosome"])
+        row["position"] = position
+        row["bin"] = bin_for_interval(
+            position, position + len(row["reference_allele"]) - 1
+        )
+        rows.append(row)
+    return rows
+
+
+def assign_variant_ids(
+    variant_rows: List[Dict[str, Any]], next_variant_id: int, batch_size: int
+) -> int:
+    """
+    Sets the variant_id of each row built by build_variant_rows to that of the variant with the same allele,
+    looked up batch_size alleles at a time, or to a new id allocated sequentially from next_variant_id,
+    so that variant calls and genotypes can reference them without a round trip to the database per variant.
+    Returns the next id that is still unallocated.
+    """
+    columns = [models.Variant.__table__.c[column] for column in VARIANT_ALLELE_COLUMNS]
+    alleles = [
+        tuple(row[column] for column in VARIANT_ALLELE_COLUMNS) for row in variant_rows
+    ]
+    existing = {}
+    for i in range(0, len(alleles), batch_size):
+        query = select(models.Variant.variant_id, *columns).where(
+            tuple_(*columns).in_(alleles[i : i + batch_size])
+        )
+        for variant_id, *allele in db.session.execute(query):
+            existing[tuple(allele)] = variant_id
+    for row, allele in zip(variant_rows, alleles):
+        if allele not in existing:
+            existing[allele] = next_variant_id
+            next_variant_id += 1
+        row["variant_id"] = existing[allele]
+    return next_variant_id
+
+
+def upsert_variants(variant_rows: List[Dict[str, Any]], batch_size: int) -> int:
+    """
+    Inserts the variants that are new, and replaces the annotations of those that already exist with the ones
+    in the rows, since the annotations of the most recently ingested report are the most recent.
+    Returns the number of rows upserted.
+    """
+    statement = mysql.insert(models.Variant.__table__)
+    statement = statement.on_duplicate_key_update(
+        {
+            column.name: statement.inserted[column.name]
+            for column in models.Variant.__table__.columns
+            if column.name != "variant_id" and column.name not in VARIANT_ALLELE_COLUMNS
+        }
+    )
+    return bulk_insert(statement, variant_rows, batch_size)
+
+
+def build_variant_call_rows(
+    records: List[Dict[str, Any]],
+    variant_rows: List[Dict[str, Any]],
+    analysis_id: int,
+) -> List[Dict[str, Any]]:
+    """
+    Converts the records of a preprocessed report into rows for a bulk insert into the variant_call table,
+    one for each variant in variant_rows, whose ids have been assigned.
+    """
+    return [
+        {
+            "variant_id": variant_row["variant_id"],
+            "analysis_id": analysis_id,
+            "depth": record.get("depth"),
+            "quality": record.get("quality"),
+            "number_of_callers": try_int(record.get("number_of_callers")),
+            "old_multiallelic": record.get("old_multiallelic"),
+        }
+        for record, variant_row in zip(records, variant_rows)
+    ]
+
+
+def build_genotype_rows(
+    records: List[Dict[str, Any]],
+    variant_rows: List[Dict[str, Any]],
+    samples: List[str],
+    family_codename: str,
+    dataset_analysis_ids: Dict[str, tuple],
+    analysis_id: int,
+) -> List[Dict[str, Any]]:
+    """
+    Converts the wide, per-sample zygosity, burden and alt_depths columns of a preprocessed report into
+    rows for a bulk insert into the genotype table, one for each sample for each variant.
+    dataset_analysis_ids is the mapping returned by AnalysisIndex.get_analysis_ids for the report.
+    """
+    # get dataset id of each sample from the mapping, in report column order
+    dataset_ids = [
+        dataset_analysis_ids[normalize_sample_name(sample, family_codename)][3]
+        for sample in samples
+    ]
+    gt_cols = [
+        [
+            ("%s%s" % (col, sample)).lower()
+            for col in ["zygosity.", "burden.", "alt_depths."]
+        ]
+        for sample in samples
+    ]
+
+    rows = []
+    for record, variant_row in zip(records, variant_rows):
+        # convert to str incase it's a singleton
+        # assume the ordering of the samples in the columns matches these two fields
+        gts_list = str(record.get("gts")).split(",")
+        # replace forward slashes with underscores where applicable
+        coverage_list = str(record.get("trio_coverage")).replace("/", "_").split("_")
+
+        for i, dataset_id in enumerate(dataset_ids):
+            zygosity, burden, alt_depths = [record.get(col) for col in gt_cols[i]]
+            rows.append(
+                {
+                    "variant_id": variant_row["variant_id"],
+                    "analysis_id": analysis_id,
+                    "dataset_id": dataset_id,
+                    "zygosity": zygosity,
+                    "burden": try_int(burden),
+                    "alt_depths": try_int(alt_depths),
+                    "coverage": try_int(coverage_list[i]),
+                    "genotype": gts_list[i],
+                }
+            )
+    return rows
+
+
+def build_variant_rsid_rows(variant_rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Splits the rsIDs of the rows built by build_variant_rows into rows for the variant_rsid table.
+    """
+    return [
+        {"variant_id": row["variant_id"], "rsid": rsid}
+        for row in variant_rows
+        for rsid in split_rsids(row["rsids"])
+    ]
+
+
+def replace_variant_rsids(variant_rows: List[Dict[str, Any]], batch_size: int) -> int:
+    """
+    Replaces the rsIDs of the rows built by build_variant_rows, whose ids have been assigned, since upsert_variants
+    replaces the rsids of variants that already exist. Returns the number of rsIDs inserted.
+    """
+    variant_ids = [row["variant_id"] for row in variant_rows]
+    for i in range(0, len(variant_ids), batch_size):
+        db.session.execute(
+            models.variant_rsid_table.delete().where(
+                models.variant_rsid_table.c.variant_id.in_(
+                    variant_ids[i : i + batch_size]
+                )
+            )
+        )
+    return bulk_insert(
+        models.variant_rsid_table.insert().prefix_with("IGNORE"),
+        build_variant_rsid_rows(variant_rows),
+        batch_size,
+    )
+
+
+def bulk_insert(
+    table: Union[Table, Insert], rows: List[Dict[str, Any]], batch_size: int
+) -> int:
+    """
+    Inserts rows into a table, or with an insert statement, with one executemany per batch,
+    which the driver sends as multi-row INSERTs.
+    Returns the number of rows inserted.
+    """
+    statement = table.insert() if isinstance(table, Table) else table
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(statement, rows[i : i + batch_size])
+    return len(rows)
+
+
+class IngestStats:
+    """
+    Accumulates the number of rows and time spent in each stage of a report ingest, to report throughput.
+    """
+
+    def __init__(self):
+        self.rows = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.rows[name] += rows
+
+    def count(self, name: str, rows: int, seconds: float = 0.0) -> None:
+        self.rows[name] += rows
+        self.seconds[name] += seconds
+
+    def log(self) -> None:
+        for name, seconds in self.seconds.items():
+            app.logger.info(
+                "{}: {} rows in {:.1f} seconds ({:.0f} rows/second)".format(
+                    name, self.rows[name], seconds, self.rows[name] / (seconds or 1)
+                )
+            )
+
+
+def delete_analysis_variants(analysis_ids: List[int], batch_size: int = 10000) -> int:
+    """
+    Deletes the genotypes and variant calls of the given analyses, and the variants no other analysis calls,
+    along with their variant_gene and variant_rsid rows through the cascading foreign keys.
+
+    Returns the number of variant calls deleted.
+    """
+    variant_ids = db.session.execute(called_variant_ids(analysis_ids)).scalars().all()
+    models.Genotype.query.filter(models.Genotype.analysis_id.in_(analysis_ids)).delete(
+        synchronize_session=False
+    )
+    deleted = models.VariantCall.query.filter(
+        models.VariantCall.analysis_id.in_(analysis_ids)
+    ).delete(synchronize_session=False)
+    for i in range(0, len(variant_ids), batch_size):
+        models.Variant.query.filter(
+            models.Variant.variant_id.in_(variant_ids[i : i + batch_size]),
+            ~exists().where(models.VariantCall.variant_id == models.Variant.variant_id),
+        ).delete(synchronize_session=False)
+    return deleted
@@ -1,12 +1,17 @@
 from dataclasses import dataclass
 from datetime import date, datetime
 from enum import Enum
+from typing import Optional, Set
 
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import CheckConstraint
+from sqlalchemy import CheckConstraint, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from .binning import bin_for_interval
+
 
 db = SQLAlchemy()
 
@@ -217,6 +222,127 @@ groups_datasets_table = db.Table(
 )
 
 
+# Which datasets each user can see through their groups, the join of users_groups and groups_datasets.
+# Access checks for non-admins are a semi-join against this instead of the two membership tables.
+# Kept up to date by refresh_dataset_visibility for the users or datasets whose memberships are written.
+user_dataset_visibility_table = db.Table(
+    "user_dataset_visibility",
+    db.Model.metadata,
+    db.Column(
+        "user_id",
+        db.Integer,
+        db.ForeignKey("user.user_id", ondelete="cascade"),
+        primary_key=True,
+    ),
+    db.Column(
+        "dataset_id",
+        db.Integer,
+        db.ForeignKey("dataset.dataset_id", ondelete="cascade"),
+        primary_key=True,
+    ),
+    db.Index("user_dataset_visibility_dataset_id_IDX", "dataset_id"),
+)
+
+
+def refresh_dataset_visibility(
+    connection,
+    user_ids: Optional[Set[int]] = None,
+    dataset_ids: Optional[Set[int]] = None,
+) -> None:
+    """
+    Brings user_dataset_visibility in line with users_groups and groups_datasets, in the connection's transaction.
+    Given user_ids or dataset_ids, only the visibility of those users or datasets is brought in line, otherwise all of
+    it is. Only the differences are written.
+    """
+    memberships = (
+        db.select(
+            users_groups_table.c.user_id,
+            groups_datasets_table.c.dataset_id,
+        )
+        .distinct()
+        .join_from(
+            users_groups_table,
+            groups_datasets_table,
+            users_groups_table.c.group_id == groups_datasets_table.c.group_id,
+        )
+        .where(
+            users_groups_table.c.user_id != None,
+            groups_datasets_table.c.dataset_id != None,
+        )
+    )
+    stale = user_dataset_visibility_table.delete()
+    if user_ids is not None:
+        memberships = memberships.where(users_groups_table.c.user_id.in_(user_ids))
+        stale = stale.where(user_dataset_visibility_table.c.user_id.in_(user_ids))
+    if dataset_ids is not None:
+        memberships = memberships.where(
+            groups_datasets_table.c.dataset_id.in_(dataset_ids)
+        )
+        stale = stale.where(user_dataset_visibility_table.c.dataset_id.in_(dataset_ids))
+    connection.execute(
+        user_dataset_visibility_table.insert()
+        .prefix_with("IGNORE")
+        .from_select(["user_id", "dataset_id"], memberships)
+    )
+    connection.execute(
+        stale.where(
+            ~db.exists(
+                memberships.where(
+                    users_groups_table.c.user_id
+                    == user_dataset_visibility_table.c.user_id,
+                    groups_datasets_table.c.dataset_id
+                    == user_dataset_visibility_table.c.dataset_id,
+                )
+            )
+        )
+    )
+
+
+# The column identifying whose visibility a write to each membership table changes
+VISIBILITY_KEYS = {"users_groups": "user_id", "groups_datasets": "dataset_id"}
+
+
+@event.listens_for(Engine, "after_execute")
+def maintain_dataset_visibility(
+    conn, clauseelement, multiparams, params, execution_options, result
+):
+    if not isinstance(clauseelement, UpdateBase):
+        return
+    key = VISIBILITY_KEYS.get(clauseelement.table.name)
+    if key is None:
+        return
+    # The ORM writes each membership row with parameters named after its columns, which give the users or datasets
+    # affected. Anything else, such as a DELETE with its own WHERE clause, falls back to refreshing everything.
+    ids = set()
+    for parameters in result.context.compiled_parameters:
+        if parameters.get(key) is None:
+            refresh_dataset_visibility(conn)
+            return
+        ids.add(parameters[key])
+    if key == "user_id":
+        refresh_dataset_visibility(conn, user_ids=ids)
+    else:
+        refresh_dataset_visibility(conn, dataset_ids=ids)
+
+
+# Counters shared by every worker that caches are keyed by, one row per generation, see generations.py
+cache_generation_table = db.Table(
+    "cache_generation",
+    db.Model.metadata,
+    db.Column("name", db.String(50), primary_key=True),
+    db.Column("generation", db.BigInteger, nullable=False, server_default="0"),
+)
+
+
+@event.listens_for(cache_generation_table, "after_create")
+def seed_cache_generations(target, connection, **kw):
+    # the migrations seed these too, this is for databases made by create_all
+    connection.execute(
+        target.insert(),
+        [{"name": "metadata", "generation": 0}, {"name": "variants", "generation": 0}],
+    )
+
+
 datasets_analyses_table = db.Table(
     "datasets_analyses",
     db.Model.metadata,
@@ -389,10 +515,100 @@ class Analysis(db.Model):
     updated_by = db.relationship("User", foreign_keys=[updated_by_id], lazy="joined")
     assignee = db.relationship("User", foreign_keys=[assignee_id], lazy="joined")
     requester = db.relationship("User", foreign_keys=[requester_id], lazy="joined")
-    variants = db.relationship("Variant", backref="analysis")
+    variant_calls = db.relationship("VariantCall", backref="analysis")
     priority: PriorityType = db.Column(db.Enum(PriorityType))
 
 
+def gene_bin(context) -> int:
+    params = context.get_current_parameters()
+    return bin_for_interval(int(params["start"]), int(params["end"]))
+
+
+# Manifest of the reports inserted by `flask map-insert-c4r-reports`, for incremental ingests
+@dataclass
+class IngestedReport(db.Model):
+    ingested_report_id: int = db.Column(db.Integer, primary_key=True)
+    path: str = db.Column(db.String(500), nullable=False, unique=True)
+    # with mtime, to skip unchanged reports without reading them. Null for reports recorded before it was added
+    size: int = db.Column(db.BigInteger, nullable=True)
+    mtime: datetime = db.Column(db.DateTime, nullable=False)
+    # SHA-256 hex digest of the report file
+    content_hash: str = db.Column(db.String(64), nullable=False)
+    analysis_id: int = db.Column(
+        db.Integer, db.ForeignKey("analysis.analysis_id", ondelete="set null")
+    )
+    ingested: datetime = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class BulkUploadStatus(str, Enum):
+    Queued = "Queued"
+    Running = "Running"
+    Done = "Done"
+    Error = "Error"
+
+
+# Asynchronous POST /api/_bulk uploads, run by the scheduler in tasks.run_bulk_upload_jobs
+@dataclass
+class BulkUploadJob(db.Model):
+    bulk_upload_job_id: int = db.Column(db.Integer, primary_key=True)
+    status: BulkUploadStatus = db.Column(db.Enum(BulkUploadStatus), nullable=False)
+    # the parsed rows of the upload and how to read their linked files
+    rows = db.Column(db.JSON, nullable=False)
+    content_type = db.Column(db.String(50), nullable=False)
+    group_ids = db.Column(db.JSON, nullable=False)
+    rows_total: int = db.Column(db.Integer, nullable=False)
+    rows_processed: int = db.Column(db.Integer, nullable=False, default=0)
+    errors: list = db.Column(db.JSON)
+    dataset_ids: list = db.Column(db.JSON)
+    created: datetime = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_by_id: int = db.Column(
+        db.Integer, db.ForeignKey("user.user_id", onupdate="cascade"), nullable=False
+    )
+    started: datetime = db.Column(db.DateTime)
+    finished: datetime = db.Column(db.DateTime)
+
+
+class SummaryReportStatus(str, Enum):
+    Queued = "Queued"
+    Running = "Running"
+    Done = "Done"
+    Error = "Error"
+
+
+# Asynchronous POST /api/summary/jobs reports, run by the scheduler in tasks.run_summary_report_jobs
+@dataclass
+class SummaryReportJob(db.Model):
+    summary_report_job_id: int = db.Column(db.Integer, primary_key=True)
+    status: SummaryReportStatus = db.Column(
+        db.Enum(SummaryReportStatus), nullable=False
+    )
+    # the same parameters as GET /api/summary/<type>
+    type: str = db.Column(db.String(20), nullable=False)
+    search_type: str = db.Column(db.String(20), nullable=False)
+    search: str = db.Column(db.Text, nullable=False)
+    columns: str = db.Column(db.Text)
+    # csv, parquet or arrow
+    format: str = db.Column(
+        db.String(10), nullable=False, default="csv", server_default="csv"
+    )
+    # the report is written to the results-<group_code> bucket of this group
+    group_id: int = db.Column(
+        db.Integer,
+        db.ForeignKey("group.group_id", onupdate="cascade", ondelete="cascade"),
+        nullable=False,
+    )
+    object_name: str = db.Column(db.String(255))
+    errors: list = db.Column(db.JSON)
+    created: datetime = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_by_id: int = db.Column(
+        db.Integer, db.ForeignKey("user.user_id", onupdate="cascade"), nullable=False
+    )
+    started: datetime = db.Column(db.DateTime)
+    finished: datetime = db.Column(db.DateTime)
+
+    group = db.relationship("Group")
+
+
 @dataclass
 class Gene(db.Model):
     # these are indeed unique in the gtf
@@ -405,8 +621,13 @@ class Gene(db.Model):
     # GRCh37 coordinates, incompatible with others
     start: int = db.Column(db.Integer, nullable=False)
     end: int = db.Column(db.Integer, nullable=False)
+    # UCSC bin of [start, end], see binning.py. Genes without one would never be mapped to variants,
+    # so it has to be set by anything loading the gene table outside the ORM
+    bin = db.Column(db.SmallInteger, nullable=False, default=gene_bin)
     aliases = db.relationship("GeneAlias", backref="gene")
 
+    __table_args__ = (db.Index("gene_chromosome_bin_IDX", "chromosome", "bin"),)
+
 
 @dataclass
 class GeneAlias(db.Model):
@@ -427,15 +648,18 @@ class GeneAlias(db.Model):
     )
 
 
+def variant_bin(context) -> int:
+    params = context.get_current_parameters()
+    position = int(params["position"])
+    return bin_for_interval(position, position + len(params["reference_allele"]) - 1)
+
+
 @dataclass
 class Variant(db.Model):
-    # table contains both variant-annotation (external, versioned annotation information) and variant-analysis (vcf) information.
-    # in the future, the variant-analysis information could be stored in the database and
-    # variant-annotations would be performed on the fly potentially through click commands or additional tables
+    # one row per allele with its variant-annotation (external, versioned annotation information), which is
+    # that of the most recently ingested report calling it. The variant-analysis (vcf) information of each
+    # analysis calling the allele is in VariantCall, and that of each sample in Genotype
     variant_id: int = db.Column(db.Integer, primary_key=True)
-    analysis_id: int = db.Column(
-        db.Integer, db.ForeignKey("analysis.analysis_id"), nullable=False
-    )
     chromosome: str = db.Column(db.String(2), nullable=False)
     # GRCh37 coordinates, incompatible with others
     position: int = db.Column(db.Integer, nullable=False, index=True)
@@ -443,7 +667,6 @@ class Variant(db.Model):
     alt_allele: str = db.Column(db.String(300), nullable=False)
     variation: str = db.Column(db.String(50), nullable=False)
     refseq_change = db.Column(db.String(500), nullable=True)
-    depth: int = db.Column(db.Integer, nullable=False)
     conserved_in_20_mammals: int = db.Column(db.Float, nullable=True)
     sift_score: int = db.Column(db.Float, nullable=True)
     polyphen_score: int = db.Column(db.Float, nullable=True)
@@ -455,7 +678,6 @@ class Variant(db.Model):
     # can be hgnc, ensembl or null depending on age of report. reports from 2020-08 onwards are guaranteed to have either hgnc or ensembl id in this, exists to facilitate comparison
     gene: str = db.Column(db.String(50), nullable=True)
     info: str = db.Column(db.Text(15000), nullable=True)
-    quality: int = db.Column(db.Integer, nullable=True)
     clinvar: str = db.Column(db.String(200), nullable=True)
     gnomad_af_popmax: int = db.Column(db.Float, nullable=True)
     gnomad_ac: int = db.Column(db.Integer, nullable=True)
@@ -481,10 +703,83 @@ class Variant(db.Model):
     imprinting_status: str = db.Column(db.String(50), nullable=True)
     imprinting_expressed_allele: str = db.Column(db.String(50), nullable=True)
     pseudoautosomal: str = db.Column(db.Boolean, nullable=True)  # 'Nan'/Yes/Na
-    number_of_callers: int = db.Column(db.Integer, nullable=True)
-    old_multiallelic: str = db.Column(db.String(500), nullable=True)
     uce_100bp: bool = db.Column(db.Boolean, nullable=True)
     uce_200bp: bool = db.Column(db.Boolean, nullable=True)
+    # UCSC bin of the reference allele's span, see binning.py
+    bin = db.Column(db.SmallInteger, nullable=False, default=variant_bin)
+
+    __table_args__ = (
+        db.Index(
+            "variant_chromosome_bin_position_IDX", "chromosome", "bin", "position"
+        ),
+        db.UniqueConstraint(
+            "chromosome",
+            "position",
+            "reference_allele",
+            "alt_allele",
+            name="variant_allele_IDX",
+        ),
+    )
+
+
+@dataclass
+class VariantCall(db.Model):
+    # an allele as called in one analysis, with what the vcf says about it rather than its annotations
+    variant_id: int = db.Column(
+        db.Integer,
+        db.ForeignKey("variant.variant_id", ondelete="cascade"),
+        primary_key=True,
+    )
+    analysis_id: int = db.Column(
+        db.Integer, db.ForeignKey("analysis.analysis_id"), primary_key=True
+    )
+    depth: int = db.Column(db.Integer, nullable=False)
+    quality: int = db.Column(db.Integer, nullable=True)
+    number_of_callers: int = db.Column(db.Integer, nullable=True)
+    old_multiallelic: str = db.Column(db.String(500), nullable=True)
+
+    variant = db.relationship("Variant", backref="calls")
+
+    __table_args__ = (db.Index("variant_call_analysis_id_IDX", "analysis_id"),)
+
+
+# Precomputed overlaps between variants and genes, so that gene panel searches
+# are equality joins instead of range joins on chromosome and position
+variant_gene_table = db.Table(
+    "variant_gene",
+    db.Model.metadata,
+    db.Column(
+        "variant_id",
+        db.Integer,
+        db.ForeignKey("variant.variant_id", ondelete="cascade"),
+        nullable=False,
+    ),
+    db.Column(
+        "ensembl_id",
+        db.Integer,
+        db.ForeignKey("gene.ensembl_id", onupdate="cascade", ondelete="cascade"),
+        nullable=False,
+    ),
+    db.PrimaryKeyConstraint("variant_id", "ensembl_id"),
+    db.Index("variant_gene_ensembl_id_IDX", "ensembl_id"),
+)
+
+
+# Normalized rsIDs of each variant, so that rsID searches are index lookups instead of
+# substring matches against the comma delimited Variant.rsids
+variant_rsid_table = db.Table(
+    "variant_rsid",
+    db.Model.metadata,
+    db.Column(
+        "variant_id",
+        db.Integer,
+        db.ForeignKey("variant.variant_id", ondelete="cascade"),
+        nullable=False,
+    ),
+    db.Column("rsid", db.String(20), nullable=False),
+    db.PrimaryKeyConstraint("variant_id", "rsid"),
+    db.Index("variant_rsid_rsid_IDX", "rsid"),
+)
 
 
 @dataclass
@@ -507,6 +802,9 @@ class Genotype(db.Model):
     )
 
     variant = db.relationship("Variant", backref="genotype", foreign_keys=[variant_id])
+    call = db.relationship(
+        "VariantCall", foreign_keys=[variant_id, analysis_id], viewonly=True
+    )
 
     analysis = db.relationship(
         "Analysis",
@@ -531,7 +829,8 @@ class Genotype(db.Model):
             ["datasets_analyses.analysis_id", "datasets_analyses.dataset_id"],
         ),
         db.ForeignKeyConstraint(
-            [analysis_id, variant_id],
-            ["variant.analysis_id", "variant.variant_id"],
+            [variant_id, analysis_id],
+            ["variant_call.variant_id", "variant_call.analysis_id"],
+            name="genotype_variant_call_fk",
         ),
     )
@@ -0,0 +1,119 @@
+"""
+On-demand profiling of a request, for admins
+
+Adding ?profile=json (or any value) or an X-Stager-Profile header to a request runs its view under cProfile, and
+responds with the profile instead of the view's response: the functions with the largest cumulative time and what
+each of them called, plus every SQL statement executed and its duration. ?profile=pstats instead downloads the raw
+profile, which can be loaded by pstats.Stats or visualized with tools like snakeviz.
+
+The view's response body is consumed inside the profiler, so streamed responses such as csv exports are profiled in
+full. Only one request is profiled at a time per process, as cProfile can't profile concurrent requests separately.
+"""
+
+import cProfile
+import marshal
+import pstats
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Dict, List
+
+from flask import Response, abort, current_app, request
+from flask_login import login_required
+from werkzeug.exceptions import HTTPException
+
+from . import sql_metrics
+from .serializers import json_response
+from .utils import check_admin
+
+PROFILE_HEADER = "X-Stager-Profile"
+# number of functions in the JSON profile, by cumulative time
+PROFILE_FUNCTIONS = 100
+
+_profiling = Lock()
+
+
+def requested() -> bool:
+    return "profile" in request.args or PROFILE_HEADER in request.headers
+
+
+def profile(dispatch: Callable[[], Any]) -> Response:
+    """Profiles the view dispatched by dispatch, if the current user is an admin"""
+    return login_required(check_admin(lambda: _profile(dispatch)))()
+
+
+def _profile(dispatch: Callable[[], Any]) -> Response:
+    output = request.args.get("profile") or request.headers.get(PROFILE_HEADER)
+    if not _profiling.acquire(blocking=False):
+        abort(409, description="Another request is being profiled, try again later")
+    try:
+        statements = sql_metrics.record_statements()
+        profiler = cProfile.Profile()
+        start = perf_counter()
+        profiler.enable()
+        try:
+            try:
+                response = current_app.make_response(dispatch())
+                if not response.direct_passthrough:
+                    response.get_data()
+            except HTTPException as err:
+                response = err.get_response()
+        finally:
+            profiler.disable()
+        duration = perf_counter() - start
+    finally:
+        _profiling.release()
+
+    stats = pstats.Stats(profiler)
+    if output == "pstats":
+        return Response(
+            marshal.dumps(stats.stats),
+            mimetype="application/octet-stream",
+            headers={
+                "Content-Disposition": f"attachment; filename={request.endpoint}.pstats"
+            },
+        )
+    return json_response(
+        {
+            "endpoint": request.endpoint,
+            "status": response.status_code,
+            "duration": duration,
+            "profile": call_tree(stats),
+            "sql": {
+                "count": len(statements),
+                "duration": sum(seconds for _, seconds in statements),
+                "statements": [
+                    {"statement": statement, "duration": seconds}
+                    for statement, seconds in statements
+                ],
+            },
+        }
+    )
+
+
+def call_tree(
+    stats: pstats.Stats, limit: int = PROFILE_FUNCTIONS
+) -> List[Dict[str, Any]]:
+    """
+    The functions taking the most cumulative time, each with the functions it called and the time spent in them.
+    cProfile only records the callers of each function, so they are inverted to get the callees.
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, _, _, cumulative) in callers.items():
+            callees.setdefault(caller, []).append((cumulative, func))
+
+    functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    return [
+        {
+            "function": pstats.func_std_string(func),
+            "calls": calls,
+            "primitive_calls": primitive_calls,
+            "total": total,
+            "cumulative": cumulative,
+            "callees": [
+                {"function": pstats.func_std_string(callee), "cumulative": time}
+                for time, callee in sorted(callees.get(func, ()), reverse=True)
+            ],
+        }
+        for func, (primitive_calls, calls, total, cumulative, _) in functions[:limit]
+    ]
@@ -0,0 +1,204 @@
+"""
+Result cache for the /api/summary reports
+
+The same gene panels are requested over and over, and each report runs the whole variant to family join and its
+aggregation again. Rendered reports are therefore cached, keyed by everything that determines their content: the
+search type and its normalized values, the report type, the output format and columns, which datasets the user can
+see (their groups, or all of them for admins), and the metadata and variants generations, see generations.py.
+
+The variants generation is bumped once an ingest or the deletion of an analysis has committed, and the metadata one
+once any write to the datasets, participants, families or their groups has, so a report cached before either is never
+returned after it. Stale entries aren't deleted, they just stop being requested and are evicted like any other entry.
+Entries are also not returned once they were written more than REPORT_CACHE_MAX_AGE_SECONDS ago, in case a bump was
+lost or a write bypassed the app.
+
+Entries are stored on a local disk or in a MinIO bucket, so that every gunicorn worker shares them, and the least
+recently used are evicted once the cache is over REPORT_CACHE_MAX_BYTES.
+"""
+
+from hashlib import sha256
+from io import BytesIO
+import json
+import os
+from tempfile import NamedTemporaryFile
+from time import time
+from typing import Any, Optional, Tuple
+
+from flask import Flask, current_app as app
+from minio import Minio
+from minio.commonconfig import REPLACE, CopySource
+from minio.error import S3Error
+
+from .generations import get_generation
+from .utils import get_minio_client
+
+
+class DiskReportCache:
+    """
+    Entries are files in a directory. Their modification times are when they were written, and their access times,
+    set explicitly since the disk may be mounted noatime, when they were last read.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: Optional[int] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, name: str) -> Optional[bytes]:
+        path = os.path.join(self.directory, name)
+        try:
+            written = os.stat(path).st_mtime
+            if self.max_age is not None and time() - written > self.max_age:
+                return None
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path, (time(), written))
+        except FileNotFoundError:  # or evicted by another worker in between
+            return None
+        return data
+
+    def set(self, name: str, data: bytes) -> None:
+        # written to a temporary file first so other workers never read a partial entry
+        with NamedTemporaryFile(
+            dir=self.directory, suffix=".tmp", delete=False
+        ) as file:
+            file.write(data)
+        os.replace(file.name, os.path.join(self.directory, name))
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class MinioReportCache:
+    """
+    Entries are objects in a bucket, copied onto themselves when read so their last modified time is refreshed.
+    When they were written is kept in their metadata.
+    """
+
+    def __init__(self, bucket: str, max_bytes: int, max_age: Optional[int] = None):
+        self.bucket = bucket
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    @property
+    def client(self) -> Minio:
+        return get_minio_client()
+
+    def get(self, name: str) -> Optional[bytes]:
+        client = self.client
+        try:
+            response = client.get_object(self.bucket, name)
+        except S3Error as err:
+            if err.code in ("NoSuchKey", "NoSuchBucket"):
+                return None
+            raise
+        try:
+            written = response.headers.get("x-amz-meta-written")
+            # entries from before their write time was kept are treated as expired
+            if self.max_age is not None and (
+                written is None or time() - float(written) > self.max_age
+            ):
+                return None
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+        # an object can only be copied onto itself if its metadata is replaced
+        client.copy_object(
+            self.bucket,
+            name,
+            CopySource(self.bucket, name),
+            metadata={"x-amz-meta-written": written or str(time())},
+            metadata_directive=REPLACE,
+        )
+        return data
+
+    def set(self, name: str, data: bytes) -> None:
+        client = self.client
+        if not client.bucket_exists(self.bucket):
+            client.make_bucket(self.bucket)
+        client.put_object(
+            self.bucket,
+            name,
+            BytesIO(data),
+            len(data),
+            metadata={"x-amz-meta-written": str(time())},
+        )
+        self.evict(client)
+
+    def evict(self, client: Minio) -> None:
+        entries = [
+            (obj.last_modified, obj.size, obj.object_name)
+            for obj in client.list_objects(self.bucket)
+        ]
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            client.remove_object(self.bucket, name)
+            total -= size
+
+
+def cache_key(*parts: Any) -> str:
+    return sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+def get_cached_report(key: Tuple) -> Tuple[Optional[str], Optional[bytes]]:
+    """
+    The name of the cache entry of a report, and the report if it is cached.
+    The name is None if the reports aren't being cached, and it includes the current generations.
+    """
+    cache = app.extensions.get("report_cache")
+    if cache is None:
+        return None, None
+    generations = [get_generation("metadata"), get_generation("variants")]
+    if None in generations:
+        return None, None
+    name = cache_key(*generations, *key)
+    try:
+        return name, cache.get(name)
+    except Exception:
+        # the report can still be built without the cache
+        app.logger.warning("Could not read the report cache", exc_info=True)
+        return name, None
+
+
+def cache_report(name: Optional[str], data: bytes) -> None:
+    cache = app.extensions.get("report_cache")
+    if cache is None or name is None or len(data) > cache.max_bytes:
+        return
+    try:
+        cache.set(name, data)
+    except Exception:
+        app.logger.warning("Could not write to the report cache", exc_info=True)
+
+
+def init_app(app: Flask) -> None:
+    backend = app.config["REPORT_CACHE"]
+    max_bytes = app.config["REPORT_CACHE_MAX_BYTES"]
+    max_age = app.config["REPORT_CACHE_MAX_AGE_SECONDS"]
+    if backend == "disk":
+        app.extensions["report_cache"] = DiskReportCache(
+            app.config["REPORT_CACHE_DIR"], max_bytes, max_age
+        )
+    elif backend == "minio":
+        app.extensions["report_cache"] = MinioReportCache(
+            app.config["REPORT_CACHE_BUCKET"], max_bytes, max_age
+        )
+    elif backend:
+        raise ValueError(f"Unknown REPORT_CACHE backend {backend}")
@@ -0,0 +1,97 @@
+"""
+Fast JSON serialization of the dataclass models for responses
+
+dataclasses.asdict deep-copies every field of every row and then the copies are encoded by the pure Python
+DateTimeEncoder. Instead, the serialized fields of each model are looked up once, read with a single attrgetter
+per instance, and the result is encoded by orjson, which handles datetimes, dates and enums natively.
+The standard library json module is used if orjson isn't installed.
+"""
+
+from dataclasses import fields, is_dataclass
+from datetime import date, time
+from decimal import Decimal
+from enum import Enum
+import json
+from operator import attrgetter
+from typing import Any, Callable, Container, Dict, Optional, Tuple
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from . import models
+
+# model class -> (field names, getter returning their values as a tuple)
+_getters: Dict[type, Tuple[Tuple[str, ...], Callable[[Any], Tuple]]] = {}
+
+
+def _compile(cls: type) -> Tuple[Tuple[str, ...], Callable[[Any], Tuple]]:
+    names = tuple(field.name for field in fields(cls))
+    if len(names) == 1:
+        getter = attrgetter(names[0])
+        return names, lambda instance: (getter(instance),)
+    return names, attrgetter(*names)
+
+
+def field_names(cls: type) -> Tuple[str, ...]:
+    """The serialized fields of a model, in order"""
+    compiled = _getters.get(cls)
+    if compiled is None:
+        compiled = _getters[cls] = _compile(cls)
+    return compiled[0]
+
+
+def to_dict(instance: Any, only: Optional[Container[str]] = None) -> Dict[str, Any]:
+    """
+    The equivalent of dataclasses.asdict for a model instance, but without copying its values.
+    If only is given, the fields not in it are left out without being read.
+    """
+    cls = type(instance)
+    compiled = _getters.get(cls)
+    if compiled is None:
+        compiled = _getters[cls] = _compile(cls)
+    names, getter = compiled
+    if only is not None:
+        return {name: getattr(instance, name) for name in names if name in only}
+    return dict(zip(names, getter(instance)))
+
+
+def _default(obj: Any) -> Any:
+    """encodes what the JSON backend doesn't natively, the same way as utils.DateTimeEncoder"""
+    if is_dataclass(obj):
+        return to_dict(obj)
+    if isinstance(obj, (date, time)):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if hasattr(obj, "item"):  # numpy scalars from pandas
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(
+            obj,
+            default=_default,
+            option=orjson.OPT_PASSTHROUGH_DATACLASS
+            | orjson.OPT_NON_STR_KEYS
+            | orjson.OPT_SERIALIZE_NUMPY,
+        )
+    return json.dumps(obj, default=_default, separators=(",", ":")).encode()
+
+
+def json_response(obj: Any, status: int = 200) -> Response:
+    """Drop-in for jsonify of a single object"""
+    return Response(dumps(obj), status=status, mimetype="application/json")
+
+
+# compile the getters upfront rather than on the first request
+for _model in vars(models).values():
+    if isinstance(_model, type) and is_dataclass(_model):
+        _getters[_model] = _compile(_model)
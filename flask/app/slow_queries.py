@@ -0,0 +1,173 @@
+"""
+Slow query log
+
+Statements taking longer than SLOW_QUERY_SECONDS are logged as one JSON object per line to the stager.slow_query
+logger, which config_logger diverts to the SQLAlchemy sidecar. Each entry has the statement, its bound parameters with
+strings redacted to their length since they include codenames and emails, the endpoint and path without its query
+string that executed it, and on MySQL the EXPLAIN FORMAT=JSON plan. EXPLAINs run on a dedicated engine of a single
+connection with a short timeout, so they never take a connection from the app's pool and leave the transaction of the
+slow statement alone. At most SLOW_QUERY_LOG_PER_MINUTE entries are logged per process, the rest are counted and
+reported with the next entry, so a slow endpoint under load doesn't flood the sidecar or hammer the database with
+EXPLAINs.
+"""
+
+import json
+import logging
+from threading import Lock, local
+from time import monotonic, perf_counter
+from typing import Any, Dict, Optional
+
+from flask import Flask, current_app, has_app_context, has_request_context, request
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("stager.slow_query")
+
+# statements that MySQL can EXPLAIN
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+# seconds an EXPLAIN waits for the explaining connection, or for its plan
+EXPLAIN_TIMEOUT = 5
+
+# at most this many rows of an executemany are logged
+LOGGED_ROWS = 10
+
+# set while explaining so the EXPLAIN itself is never explained
+_explaining = local()
+
+
+class SlowQueryLog:
+    """The threshold and rate limit of the slow query log for an app"""
+
+    def __init__(self, threshold: float, per_minute: int):
+        self.threshold = threshold
+        self.per_minute = per_minute
+        self._lock = Lock()
+        self._tokens = float(per_minute)
+        self._refilled = monotonic()
+        self.suppressed = 0
+        # by URL of the engine whose statements are explained
+        self._explain_engines: Dict[str, Engine] = {}
+
+    def explain_engine(self, engine: Engine) -> Engine:
+        """A pool of one connection to the same database, which EXPLAINs wait on for at most EXPLAIN_TIMEOUT"""
+        key = str(engine.url)
+        with self._lock:
+            if key not in self._explain_engines:
+                self._explain_engines[key] = create_engine(
+                    engine.url,
+                    pool_size=1,
+                    max_overflow=0,
+                    pool_timeout=EXPLAIN_TIMEOUT,
+                    pool_recycle=3600,
+                    connect_args={
+                        "connect_timeout": EXPLAIN_TIMEOUT,
+                        "read_timeout": EXPLAIN_TIMEOUT,
+                    },
+                )
+            return self._explain_engines[key]
+
+    def acquire(self) -> Optional[int]:
+        """
+        Take a token for logging an entry, refilling the bucket at per_minute tokens per minute.
+        Returns the number of entries suppressed since the last one logged, or None if this one should be too.
+        """
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(
+                self.per_minute,
+                self._tokens + (now - self._refilled) * self.per_minute / 60,
+            )
+            self._refilled = now
+            if self._tokens < 1:
+                self.suppressed += 1
+                return None
+            self._tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+
+def explain(engine: Engine, statement: str, parameters: Any) -> Dict[str, Any]:
+    """The EXPLAIN FORMAT=JSON plan of a statement"""
+    _explaining.active = True
+    try:
+        with engine.connect() as explain_conn:
+            plan = explain_conn.exec_driver_sql(
+                f"EXPLAIN FORMAT=JSON {statement}", parameters
+            ).scalar()
+        return json.loads(plan)
+    finally:
+        _explaining.active = False
+
+
+def redact(parameters: Any) -> Any:
+    """Bound parameters with strings replaced by their length, and only the first LOGGED_ROWS of an executemany"""
+    if isinstance(parameters, str):
+        return f"<{len(parameters)} characters>"
+    if isinstance(parameters, bytes):
+        return f"<{len(parameters)} bytes>"
+    if isinstance(parameters, dict):
+        return {key: redact(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        redacted = [redact(value) for value in parameters[:LOGGED_ROWS]]
+        if len(parameters) > LOGGED_ROWS:
+            redacted.append(f"<{len(parameters) - LOGGED_ROWS} more>")
+        return redacted
+    return parameters
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("slow_query_start", []).append(perf_counter())
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # after_cursor_execute doesn't fire for a failed statement
+    if context.cursor is not None and context.connection is not None:
+        starts = context.connection.info.get("slow_query_start")
+        if starts:
+            starts.pop()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = perf_counter() - conn.info["slow_query_start"].pop()
+    if getattr(_explaining, "active", False) or not has_app_context():
+        return
+    slow_query_log = current_app.extensions.get("slow_queries")
+    if slow_query_log is None or duration < slow_query_log.threshold:
+        return
+    suppressed = slow_query_log.acquire()
+    if suppressed is None:
+        return
+
+    entry = {
+        "duration": round(duration, 6),
+        "endpoint": request.endpoint if has_request_context() else None,
+        # without the query string, whose values include codenames
+        "path": request.path if has_request_context() else None,
+        "statement": statement,
+        "parameters": redact(parameters),
+        "executemany": executemany,
+    }
+    if suppressed:
+        entry["suppressed"] = suppressed
+    if (
+        conn.dialect.name == "mysql"
+        and not executemany
+        and statement.lstrip().upper().startswith(EXPLAINABLE)
+    ):
+        try:
+            entry["plan"] = explain(
+                slow_query_log.explain_engine(conn.engine), statement, parameters
+            )
+        except Exception as err:
+            entry["explain_error"] = str(err)
+    logger.warning(json.dumps(entry, default=str))
+
+
+def init_app(app: Flask) -> None:
+    app.extensions["slow_queries"] = SlowQueryLog(
+        app.config["SLOW_QUERY_SECONDS"], app.config["SLOW_QUERY_LOG_PER_MINUTE"]
+    )
@@ -0,0 +1,160 @@
+"""
+Per-endpoint SQL metrics for Prometheus
+
+prometheus_flask_exporter only measures HTTP latency, which doesn't say whether an endpoint is slow because of the
+database. Every statement executed during a request is tallied on the request by engine events, and the totals are
+observed when the request is torn down (after a streamed response has finished), labelled by Flask endpoint so the
+blueprint is visible, e.g. datasets.list_datasets.
+
+Checking out a connection is timed by TimedQueuePool, which also exports how many connections each worker's pool
+has handed out relative to its capacity. The metrics are module level so they are registered once per process, and
+work in gunicorn's multiprocess mode when PROMETHEUS_MULTIPROC_DIR is set like the rest of the exported metrics.
+"""
+
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+from flask import Flask, has_request_context, request
+from prometheus_client import Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+SQL_STATEMENTS = Histogram(
+    "stager_sql_statements_per_request",
+    "Number of SQL statements executed for a request",
+    ["endpoint"],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, float("inf")),
+)
+SQL_SECONDS = Histogram(
+    "stager_sql_seconds_per_request",
+    "Time spent executing SQL statements for a request",
+    ["endpoint"],
+)
+SQL_ROWS = Histogram(
+    "stager_sql_rows_per_request",
+    "Number of rows returned by the SQL statements of a request",
+    ["endpoint"],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000, float("inf")),
+)
+POOL_CHECKOUT_SECONDS = Histogram(
+    "stager_sql_pool_checkout_seconds",
+    "Time waited to check out a connection from the pool, including connecting if the pool overflows",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, float("inf")),
+)
+POOL_CHECKED_OUT = Gauge(
+    "stager_sql_pool_checked_out",
+    "Connections currently checked out of the pools",
+    multiprocess_mode="livesum",
+)
+POOL_SATURATION = Gauge(
+    "stager_sql_pool_saturation",
+    "Fraction of the pool size and overflow currently checked out, per worker",
+    multiprocess_mode="liveall",
+)
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that measures how long checkouts wait for a connection and how saturated the pool is.
+    SQLAlchemy's pool events only fire once a connection has been obtained, so the wait is timed here instead.
+    """
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_SECONDS.observe(perf_counter() - start)
+            self._observe_usage()
+
+    def _do_return_conn(self, conn):
+        try:
+            super()._do_return_conn(conn)
+        finally:
+            self._observe_usage()
+
+    def _observe_usage(self):
+        checked_out = self.checkedout()
+        # a negative max_overflow means no limit, so only the pool size is meaningful
+        capacity = self.size() + max(self._max_overflow, 0)
+        POOL_CHECKED_OUT.set(checked_out)
+        POOL_SATURATION.set(checked_out / capacity if capacity else 0)
+
+
+class _Tally:
+    __slots__ = ("statements", "seconds", "rows", "log")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.rows = 0
+        # (statement, seconds) of each statement if they're being recorded
+        self.log: Optional[List[Tuple[str, float]]] = None
+
+
+def _request_tally() -> _Tally:
+    tally = getattr(request, "sql_tally", None)
+    if tally is None:
+        tally = request.sql_tally = _Tally()
+    return tally
+
+
+def record_statements() -> List[Tuple[str, float]]:
+    """Record each statement the rest of this request executes, with its duration, in the returned list"""
+    tally = _request_tally()
+    tally.log = []
+    return tally.log
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("sql_metrics_start", []).append(perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = perf_counter() - conn.info["sql_metrics_start"].pop()
+    # statements outside of a request, e.g. scheduled jobs and Click commands, aren't attributed to an endpoint
+    if not has_request_context():
+        return
+    tally = _request_tally()
+    tally.statements += 1
+    tally.seconds += duration
+    if tally.log is not None:
+        tally.log.append((statement, duration))
+    # rowcount of a buffered SELECT is the number of rows fetched, but it isn't known yet when streaming
+    if (
+        cursor.description is not None
+        and cursor.rowcount > 0
+        and not (context and context.execution_options.get("stream_results"))
+    ):
+        tally.rows += cursor.rowcount
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # after_cursor_execute doesn't fire for a failed statement
+    if context.cursor is not None and context.connection is not None:
+        starts = context.connection.info.get("sql_metrics_start")
+        if starts:
+            starts.pop()
+
+
+def _observe_request(exc=None):
+    tally = getattr(request, "sql_tally", None)
+    if tally is None:
+        return
+    endpoint = request.endpoint or "none"
+    SQL_STATEMENTS.labels(endpoint).observe(tally.statements)
+    SQL_SECONDS.labels(endpoint).observe(tally.seconds)
+    SQL_ROWS.labels(endpoint).observe(tally.rows)
+
+
+def init_app(app: Flask) -> None:
+    """Observe the SQL tally of each request, and time connection checkouts unless another pool was configured"""
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "poolclass": TimedQueuePool,
+        **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+    }
+    app.teardown_request(_observe_request)
@@ -14,8 +14,13 @@ from requests import Session
 from slurm_rest import Configuration, ApiClient
 from slurm_rest.apis import SlurmApi
 
+from . import profiling, report_cache, sql_metrics
 from .login import StagerLoginManager
-from .tasks import send_email_notification
+from .tasks import (
+    run_bulk_upload_jobs,
+    run_summary_report_jobs,
+    send_email_notification,
+)
 from .utils import DateTimeEncoder
 from .slurm import poll_slurm
 
@@ -32,6 +37,8 @@ class Stager(Flask):
     def __init__(self, config, db: SQLAlchemy, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.config.from_object(config)
+        # kept so that processes started by the scheduler can create their own app, see tasks.py
+        self.config_object = config
         # Configures Flask's logger and customize. N.B.: logging modules conflict in name
         flask_logging.create_logger(self)
         # %(asctime)s may be useful is redundant with Docker timestamps and production journald
@@ -40,6 +47,8 @@ class Stager(Flask):
         )
         # Initialize extensions
         db.init_app(self)
+        sql_metrics.init_app(self)
+        report_cache.init_app(self)
         self.migrate = Migrate(self, db, compare_type=True)
         # The rest are not required for Click commands, but required for routes, shell, tests, etc.
         self.oauth = OAuth(self)
@@ -87,6 +96,12 @@ class Stager(Flask):
             self.before_first_request(self.start_scheduler)
         # in production, a gunicorn hook will start the scheduler
 
+    def dispatch_request(self):
+        # Admins can profile any request, see profiling.py
+        if profiling.requested():
+            return profiling.profile(super().dispatch_request)
+        return super().dispatch_request()
+
     def start_scheduler(self):
         # If this setup of when the scheduler can be started becomes too confusing
         # or cumbersome, it can be separated to be started by a completely different
@@ -107,6 +122,20 @@ class Stager(Flask):
             # its own API Schema (e.g. job response properties .array_job_id)
             self.extensions["slurm-requests"] = Session()
             self.scheduler.add_job(poll_slurm, "interval", [self], minutes=2)
+        if self.config["BULK_JOB_POLL_SECONDS"]:
+            self.scheduler.add_job(
+                run_bulk_upload_jobs,
+                "interval",
+                [self],
+                seconds=self.config["BULK_JOB_POLL_SECONDS"],
+            )
+        if self.config["REPORT_JOB_POLL_SECONDS"]:
+            self.scheduler.add_job(
+                run_summary_report_jobs,
+                "interval",
+                [self],
+                seconds=self.config["REPORT_JOB_POLL_SECONDS"],
+            )
         self.scheduler.start()
         if self.env == "development":
             # in production, a gunicorn exit hook will take care of this
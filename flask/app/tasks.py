@@ -1,11 +1,30 @@
 import json
 import os
 from datetime import datetime, timedelta
+from enum import Enum
+from io import BytesIO
+from multiprocessing import get_context
+from typing import Callable, Type
 
-from sqlalchemy.orm import joinedload
+from flask import Flask
+from sqlalchemy import select, update
+from sqlalchemy.orm import InstrumentedAttribute, joinedload
+from werkzeug.exceptions import HTTPException
 
 from . import models
+from .blueprints.misc import insert_bulk_rows
+from .blueprints.variants import (
+    REPORT_JOB_FORMATS,
+    get_report_bytes,
+    get_summary_query,
+    parse_requested_filter,
+)
 from .email import send_email
+from .models import db
+from .utils import get_minio_client
+
+# How often a running asynchronous bulk upload records its progress, in rows
+BULK_PROGRESS_ROWS = 100
 
 
 def send_email_notification(app):
@@ -65,3 +84,236 @@ def send_email_notification(app):
         app.logger.debug(
             f"{len(email_analyses)} analysis requests found... {json.dumps(email_analyses)}"
         )
+
+
+def run_queued_jobs(
+    app: Flask,
+    job_id_column: InstrumentedAttribute,
+    status: Type[Enum],
+    run_job: Callable[[Flask, int], None],
+) -> None:
+    """
+    Runs the queued jobs of the job model with the given id column, oldest first, with run_job(app, job_id). Each job is claimed by moving it from
+    Queued to Running in its own transaction, so that it runs only once.
+
+    Jobs that have been Running for longer than JOB_TIMEOUT_SECONDS were interrupted, eg. by a crash or restart, and
+    are marked as failed first. They are not requeued, as running them again could crash the same way.
+    """
+    model = job_id_column.class_
+    with app.app_context():
+        stale = db.session.execute(
+            update(model)
+            .where(
+                model.status == status.Running,
+                model.started
+                < datetime.utcnow()
+                - timedelta(seconds=app.config["JOB_TIMEOUT_SECONDS"]),
+            )
+            .values(
+                status=status.Error,
+                errors=["The job was interrupted before it finished"],
+                finished=datetime.utcnow(),
+            )
+        ).rowcount
+        db.session.commit()
+        if stale:
+            app.logger.warning(
+                "Marked %s interrupted %s as failed", stale, model.__tablename__
+            )
+
+        while True:
+            job_id = db.session.execute(
+                select(job_id_column)
+                .where(model.status == status.Queued)
+                .order_by(job_id_column)
+                .limit(1)
+            ).scalar()
+            if job_id is None:
+                return
+            claimed = db.session.execute(
+                update(model)
+                .where(job_id_column == job_id, model.status == status.Queued)
+                .values(status=status.Running, started=datetime.utcnow())
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                run_job(app, job_id)
+
+
+def run_bulk_upload_jobs(app):
+    """
+    Runs the queued asynchronous bulk uploads, oldest first.
+    """
+    run_queued_jobs(
+        app,
+        models.BulkUploadJob.bulk_upload_job_id,
+        models.BulkUploadStatus,
+        run_bulk_upload_job,
+    )
+
+
+def run_bulk_upload_job(app, job_id: int):
+    """
+    Inserts the rows of a claimed bulk upload job in one transaction, together with the job's result.
+    Progress is written through a separate connection so that it is visible while the upload is uncommitted.
+    """
+    job = models.BulkUploadJob.query.get(job_id)
+    app.logger.info("Running bulk upload job %s with %s rows", job_id, job.rows_total)
+    groups = models.Group.query.filter(models.Group.group_id.in_(job.group_ids)).all()
+
+    def progress(rows_processed: int):
+        if rows_processed % BULK_PROGRESS_ROWS == 0:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    update(models.BulkUploadJob)
+                    .where(models.BulkUploadJob.bulk_upload_job_id == job_id)
+                    .values(rows_processed=rows_processed)
+                )
+
+    try:
+        dataset_ids = insert_bulk_rows(
+            job.rows,
+            groups,
+            job.created_by_id,
+            job.created_by_id,
+            job.content_type,
+            progress,
+        )
+        job.status = models.BulkUploadStatus.Done
+        job.rows_processed = job.rows_total
+        job.dataset_ids = dataset_ids
+        job.finished = datetime.utcnow()
+        db.session.commit()
+        app.logger.info(
+            "Bulk upload job %s added %s datasets", job_id, len(dataset_ids)
+        )
+        return
+    except HTTPException as err:
+        # the same errors a synchronous upload would have responded with
+        errors = [err.description]
+    except Exception as err:
+        app.logger.exception("Bulk upload job %s failed", job_id)
+        errors = [str(err)]
+
+    db.session.rollback()
+    job = models.BulkUploadJob.query.get(job_id)
+    job.status = models.BulkUploadStatus.Error
+    job.errors = errors
+    job.finished = datetime.utcnow()
+    db.session.commit()
+
+
+def run_summary_report_jobs(app):
+    """
+    Runs the queued summary report jobs, oldest first, each in a process of its own.
+    """
+    run_queued_jobs(
+        app,
+        models.SummaryReportJob.summary_report_job_id,
+        models.SummaryReportStatus,
+        run_summary_report_process,
+    )
+
+
+def run_summary_report_process(app, job_id: int):
+    """
+    Runs a claimed summary report job in a new process and waits for it.
+
+    The scheduler runs in the gunicorn master, and reports are aggregated in memory, so a large one running there
+    could get the master, and every worker with it, killed for running out of memory. The process is spawned rather
+    than forked from the master and its scheduler threads, and creates an app of its own. If it dies or runs for
+    longer than JOB_TIMEOUT_SECONDS, the job is marked as failed here.
+    """
+    process = get_context("spawn").Process(
+        target=summary_report_process_main,
+        args=(app.config_object, job_id),
+        name=f"summary-report-{job_id}",
+    )
+    process.start()
+    process.join(app.config["JOB_TIMEOUT_SECONDS"])
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        error = "The report took too long to build"
+    elif process.exitcode != 0:
+        error = f"The report process exited with code {process.exitcode}"
+    else:
+        return
+    app.logger.error("Summary report job %s failed: %s", job_id, error)
+    db.session.execute(
+        update(models.SummaryReportJob)
+        .where(
+            models.SummaryReportJob.summary_report_job_id == job_id,
+            models.SummaryReportJob.status == models.SummaryReportStatus.Running,
+        )
+        .values(
+            status=models.SummaryReportStatus.Error,
+            errors=[error],
+            finished=datetime.utcnow(),
+        )
+    )
+    db.session.commit()
+
+
+def summary_report_process_main(config, job_id: int):
+    # imported here since the app package imports this module
+    from . import create_app
+
+    app = create_app(config)
+    with app.app_context():
+        run_summary_report_job(app, job_id)
+
+
+def run_summary_report_job(app, job_id: int):
+    """
+    Builds the report of a claimed job, as its creator would have seen it from GET /api/summary/<type>,
+    and writes it to the results bucket of the job's group.
+    """
+    job = models.SummaryReportJob.query.get(job_id)
+    app.logger.info(
+        "Running %s summary report job %s for %s", job.type, job_id, job.search_type
+    )
+    try:
+        user = models.User.query.get(job.created_by_id)
+        query = get_summary_query(
+            parse_requested_filter(job.search_type, job.search), user
+        )
+        mimetype = REPORT_JOB_FORMATS[job.format]
+        data = get_report_bytes(query, job.type, mimetype, job.columns)
+        bucket = f"results-{job.group.group_code}"
+        object_name = (
+            f"summary-reports/{job_id}-{job.type[:-1]}_wise_report.{job.format}"
+        )
+        # end the read transaction rather than keep it open during the upload
+        db.session.rollback()
+        get_minio_client().put_object(
+            bucket,
+            object_name,
+            BytesIO(data),
+            len(data),
+            content_type=mimetype,
+        )
+        job.status = models.SummaryReportStatus.Done
+        job.object_name = object_name
+        job.finished = datetime.utcnow()
+        db.session.commit()
+        app.logger.info(
+            "Summary report job %s wrote %s bytes to %s",
+            job_id,
+            len(data),
+            object_name,
+        )
+        return
+    except HTTPException as err:
+        # the same errors a synchronous report would have responded with
+        errors = [err.description]
+    except Exception as err:
+        app.logger.exception("Summary report job %s failed", job_id)
+        errors = [str(err)]
+
+    db.session.rollback()
+    job = models.SummaryReportJob.query.get(job_id)
+    job.status = models.SummaryReportStatus.Error
+    job.errors = errors
+    job.finished = datetime.utcnow()
+    db.session.commit()
@@ -1,32 +1,65 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
 from csv import DictWriter, QUOTE_MINIMAL
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass
 from datetime import date, datetime, time
 from enum import Enum
 from functools import wraps
-from io import BytesIO, StringIO
+from io import StringIO
+import json
 from os import getenv
-from typing import Any, Callable, Dict, List, Union, Iterable, Mapping
+from threading import Lock
+from time import monotonic
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Tuple,
+    Union,
+    Iterable,
+    Iterator,
+    Mapping,
+    Optional,
+    Set,
+)
 
 from flask import (
     abort,
+    after_this_request,
     current_app as app,
     jsonify,
     request,
     Request,
-    send_file,
+    Response,
+    stream_with_context,
 )
 from flask.json import JSONEncoder
 from flask_login import current_user
 from flask_sqlalchemy import Model
 from flask_sqlalchemy.model import DefaultMeta
 from minio import Minio
-from sqlalchemy import exc, inspect, select
+from sqlalchemy import (
+    and_,
+    asc,
+    case,
+    desc,
+    distinct,
+    exc,
+    func,
+    inspect,
+    or_,
+    select,
+)
 from sqlalchemy.orm.query import Query
-from sqlalchemy.sql.sqltypes import Enum as SqlAlchemyEnum
+from sqlalchemy.sql.expression import ColumnElement, Select
+from sqlalchemy.sql.sqltypes import Date, DateTime, Enum as SqlAlchemyEnum
 from werkzeug.exceptions import HTTPException
 
+from .generations import get_generation
 from .madmin import MinioAdmin
-from .models import db, User, Group, Dataset
+from .models import db, User, Dataset, user_dataset_visibility_table
+from .serializers import json_response, to_dict
 
 
 def str_to_bool(param: str) -> bool:
@@ -252,40 +285,318 @@ def get_minio_client() -> Minio:
     )
 
 
+def iter_csv(
+    results: Iterable[Union[Dict[str, Any], Model]],
+    colnames: List[str] = None,
+    chunk_rows: int = 1000,
+) -> Iterator[str]:
+    """
+    Yields a csv of models or mappings chunk_rows rows at a time, so that it can be written out as it's built.
+    The header is colnames if given, otherwise the keys of the first row.
+    """
+    csv_data = StringIO()
+    writer = None
+    for i, row in enumerate(results, 1):
+        if not isinstance(row, Mapping):
+            row = to_dict(row)
+        if writer is None:
+            writer = DictWriter(
+                csv_data,
+                fieldnames=colnames or row.keys(),
+                quoting=QUOTE_MINIMAL,
+            )
+            writer.writeheader()
+        writer.writerow(row)
+        if i % chunk_rows == 0:
+            yield csv_data.getvalue()
+            csv_data.seek(0)
+            csv_data.truncate()
+    # no rows, but the csv should still have a header if we know it
+    if writer is None and colnames:
+        DictWriter(csv_data, fieldnames=colnames).writeheader()
+    if csv_data.tell():
+        yield csv_data.getvalue()
+
+
 def query_results_to_csv(results: List[dict or dataclass]):
     """take a list of models and convert to csv"""
-    is_dict = isinstance(results[0], dict)
+    return "".join(iter_csv(results))
 
-    if not is_dict:
-        results = [asdict(result) for result in results]
 
-    colnames = results[0].keys()
+def stream_query(query: Query) -> Iterator[Model]:
+    """
+    Yields the entities of an ORM query REPORT_CHUNK_SIZE at a time, for responses that are written out as they're built.
 
-    csv_data = StringIO()
-    writer = DictWriter(
-        csv_data,
-        fieldnames=colnames,
-        quoting=QUOTE_MINIMAL,
+    The driver still buffers the raw rows, since lazy loads need the connection while the results are being read,
+    but the ORM instances and anything made from them only exist a chunk at a time. Consecutive duplicates of an
+    entity, from joins against a collection that isn't eagerly loaded, are skipped.
+    """
+    previous = None
+    try:
+        for instance in query.yield_per(
+            app.config["REPORT_CHUNK_SIZE"]
+        ).execution_options(stream_results=False):
+            if instance is not previous:
+                yield instance
+            previous = instance
+    finally:
+        # the response outlives the view, whose session may have already been removed
+        query.session.close()
+
+
+def paginated_response(
+    results: List[Any],
+    page: int,
+    total: int,
+    limit: int = None,
+    next_cursor: Union[str, None, bool] = False,
+):
+    response = {
+        "data": results,
+        "page": page if limit else 0,
+        "total_count": total,
+    }
+    # only present when paginating with ?cursor=, null on the last page
+    if next_cursor is not False:
+        response["next_cursor"] = next_cursor
+    return json_response(response)
+
+
+def get_fields(available: Iterable[str]) -> Optional[Set[str]]:
+    """
+    Parses ?fields=, a comma separated subset of the keys of each result, for callers that only need a few of them.
+    Returns None if unspecified, meaning every key. Endpoints also skip loading whatever isn't requested.
+    """
+    fields = request.args.get("fields", type=str)
+    if not fields:
+        return None
+    fields = {field.strip() for field in fields.split(",")}
+    if not fields <= set(available):
+        abort(400, description=f"fields must be among {sorted(available)}")
+    return fields
+
+
+def wants(fields: Optional[Set[str]], *keys: str) -> bool:
+    """whether any of the keys are requested by ?fields="""
+    return fields is None or not fields.isdisjoint(keys)
+
+
+def sparse_dict(
+    instance: Model,
+    getters: Mapping[str, Callable[[Model], Any]],
+    fields: Optional[Set[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Serializes a model and the values of the getters under their keys, which replace any of its own fields.
+    Only the requested fields are included, and the others are never read, so they aren't lazily loaded either.
+    """
+    result = to_dict(instance, fields)
+    for key, getter in getters.items():
+        if fields is None or key in fields:
+            result[key] = getter(instance)
+    return result
+
+
+# Query parameters that don't change which rows are counted
+UNCOUNTED_ARGS = {"page", "limit", "cursor", "order_by", "order_dir", "count", "user"}
+
+
+class CountCache:
+    """
+    Per-process cache of the total_count of the paged list endpoints, keyed by the endpoint, its filters and the user's
+    groups. Counts are stamped with the shared metadata generation they were counted in, so a write committed by any
+    worker makes them stale, as does being COUNT_CACHE_SECONDS old.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(
+        self, key: Tuple, generation: Optional[int] = None, max_age: float = None
+    ) -> Union[int, None]:
+        """
+        The cached count, or None if there is none or, given the current generation and max_age, it is stale
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            count, counted_generation, counted = entry
+            if max_age is not None and (
+                generation is None
+                or counted_generation != generation
+                or monotonic() - counted > max_age
+            ):
+                return None
+            return count
+
+    def set(self, key: Tuple, count: int, generation: Optional[int]) -> None:
+        with self.lock:
+            self.entries[key] = (count, generation, monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+count_cache = CountCache()
+
+
+def get_total_count(query: Query, primary_key: ColumnElement, user: User):
+    """
+    The total_count of a paged list endpoint, the number of distinct primary keys in its query, according to ?count=
+    - unspecified: a fresh cached count for the same filters and user groups, otherwise counted and cached
+    - exact: always counted
+    - estimate: the cached count however stale, for when the UI only needs an approximation. Otherwise null, and the
+      count is cached once the response has been sent, for the next request
+    - none: null, skipping the count entirely
+    """
+    mode = request.args.get("count", type=str) or None
+    if mode not in [None, "exact", "estimate", "none"]:
+        abort(400, description="count must be one of 'exact', 'estimate' or 'none'")
+    if mode == "none":
+        return None
+
+    key = (
+        request.path,
+        tuple(
+            sorted(
+                (arg, value)
+                for arg, value in request.args.items(multi=True)
+                if arg not in UNCOUNTED_ARGS
+            )
+        ),
+        "admin"
+        if user.is_admin
+        else tuple(sorted(group.group_id for group in user.groups)),
     )
-    writer.writeheader()
-    for row in results:
-        if isinstance(row, Model):
-            row = asdict(row)
-        writer.writerow(row)
+    generation = get_generation("metadata")
+    if mode is None:
+        count = count_cache.get(key, generation, app.config["COUNT_CACHE_SECONDS"])
+    elif mode == "estimate":
+        count = count_cache.get(key)
+    else:
+        count = None
+    if count is not None:
+        return count
 
-    return csv_data.getvalue()
+    statement = query.with_entities(func.count(distinct(primary_key)))
+    if mode == "estimate":
+        count_after_response(statement.statement, key, generation)
+        return None
+    count = statement.scalar()
+    count_cache.set(key, count, generation)
+    return count
 
 
-def paginated_response(results: List[Any], page: int, total: int, limit: int = None):
-    return jsonify(
-        {
-            "data": results,
-            "page": page if limit else 0,
-            "total_count": total,
-        }
+def count_after_response(statement: Select, key: Tuple, generation: Optional[int]):
+    """Caches the count of the statement once the response has been sent, on a connection of its own"""
+    flask_app = app._get_current_object()
+    engine = db.engine
+
+    def count() -> None:
+        try:
+            with engine.connect() as connection:
+                count_cache.set(key, connection.execute(statement).scalar(), generation)
+        except Exception:
+            flask_app.logger.warning("Could not count %s", key[0], exc_info=True)
+
+    @after_this_request
+    def count_on_close(response: Response) -> Response:
+        response.call_on_close(count)
+        return response
+
+
+def encode_cursor(values: List[Any]) -> str:
+    return urlsafe_b64encode(json.dumps(values, cls=DateTimeEncoder).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        return json.loads(urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        abort(400, description="Invalid cursor")
+
+
+def enum_position(column: ColumnElement) -> ColumnElement:
+    """
+    The 1-based position of an enum column's value in the enum's definition, which is how MySQL sorts enums,
+    as opposed to comparing them, which it does by name.
+    """
+    return case(
+        {name: position for position, name in enumerate(column.type.enums, 1)},
+        value=column,
     )
 
 
+def keyset_page(
+    query: Query,
+    order: ColumnElement,
+    primary_key: ColumnElement,
+    descending: bool,
+    limit: int = None,
+) -> Tuple[List[Any], Union[str, None]]:
+    """
+    Cursor pagination for ?cursor=, an alternative to the page/limit offsets of @paged.
+
+    Rows are ordered by (order, primary_key), and the cursor holds the values of the last row of the previous page,
+    so the next page is found by seeking past them rather than by reading through every previous row, and rows that
+    tie in order keep a stable position between pages. An empty cursor requests the first page.
+    Returns the page and the cursor of the next page, None if this is the last one.
+    """
+    # seek on the position that enums are sorted by, so that pages are in the same order as with offsets
+    if isinstance(order.type, SqlAlchemyEnum):
+        order = enum_position(order)
+    # cursors are only valid for the ordering they were made for
+    ordering = [request.args.get("order_by"), request.args.get("order_dir")]
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        cursor = decode_cursor(cursor)
+        if not isinstance(cursor, list) or len(cursor) != 4 or cursor[:2] != ordering:
+            abort(400, description="cursor does not match order_by and order_dir")
+        value, last_id = cursor[2:]
+        try:
+            if value is not None and isinstance(order.type, DateTime):
+                value = datetime.fromisoformat(value)
+            elif value is not None and isinstance(order.type, Date):
+                value = date.fromisoformat(value)
+        except (TypeError, ValueError):
+            abort(400, description="Invalid cursor")
+        # MySQL sorts NULLs first in ascending order and last in descending order
+        if descending:
+            after = (
+                and_(order == None, primary_key < last_id)
+                if value is None
+                else or_(
+                    order < value,
+                    and_(order == value, primary_key < last_id),
+                    order == None,
+                )
+            )
+        else:
+            after = (
+                or_(and_(order == None, primary_key > last_id), order != None)
+                if value is None
+                else or_(order > value, and_(order == value, primary_key > last_id))
+            )
+        query = query.filter(after)
+
+    direction = desc if descending else asc
+    rows = (
+        query.add_columns(order, primary_key)
+        .order_by(direction(order), direction(primary_key))
+        .limit(limit and limit + 1)
+        .all()
+    )
+    if limit is None or len(rows) <= limit:
+        return [row[0] for row in rows], None
+    rows = rows[:limit]
+    return [row[0] for row in rows], encode_cursor(ordering + list(rows[-1][1:]))
+
+
 def update_last_login(user: User = None):
     """
     Update last login for given user and return login details.
@@ -314,28 +625,27 @@ def update_last_login(user: User = None):
 
 
 def csv_response(
-    results: List[Dict[str, Any]] or List[Model],
+    results: Iterable[Dict[str, Any]] or Iterable[Model],
     filename: str = "report",
     colnames: List[str] = None,
 ):
-    """create a csv HTTP response from a list of query results or mapping"""
+    """create a streamed csv HTTP response from query results or mappings, which may be a generator"""
 
     if colnames:
         results = filter_keys_and_reorder(results, colnames)
 
-    csv = query_results_to_csv(results)
-
-    return send_file(
-        BytesIO(csv.encode("utf-8")),
-        "text/csv",
-        as_attachment=True,
-        download_name=filename,
+    response = Response(
+        stream_with_context(iter_csv(results, colnames)), mimetype="text/csv"
     )
+    response.headers.set("Content-Disposition", "attachment", filename=filename)
+    return response
 
 
-def filter_keys_and_reorder(data: List[Dict[str, Any]] or List[Model], keys: List[str]):
-    """filter list item mappings and key order according to list of keys"""
-    return [{key: row[key] for key in keys} for row in data]
+def filter_keys_and_reorder(
+    data: Iterable[Dict[str, Any]], keys: List[str]
+) -> Iterator[Dict[str, Any]]:
+    """filter item mappings and key order according to list of keys, as they are consumed"""
+    return ({key: row[key] for key in keys} for row in data)
 
 
 def expects_json(req: Request):
@@ -346,6 +656,10 @@ def expects_csv(req: Request):
     return "text/csv" in req.accept_mimetypes
 
 
+def expects_ndjson(req: Request):
+    return "application/x-ndjson" in req.accept_mimetypes
+
+
 # https://stackoverflow.com/a/55991358
 def clone_entity(model_object, **kwargs):
     """
@@ -414,18 +728,10 @@ def filter_datasets_by_user_groups(query: Query, user: User):
     attach a subquery that removes datasets that don't share groups with the user
     this function assumes that the query already includes a selection for models.Dataset
     """
-    user_group_subquery = (
-        Group.query.join(Group.users)
-        .filter(User.user_id == user.user_id)
-        .with_entities(Group.group_id)
-        .subquery()
-    )
-
-    dataset_subquery = (
-        Dataset.query.join(Dataset.groups)
-        .filter(Group.group_id.in_(select(user_group_subquery.c.group_id)))
-        .with_entities(Dataset.dataset_id)
-        .subquery()
+    return query.filter(
+        Dataset.dataset_id.in_(
+            select(user_dataset_visibility_table.c.dataset_id).where(
+                user_dataset_visibility_table.c.user_id == user.user_id
+            )
+        )
     )
-
-    return query.filter(Dataset.dataset_id.in_(select(dataset_subquery.c.dataset_id)))
@@ -0,0 +1,55 @@
+"""Add variant_rsid table
+
+Revision ID: 22526e373f41
+Revises: aa2217f05e7f
+Create Date: 2026-10-18 11:48:20.553901
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "22526e373f41"
+down_revision = "aa2217f05e7f"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    variant_rsid = op.create_table(
+        "variant_rsid",
+        sa.Column("variant_id", sa.Integer(), nullable=False),
+        sa.Column("rsid", sa.String(length=20), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["variant_id"], ["variant.variant_id"], ondelete="cascade"
+        ),
+        sa.PrimaryKeyConstraint("variant_id", "rsid"),
+    )
+    op.create_index("variant_rsid_rsid_IDX", "variant_rsid", ["rsid"])
+
+    # Backfill from the comma delimited variant.rsids, same as mapping_utils.split_rsids
+    rsid_pattern = re.compile(r"^rs\d+$")
+    connection = op.get_bind()
+    result = connection.execute(
+        sa.text("SELECT variant_id, rsids FROM variant WHERE rsids IS NOT NULL")
+    )
+    while True:
+        batch = result.fetchmany(10000)
+        if not batch:
+            break
+        rows = [
+            {"variant_id": variant_id, "rsid": rsid}
+            for variant_id, rsids in batch
+            for rsid in {token.strip().lower() for token in rsids.split(",")}
+            if rsid_pattern.match(rsid)
+        ]
+        if rows:
+            op.bulk_insert(variant_rsid, rows)
+
+
+def downgrade():
+    op.drop_index("variant_rsid_rsid_IDX", "variant_rsid")
+    op.drop_table("variant_rsid")
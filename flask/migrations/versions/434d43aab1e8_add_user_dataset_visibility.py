@@ -0,0 +1,49 @@
+"""Add user_dataset_visibility
+
+Revision ID: 434d43aab1e8
+Revises: b27c49cff1e5
+Create Date: 2026-10-18 15:41:06.581270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "434d43aab1e8"
+down_revision = "b27c49cff1e5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "user_dataset_visibility",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("dataset_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["user.user_id"], ondelete="cascade"),
+        sa.ForeignKeyConstraint(
+            ["dataset_id"], ["dataset.dataset_id"], ondelete="cascade"
+        ),
+        sa.PrimaryKeyConstraint("user_id", "dataset_id"),
+    )
+    op.create_index(
+        "user_dataset_visibility_dataset_id_IDX",
+        "user_dataset_visibility",
+        ["dataset_id"],
+    )
+    # same as models.refresh_dataset_visibility
+    op.execute(
+        """
+        INSERT IGNORE INTO user_dataset_visibility (user_id, dataset_id)
+        SELECT DISTINCT users_groups.user_id, groups_datasets.dataset_id
+        FROM users_groups
+        JOIN groups_datasets ON users_groups.group_id = groups_datasets.group_id
+        WHERE users_groups.user_id IS NOT NULL AND groups_datasets.dataset_id IS NOT NULL
+        """
+    )
+
+
+def downgrade():
+    op.drop_index("user_dataset_visibility_dataset_id_IDX", "user_dataset_visibility")
+    op.drop_table("user_dataset_visibility")
@@ -0,0 +1,44 @@
+"""Add variant_gene table
+
+Revision ID: 4949cf4f5231
+Revises: 690e68b426ca
+Create Date: 2026-10-18 10:12:31.408215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "4949cf4f5231"
+down_revision = "690e68b426ca"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "variant_gene",
+        sa.Column("variant_id", sa.Integer(), nullable=False),
+        sa.Column("ensembl_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["variant_id"], ["variant.variant_id"], ondelete="cascade"
+        ),
+        sa.ForeignKeyConstraint(
+            ["ensembl_id"], ["gene.ensembl_id"], onupdate="cascade", ondelete="cascade"
+        ),
+        sa.PrimaryKeyConstraint("variant_id", "ensembl_id"),
+    )
+    op.create_index("variant_gene_ensembl_id_IDX", "variant_gene", ["ensembl_id"])
+    # Backfill existing variants, equivalent to `flask map-variants-genes`
+    op.execute(
+        "INSERT INTO variant_gene (variant_id, ensembl_id) "
+        "SELECT variant.variant_id, gene.ensembl_id FROM variant "
+        "JOIN gene ON gene.chromosome = variant.chromosome "
+        "AND gene.start <= variant.position AND variant.position <= gene.end"
+    )
+
+
+def downgrade():
+    op.drop_index("variant_gene_ensembl_id_IDX", "variant_gene")
+    op.drop_table("variant_gene")
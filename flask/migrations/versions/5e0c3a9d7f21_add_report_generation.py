@@ -0,0 +1,31 @@
+"""Add report_generation
+
+Revision ID: 5e0c3a9d7f21
+Revises: 434d43aab1e8
+Create Date: 2026-10-18 17:02:44.118209
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5e0c3a9d7f21"
+down_revision = "434d43aab1e8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    report_generation = op.create_table(
+        "report_generation",
+        sa.Column("report_generation_id", sa.Integer(), nullable=False),
+        sa.Column("generation", sa.BigInteger(), server_default="0", nullable=False),
+        sa.PrimaryKeyConstraint("report_generation_id"),
+    )
+    # the single row read and bumped by report_cache.py
+    op.bulk_insert(report_generation, [{"report_generation_id": 1, "generation": 0}])
+
+
+def downgrade():
+    op.drop_table("report_generation")
@@ -0,0 +1,37 @@
+"""Add ingested_report manifest
+
+Revision ID: 97b34f104180
+Revises: 22526e373f41
+Create Date: 2026-10-18 13:26:09.734512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "97b34f104180"
+down_revision = "22526e373f41"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "ingested_report",
+        sa.Column("ingested_report_id", sa.Integer(), nullable=False),
+        sa.Column("path", sa.String(length=500), nullable=False),
+        sa.Column("mtime", sa.DateTime(), nullable=False),
+        sa.Column("content_hash", sa.String(length=64), nullable=False),
+        sa.Column("analysis_id", sa.Integer(), nullable=True),
+        sa.Column("ingested", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["analysis_id"], ["analysis.analysis_id"], ondelete="set null"
+        ),
+        sa.PrimaryKeyConstraint("ingested_report_id"),
+        sa.UniqueConstraint("path"),
+    )
+
+
+def downgrade():
+    op.drop_table("ingested_report")
@@ -0,0 +1,50 @@
+"""Add summary_report_job
+
+Revision ID: 9d41f6b2c8e3
+Revises: 5e0c3a9d7f21
+Create Date: 2026-10-18 17:48:12.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9d41f6b2c8e3"
+down_revision = "5e0c3a9d7f21"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "summary_report_job",
+        sa.Column("summary_report_job_id", sa.Integer(), nullable=False),
+        sa.Column(
+            "status",
+            sa.Enum("Queued", "Running", "Done", "Error", name="summaryreportstatus"),
+            nullable=False,
+        ),
+        sa.Column("type", sa.String(length=20), nullable=False),
+        sa.Column("search_type", sa.String(length=20), nullable=False),
+        sa.Column("search", sa.Text(), nullable=False),
+        sa.Column("columns", sa.Text(), nullable=True),
+        sa.Column("group_id", sa.Integer(), nullable=False),
+        sa.Column("object_name", sa.String(length=255), nullable=True),
+        sa.Column("errors", sa.JSON(), nullable=True),
+        sa.Column("created", sa.DateTime(), nullable=False),
+        sa.Column("created_by_id", sa.Integer(), nullable=False),
+        sa.Column("started", sa.DateTime(), nullable=True),
+        sa.Column("finished", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["created_by_id"], ["user.user_id"], onupdate="cascade"
+        ),
+        sa.ForeignKeyConstraint(
+            ["group_id"], ["group.group_id"], onupdate="cascade", ondelete="cascade"
+        ),
+        sa.PrimaryKeyConstraint("summary_report_job_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("summary_report_job")
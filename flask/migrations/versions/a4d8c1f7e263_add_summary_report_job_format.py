@@ -0,0 +1,27 @@
+"""Add summary_report_job format
+
+Revision ID: a4d8c1f7e263
+Revises: f2c7a9e4b358
+Create Date: 2026-10-19 15:08:37.214590
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a4d8c1f7e263"
+down_revision = "f2c7a9e4b358"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "summary_report_job",
+        sa.Column("format", sa.String(length=10), server_default="csv", nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_column("summary_report_job", "format")
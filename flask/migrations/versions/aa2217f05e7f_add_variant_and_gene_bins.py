@@ -0,0 +1,53 @@
+"""Add variant and gene bins
+
+Revision ID: aa2217f05e7f
+Revises: 4949cf4f5231
+Create Date: 2026-10-18 11:03:52.117640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "aa2217f05e7f"
+down_revision = "4949cf4f5231"
+branch_labels = None
+depends_on = None
+
+
+def bin_sql(start: str, end: str) -> str:
+    """UCSC bin of the 1-based inclusive interval [start, end], kept in sync with app/binning.py"""
+    return (
+        "CASE "
+        f"WHEN ({start} - 1) >> 17 = ({end} - 1) >> 17 THEN 585 + (({start} - 1) >> 17) "
+        f"WHEN ({start} - 1) >> 20 = ({end} - 1) >> 20 THEN 73 + (({start} - 1) >> 20) "
+        f"WHEN ({start} - 1) >> 23 = ({end} - 1) >> 23 THEN 9 + (({start} - 1) >> 23) "
+        f"WHEN ({start} - 1) >> 26 = ({end} - 1) >> 26 THEN 1 + (({start} - 1) >> 26) "
+        f"ELSE ({start} - 1) >> 29 END"
+    )
+
+
+def upgrade():
+    op.add_column("gene", sa.Column("bin", sa.SmallInteger(), nullable=True))
+    op.execute(f"UPDATE gene SET bin = {bin_sql('start', '`end`')}")
+    op.create_index("gene_chromosome_bin_IDX", "gene", ["chromosome", "bin"])
+
+    op.add_column("variant", sa.Column("bin", sa.SmallInteger(), nullable=True))
+    op.execute(
+        "UPDATE variant SET bin = "
+        + bin_sql("position", "position + CHAR_LENGTH(reference_allele) - 1")
+    )
+    op.alter_column("variant", "bin", existing_type=sa.SmallInteger(), nullable=False)
+    op.create_index(
+        "variant_chromosome_bin_position_IDX",
+        "variant",
+        ["chromosome", "bin", "position"],
+    )
+
+
+def downgrade():
+    op.drop_index("variant_chromosome_bin_position_IDX", "variant")
+    op.drop_column("variant", "bin")
+    op.drop_index("gene_chromosome_bin_IDX", "gene")
+    op.drop_column("gene", "bin")
@@ -0,0 +1,47 @@
+"""Add bulk_upload_job
+
+Revision ID: b27c49cff1e5
+Revises: 97b34f104180
+Create Date: 2026-10-18 14:52:37.208415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b27c49cff1e5"
+down_revision = "97b34f104180"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "bulk_upload_job",
+        sa.Column("bulk_upload_job_id", sa.Integer(), nullable=False),
+        sa.Column(
+            "status",
+            sa.Enum("Queued", "Running", "Done", "Error", name="bulkuploadstatus"),
+            nullable=False,
+        ),
+        sa.Column("rows", sa.JSON(), nullable=False),
+        sa.Column("content_type", sa.String(length=50), nullable=False),
+        sa.Column("group_ids", sa.JSON(), nullable=False),
+        sa.Column("rows_total", sa.Integer(), nullable=False),
+        sa.Column("rows_processed", sa.Integer(), nullable=False),
+        sa.Column("errors", sa.JSON(), nullable=True),
+        sa.Column("dataset_ids", sa.JSON(), nullable=True),
+        sa.Column("created", sa.DateTime(), nullable=False),
+        sa.Column("created_by_id", sa.Integer(), nullable=False),
+        sa.Column("started", sa.DateTime(), nullable=True),
+        sa.Column("finished", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["created_by_id"], ["user.user_id"], onupdate="cascade"
+        ),
+        sa.PrimaryKeyConstraint("bulk_upload_job_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("bulk_upload_job")
@@ -0,0 +1,233 @@
+"""Split variant into canonical alleles and per-analysis variant_call
+
+Revision ID: b7e2c5a1f0d4
+Revises: 9d41f6b2c8e3
+Create Date: 2026-10-18 19:02:37.114092
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b7e2c5a1f0d4"
+down_revision = "9d41f6b2c8e3"
+branch_labels = None
+depends_on = None
+
+CALL_COLUMNS = ["depth", "quality", "number_of_callers", "old_multiallelic"]
+
+
+def upgrade():
+    op.create_table(
+        "variant_call",
+        sa.Column("variant_id", sa.Integer(), nullable=False),
+        sa.Column("analysis_id", sa.Integer(), nullable=False),
+        sa.Column("depth", sa.Integer(), nullable=False),
+        sa.Column("quality", sa.Integer(), nullable=True),
+        sa.Column("number_of_callers", sa.Integer(), nullable=True),
+        sa.Column("old_multiallelic", sa.String(length=500), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["variant_id"], ["variant.variant_id"], ondelete="cascade"
+        ),
+        sa.ForeignKeyConstraint(["analysis_id"], ["analysis.analysis_id"]),
+        sa.PrimaryKeyConstraint("variant_id", "analysis_id"),
+    )
+    op.create_index("variant_call_analysis_id_IDX", "variant_call", ["analysis_id"])
+
+    # The variant with the highest id of each allele, i.e. from the most recently ingested report,
+    # becomes the canonical one, keeping its annotations
+    op.execute(
+        """
+        CREATE TABLE variant_canonical (
+            variant_id INT NOT NULL PRIMARY KEY,
+            canonical_id INT NOT NULL
+        )
+        SELECT variant.variant_id, canonical.canonical_id
+        FROM variant
+        JOIN (
+            SELECT chromosome, position, reference_allele, alt_allele, MAX(variant_id) AS canonical_id
+            FROM variant
+            GROUP BY chromosome, position, reference_allele, alt_allele
+        ) AS canonical
+        USING (chromosome, position, reference_allele, alt_allele)
+        """
+    )
+    # an allele repeated within an analysis keeps its latest call
+    op.execute(
+        """
+        INSERT IGNORE INTO variant_call
+            (variant_id, analysis_id, depth, quality, number_of_callers, old_multiallelic)
+        SELECT variant_canonical.canonical_id, variant.analysis_id, variant.depth, variant.quality,
+            variant.number_of_callers, variant.old_multiallelic
+        FROM variant
+        JOIN variant_canonical ON variant_canonical.variant_id = variant.variant_id
+        ORDER BY variant.variant_id DESC
+        """
+    )
+
+    # genotypes referenced variant (analysis_id, variant_id)
+    op.drop_constraint("genotype_ibfk_2", "genotype", type_="foreignkey")
+    op.execute(
+        """
+        UPDATE IGNORE genotype
+        JOIN variant_canonical ON variant_canonical.variant_id = genotype.variant_id
+        SET genotype.variant_id = variant_canonical.canonical_id
+        WHERE variant_canonical.variant_id != variant_canonical.canonical_id
+        """
+    )
+    # those of the same sample and allele repeated within an analysis
+    op.execute(
+        """
+        DELETE genotype FROM genotype
+        JOIN variant_canonical ON variant_canonical.variant_id = genotype.variant_id
+        WHERE variant_canonical.variant_id != variant_canonical.canonical_id
+        """
+    )
+    for table, column in [("variant_rsid", "rsid"), ("variant_gene", "ensembl_id")]:
+        op.execute(
+            f"""
+            INSERT IGNORE INTO {table} (variant_id, {column})
+            SELECT variant_canonical.canonical_id, {table}.{column}
+            FROM {table}
+            JOIN variant_canonical ON variant_canonical.variant_id = {table}.variant_id
+            WHERE variant_canonical.variant_id != variant_canonical.canonical_id
+            """
+        )
+    # cascades to their variant_rsid and variant_gene rows
+    op.execute(
+        """
+        DELETE variant FROM variant
+        JOIN variant_canonical ON variant_canonical.variant_id = variant.variant_id
+        WHERE variant_canonical.variant_id != variant_canonical.canonical_id
+        """
+    )
+    op.drop_table("variant_canonical")
+
+    op.drop_constraint("variant_ibfk_1", "variant", type_="foreignkey")
+    op.drop_column("variant", "analysis_id")
+    for column in CALL_COLUMNS:
+        op.drop_column("variant", column)
+    op.create_index(
+        "variant_allele_IDX",
+        "variant",
+        ["chromosome", "position", "reference_allele", "alt_allele"],
+        unique=True,
+    )
+    op.create_foreign_key(
+        "genotype_variant_call_fk",
+        "genotype",
+        "variant_call",
+        ["variant_id", "analysis_id"],
+        ["variant_id", "analysis_id"],
+    )
+
+
+def downgrade():
+    op.drop_constraint("genotype_variant_call_fk", "genotype", type_="foreignkey")
+    op.drop_index("variant_allele_IDX", table_name="variant")
+    op.add_column("variant", sa.Column("analysis_id", sa.Integer(), nullable=True))
+    op.add_column("variant", sa.Column("depth", sa.Integer(), nullable=True))
+    op.add_column("variant", sa.Column("quality", sa.Integer(), nullable=True))
+    op.add_column(
+        "variant", sa.Column("number_of_callers", sa.Integer(), nullable=True)
+    )
+    op.add_column(
+        "variant", sa.Column("old_multiallelic", sa.String(length=500), nullable=True)
+    )
+
+    # the first analysis calling each variant keeps it
+    op.execute(
+        """
+        UPDATE variant
+        JOIN (
+            SELECT variant_id, MIN(analysis_id) AS analysis_id
+            FROM variant_call
+            GROUP BY variant_id
+        ) AS first_call ON first_call.variant_id = variant.variant_id
+        JOIN variant_call ON variant_call.variant_id = first_call.variant_id
+            AND variant_call.analysis_id = first_call.analysis_id
+        SET variant.analysis_id = variant_call.analysis_id,
+            variant.depth = variant_call.depth,
+            variant.quality = variant_call.quality,
+            variant.number_of_callers = variant_call.number_of_callers,
+            variant.old_multiallelic = variant_call.old_multiallelic
+        """
+    )
+    op.execute("DELETE FROM variant WHERE analysis_id IS NULL")
+
+    # and each other analysis gets a copy of it with a new id
+    next_variant_id = (
+        op.get_bind().execute(sa.text("SELECT MAX(variant_id) FROM variant")).scalar()
+        or 0
+    ) + 1
+    op.execute(
+        f"""
+        CREATE TABLE variant_expanded (
+            variant_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            canonical_id INT NOT NULL,
+            analysis_id INT NOT NULL
+        ) AUTO_INCREMENT = {next_variant_id}
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO variant_expanded (canonical_id, analysis_id)
+        SELECT variant_call.variant_id, variant_call.analysis_id
+        FROM variant_call
+        JOIN variant ON variant.variant_id = variant_call.variant_id
+        WHERE variant_call.analysis_id != variant.analysis_id
+        ORDER BY variant_call.variant_id, variant_call.analysis_id
+        """
+    )
+    annotations = ", ".join(
+        column["name"]
+        for column in sa.inspect(op.get_bind()).get_columns("variant")
+        if column["name"] not in ["variant_id", "analysis_id", *CALL_COLUMNS]
+    )
+    op.execute(
+        f"""
+        INSERT INTO variant (variant_id, analysis_id, {", ".join(CALL_COLUMNS)}, {annotations})
+        SELECT variant_expanded.variant_id, variant_expanded.analysis_id,
+            {", ".join(f"variant_call.{column}" for column in CALL_COLUMNS)},
+            {", ".join(f"canonical.{column}" for column in annotations.split(", "))}
+        FROM variant_expanded
+        JOIN variant AS canonical ON canonical.variant_id = variant_expanded.canonical_id
+        JOIN variant_call ON variant_call.variant_id = variant_expanded.canonical_id
+            AND variant_call.analysis_id = variant_expanded.analysis_id
+        """
+    )
+    op.execute(
+        """
+        UPDATE genotype
+        JOIN variant_expanded ON variant_expanded.canonical_id = genotype.variant_id
+            AND variant_expanded.analysis_id = genotype.analysis_id
+        SET genotype.variant_id = variant_expanded.variant_id
+        """
+    )
+    for table, column in [("variant_rsid", "rsid"), ("variant_gene", "ensembl_id")]:
+        op.execute(
+            f"""
+            INSERT INTO {table} (variant_id, {column})
+            SELECT variant_expanded.variant_id, {table}.{column}
+            FROM variant_expanded
+            JOIN {table} ON {table}.variant_id = variant_expanded.canonical_id
+            """
+        )
+    op.drop_table("variant_expanded")
+    op.drop_table("variant_call")
+
+    op.alter_column(
+        "variant", "analysis_id", existing_type=sa.Integer(), nullable=False
+    )
+    op.alter_column("variant", "depth", existing_type=sa.Integer(), nullable=False)
+    op.create_foreign_key(
+        "variant_ibfk_1", "variant", "analysis", ["analysis_id"], ["analysis_id"]
+    )
+    op.create_foreign_key(
+        "genotype_ibfk_2",
+        "genotype",
+        "variant",
+        ["analysis_id", "variant_id"],
+        ["analysis_id", "variant_id"],
+    )
@@ -0,0 +1,38 @@
+"""Make gene bin not null
+
+Revision ID: c3f8a2d6e915
+Revises: b7e2c5a1f0d4
+Create Date: 2026-10-19 09:14:26.503118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c3f8a2d6e915"
+down_revision = "b7e2c5a1f0d4"
+branch_labels = None
+depends_on = None
+
+
+def bin_sql(start: str, end: str) -> str:
+    """UCSC bin of the 1-based inclusive interval [start, end], kept in sync with app/binning.py"""
+    return (
+        "CASE "
+        f"WHEN ({start} - 1) >> 17 = ({end} - 1) >> 17 THEN 585 + (({start} - 1) >> 17) "
+        f"WHEN ({start} - 1) >> 20 = ({end} - 1) >> 20 THEN 73 + (({start} - 1) >> 20) "
+        f"WHEN ({start} - 1) >> 23 = ({end} - 1) >> 23 THEN 9 + (({start} - 1) >> 23) "
+        f"WHEN ({start} - 1) >> 26 = ({end} - 1) >> 26 THEN 1 + (({start} - 1) >> 26) "
+        f"ELSE ({start} - 1) >> 29 END"
+    )
+
+
+def upgrade():
+    # genes loaded outside the ORM since the bins were added
+    op.execute(f"UPDATE gene SET bin = {bin_sql('start', '`end`')} WHERE bin IS NULL")
+    op.alter_column("gene", "bin", existing_type=sa.SmallInteger(), nullable=False)
+
+
+def downgrade():
+    op.alter_column("gene", "bin", existing_type=sa.SmallInteger(), nullable=True)
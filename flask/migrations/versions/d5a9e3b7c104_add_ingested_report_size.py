@@ -0,0 +1,24 @@
+"""Add ingested_report size
+
+Revision ID: d5a9e3b7c104
+Revises: c3f8a2d6e915
+Create Date: 2026-10-19 10:02:51.348261
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d5a9e3b7c104"
+down_revision = "c3f8a2d6e915"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("ingested_report", sa.Column("size", sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("ingested_report", "size")
@@ -0,0 +1,31 @@
+"""Add cache_generation
+
+Revision ID: e8b4d2f6a913
+Revises: d5a9e3b7c104
+Create Date: 2026-10-19 11:14:08.502731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e8b4d2f6a913"
+down_revision = "d5a9e3b7c104"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    cache_generation = op.create_table(
+        "cache_generation",
+        sa.Column("name", sa.String(length=50), nullable=False),
+        sa.Column("generation", sa.BigInteger(), server_default="0", nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+    # the rows read and bumped by generations.py
+    op.bulk_insert(cache_generation, [{"name": "metadata", "generation": 0}])
+
+
+def downgrade():
+    op.drop_table("cache_generation")
@@ -0,0 +1,37 @@
+"""Replace report_generation with the variants cache generation
+
+Revision ID: f2c7a9e4b358
+Revises: e8b4d2f6a913
+Create Date: 2026-10-19 13:41:26.870154
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f2c7a9e4b358"
+down_revision = "e8b4d2f6a913"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    cache_generation = sa.table(
+        "cache_generation",
+        sa.column("name", sa.String),
+        sa.column("generation", sa.BigInteger),
+    )
+    op.bulk_insert(cache_generation, [{"name": "variants", "generation": 0}])
+    op.drop_table("report_generation")
+
+
+def downgrade():
+    report_generation = op.create_table(
+        "report_generation",
+        sa.Column("report_generation_id", sa.Integer(), nullable=False),
+        sa.Column("generation", sa.BigInteger(), server_default="0", nullable=False),
+        sa.PrimaryKeyConstraint("report_generation_id"),
+    )
+    op.bulk_insert(report_generation, [{"report_generation_id": 1, "generation": 0}])
+    op.execute("DELETE FROM cache_generation WHERE name = 'variants'")
@@ -0,0 +1,37 @@
+"""
+Times the variant-wise report on a frame of a million genotypes, before and after the vectorized collapse.
+
+    python -m tests.benchmark_report_df [rows]
+"""
+import sys
+from time import perf_counter
+
+from tests.unit.test_report_aggregation import (
+    legacy_report_df,
+    make_genotypes,
+    normalize_unique,
+    variant_report,
+)
+
+
+def best_of(runs, function, *args):
+    best, result = float("inf"), None
+    for _ in range(runs):
+        start = perf_counter()
+        result = function(*args)
+        best = min(best, perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    df = make_genotypes(rows)
+    legacy_seconds, expected = best_of(1, legacy_report_df, df)
+    seconds, actual = best_of(3, variant_report, df)
+    identical = normalize_unique(actual).to_csv(index=False) == normalize_unique(
+        expected
+    ).to_csv(index=False)
+    print(f"{rows} genotypes, {len(actual)} variants")
+    print(f"groupby:    {legacy_seconds:.2f}s")
+    print(f"vectorized: {seconds:.2f}s ({legacy_seconds / seconds:.1f}x)")
+    print(f"identical csv: {identical}")
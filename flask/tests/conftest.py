@@ -1,9 +1,26 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
 import os
+from time import perf_counter
+from typing import Iterator, List, Optional, Tuple
+
+from flask import has_request_context, request
 import pytest
+from sqlalchemy import event
 
 from app import create_app, db
 from app.config import Config
 from app.models import *
+from app.mapping_utils import map_variant_rsids, map_variants_to_genes
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--record-query-budgets",
+        action="store_true",
+        help="write the statements each endpoint made to tests/query_budgets.json instead of checking them",
+    )
 
 
 class TestConfig(Config):
@@ -27,6 +44,11 @@ class TestConfig(Config):
     ENABLE_OIDC = os.getenv("ENABLE_OIDC", "")
     TESTING = True
     LOGIN_DISABLED = False
+    # tests that use the report cache set up their own
+    REPORT_CACHE = ""
+    # async bulk uploads and report jobs are run explicitly by the tests
+    BULK_JOB_POLL_SECONDS = 0
+    REPORT_JOB_POLL_SECONDS = 0
 
 
 @pytest.fixture(scope="session")
@@ -376,6 +398,10 @@ def test_database(client):
         "LOXL4": [0.000585, 0.000217, 0.000285],
         "RTEL1": [0.000011, 0, 0.002722],
     }
+    rsids = {
+        "LOXL4": ["rs123", "rs12,rs1234", None],
+        "RTEL1": [None, None, None],
+    }
     # ds 1,4, - analysis 3
     # ds2,3 - analysis 2///ach//user
     datasets_gt = {
@@ -415,22 +441,29 @@ def test_database(client):
         # variant logic for analysis_3
         for i in range(len(positions["LOXL4"])):
             variant_obj = Variant(
-                analysis_id=analysis_2.analysis_id,
                 chromosome=positions[gene][i][0],
                 position=positions[gene][i][1],
                 reference_allele=reference_alleles[gene][i],
                 alt_allele=alt_alleles[gene][i],
                 variation=variations[gene][i],
                 refseq_change=refseq_changes[gene][i],
-                depth=depths[gene][i],
                 conserved_in_20_mammals=conserved_in_20_mammals[gene][i],
                 sift_score=sift_scores[gene][i],
                 polyphen_score=polyphen_scores[gene][i],
                 cadd_score=cadd_scores[gene][i],
                 gnomad_af=gnomad_afs[gene][i],
+                rsids=rsids[gene][i],
             )
             db.session.add(variant_obj)
             db.session.flush()
+            db.session.add(
+                VariantCall(
+                    variant_id=variant_obj.variant_id,
+                    analysis_id=analysis_2.analysis_id,
+                    depth=depths[gene][i],
+                )
+            )
+            db.session.flush()
 
             for dataset_id in datasets_gt:
                 gt_obj = Genotype(
@@ -443,6 +476,8 @@ def test_database(client):
                 )
                 db.session.add(gt_obj)
                 db.session.flush()
+    map_variants_to_genes()
+    map_variant_rsids()
     db.session.commit()
 
 
@@ -461,3 +496,158 @@ def login_as(client):
         )
 
     return login
+
+
+class QueryLog:
+    """
+    The SQL statements executed while recording, with the path of the request that made each one
+    (None outside of a request) and how long it took in seconds
+    """
+
+    def __init__(self):
+        self.statements: List[Tuple[Optional[str], str, float]] = []
+
+    def __len__(self) -> int:
+        return len(self.statements)
+
+    @property
+    def duration(self) -> float:
+        return sum(duration for _, _, duration in self.statements)
+
+    def __str__(self) -> str:
+        return "\n".join(
+            f"{path} {duration * 1000:.1f}ms {statement}"
+            for path, statement, duration in self.statements
+        )
+
+
+@pytest.fixture
+def count_queries(client):
+    """
+    Returns a context manager that records the SQL statements executed within it, usually by a single request.
+    The session is cleared beforehand so that the request can't reuse objects loaded earlier by the test.
+    """
+
+    @contextmanager
+    def record() -> Iterator[QueryLog]:
+        log = QueryLog()
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+            conn.info.setdefault("query_start", []).append(perf_counter())
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+            duration = perf_counter() - conn.info["query_start"].pop()
+            path = request.path if has_request_context() else None
+            log.statements.append((path, statement, duration))
+
+        db.session.remove()
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(db.engine, "after_cursor_execute", after_cursor_execute)
+        try:
+            yield log
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+            event.remove(db.engine, "after_cursor_execute", after_cursor_execute)
+
+    return record
+
+
+QUERY_BUDGETS = os.path.join(os.path.dirname(__file__), "query_budgets.json")
+
+
+@pytest.fixture(scope="session")
+def query_budgets(request):
+    """
+    The most statements each endpoint in test_query_budgets.py is allowed, as measured against the MySQL test database.
+    With --record-query-budgets, the tests add what they measure instead, which is written back when they finish.
+    """
+    try:
+        with open(QUERY_BUDGETS) as file:
+            budgets = json.load(file)
+    except FileNotFoundError:
+        budgets = {}
+    yield budgets
+    if request.config.getoption("--record-query-budgets"):
+        with open(QUERY_BUDGETS, "w") as file:
+            json.dump(budgets, file, indent=4, sort_keys=True)
+            file.write("\n")
+
+
+@pytest.fixture
+def add_bulk_data(test_database):
+    """
+    Returns a function that adds the given number of families on top of the test database. Every family has
+    three participants from different institutions, each with a blood sample that has a WES and a WGS dataset
+    with a linked file, and the WES datasets of the family are in one analysis. Everything is in the ach group.
+    """
+    group = Group.query.filter(Group.group_code == "ach").one()
+    admin = User.query.filter(User.username == "admin").one()
+    institutions = Institution.query.order_by(Institution.institution_id).all()
+    added = 0
+
+    def add(families: int) -> None:
+        nonlocal added
+        now = datetime.now()
+        for _ in range(families):
+            added += 1
+            family = Family(
+                family_codename=f"Bulk{added}",
+                created_by_id=admin.user_id,
+                updated_by_id=admin.user_id,
+            )
+            exomes = []
+            for i, participant_type in enumerate(
+                [
+                    ParticipantType.Proband,
+                    ParticipantType.Parent,
+                    ParticipantType.Sibling,
+                ]
+            ):
+                codename = f"Bulk{added}_{i}"
+                sample = TissueSample(
+                    tissue_sample_type=TissueSampleType.Blood,
+                    created_by_id=admin.user_id,
+                    updated_by_id=admin.user_id,
+                )
+                for dataset_type in ["WES", "WGS"]:
+                    dataset = Dataset(
+                        dataset_type=dataset_type,
+                        condition=DatasetCondition.GermLine,
+                        sequencing_id=f"{codename}_{dataset_type}",
+                        created_by_id=admin.user_id,
+                        updated_by_id=admin.user_id,
+                    )
+                    dataset.groups.append(group)
+                    dataset.linked_files.append(
+                        File(path=f"/bulk/{codename}.{dataset_type.lower()}.bam")
+                    )
+                    sample.datasets.append(dataset)
+                    if dataset_type == "WES":
+                        exomes.append(dataset)
+                participant = Participant(
+                    participant_codename=codename,
+                    sex=Sex.Female,
+                    participant_type=participant_type,
+                    institution_id=institutions[
+                        (added * 3 + i) % len(institutions)
+                    ].institution_id,
+                    created_by_id=admin.user_id,
+                    updated_by_id=admin.user_id,
+                )
+                participant.tissue_samples.append(sample)
+                family.participants.append(participant)
+            db.session.add(family)
+            db.session.add(
+                Analysis(
+                    analysis_state=AnalysisState.Requested,
+                    kind="exomic",
+                    requester_id=admin.user_id,
+                    updated_by_id=admin.user_id,
+                    requested=now,
+                    updated=now,
+                    datasets=exomes,
+                )
+            )
+        db.session.commit()
+
+    return add
@@ -1,3 +1,5 @@
+from io import BytesIO
+
 import pytest
 
 from sqlalchemy.orm import joinedload
@@ -13,8 +15,8 @@ def remove_analyses(dataset):
         for genotype in analysis.genotype:
             db.session.delete(genotype)
         db.session.commit()
-        for variant in analysis.variants:
-            db.session.delete(variant)
+        for call in analysis.variant_calls:
+            db.session.delete(call)
         db.session.delete(analysis)
     db.session.commit()
 
@@ -733,6 +735,67 @@ def test_dataset_order_by_related_column(client, test_database, login_as):
     assert body["data"][0]["tissue_sample_type"] == "Blood"
 
 
+def test_dataset_cursor_pagination(client, test_database, login_as):
+    """paging with cursors visits every dataset once, in the same order as without"""
+    login_as("admin")
+
+    for ordering in [
+        "",
+        "order_by=sequencing_id&order_dir=asc",
+        "order_by=sequencing_id&order_dir=desc",
+        "order_by=family_codename&order_dir=desc",
+        "order_by=tissue_sample_type&order_dir=asc",
+        "order_by=linked_files&order_dir=asc",
+    ]:
+        expected = [
+            dataset["dataset_id"]
+            for dataset in client.get(f"/api/datasets?{ordering}").get_json()["data"]
+        ]
+        dataset_ids = []
+        cursor = ""
+        while cursor is not None:
+            response = client.get(f"/api/datasets?{ordering}&limit=4&cursor={cursor}")
+            assert response.status_code == 200
+            body = response.get_json()
+            assert len(body["data"]) <= 4
+            assert body["total_count"] == 6
+            dataset_ids += [dataset["dataset_id"] for dataset in body["data"]]
+            cursor = body["next_cursor"]
+        assert dataset_ids == expected
+
+    # cursors are tied to their ordering
+    cursor = client.get("/api/datasets?limit=2&cursor=").get_json()["next_cursor"]
+    response = client.get(
+        f"/api/datasets?limit=2&cursor={cursor}&order_by=dataset_type&order_dir=asc"
+    )
+    assert response.status_code == 400
+    assert client.get("/api/datasets?limit=2&cursor=garbage").status_code == 400
+
+
+def test_dataset_total_count_modes(client, test_database, login_as):
+    """total_count can be skipped, and cached counts are invalidated by writes"""
+    login_as("admin")
+
+    assert client.get("/api/datasets?count=none").get_json()["total_count"] is None
+    assert client.get("/api/datasets?count=bogus").status_code == 400
+    assert client.get("/api/datasets?limit=1").get_json()["total_count"] == 6
+
+    db.session.add(
+        models.Dataset(
+            tissue_sample_id=1,
+            dataset_type="WGS",
+            condition="GermLine",
+            created_by_id=1,
+            updated_by_id=1,
+        )
+    )
+    db.session.commit()
+
+    for count in ["", "exact", "estimate"]:
+        response = client.get(f"/api/datasets?limit=1&count={count}")
+        assert response.get_json()["total_count"] == 7
+
+
 def test_orphan_nonmultiplexed_files_deleted(test_database):
     path_name = "test_orphan_nonmultiplexed_files_deleted"
     file = models.File(path=path_name)
@@ -789,3 +852,53 @@ def test_orphan_multiplexed_files_with_multiple_datasets_attached_not_deleted(
 
     assert len(dataset.linked_files) == 1
     assert models.File.query.filter(models.File.path == path_name).count() == 1
+
+
+def test_dataset_fields(client, test_database, login_as):
+    """?fields= limits the keys of each dataset, including the csv export's columns"""
+    login_as("admin")
+
+    response = client.get("/api/datasets?fields=dataset_id,family_codename,group_code")
+    assert response.status_code == 200
+    datasets = response.get_json()["data"]
+    assert len(datasets) == 6
+    for dataset in datasets:
+        assert dataset.keys() == {"dataset_id", "family_codename", "group_code"}
+
+    response = client.get(
+        "/api/datasets?fields=dataset_id,notes,group_code",
+        headers={"Accept": "text/csv"},
+    )
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).splitlines()[0] == "notes,dataset_id"
+
+    response = client.get("/api/datasets/1?fields=dataset_id,tissue_sample_type")
+    assert response.status_code == 200
+    assert response.get_json().keys() == {"dataset_id", "tissue_sample_type"}
+
+    assert client.get("/api/datasets?fields=dataset_id,nonsense").status_code == 400
+
+
+def test_list_datasets_columnar(client, test_database, login_as):
+    """the export can be downloaded as parquet or an arrow stream with the csv's columns"""
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    login_as("admin")
+    response = client.get(
+        "/api/datasets?fields=dataset_id,dataset_type,linked_files",
+        headers={"Accept": "application/vnd.apache.arrow.stream"},
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/vnd.apache.arrow.stream"
+    table = pa.ipc.open_stream(response.get_data()).read_all()
+    assert table.column_names == ["dataset_type", "linked_files", "dataset_id"]
+    assert sorted(table.column("dataset_id").to_pylist()) == [1, 2, 3, 4, 5, 6]
+    assert pa.types.is_dictionary(table.schema.field("dataset_type").type)
+
+    response = client.get(
+        "/api/datasets", headers={"Accept": "application/vnd.apache.parquet"}
+    )
+    assert response.status_code == 200
+    assert "datasets_report.parquet" in response.headers["Content-Disposition"]
+    assert pq.read_table(BytesIO(response.get_data())).num_rows == 6
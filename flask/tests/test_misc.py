@@ -1,13 +1,13 @@
-from unittest.mock import Mock
 from csv import DictReader
+from datetime import datetime, timedelta
 from io import StringIO
 from pytest import raises
-from flask.wrappers import Request
 from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import BadRequest
 
 from app import models, db
-from app.blueprints.misc import link_files_to_dataset
+from app.blueprints.misc import link_files, parse_linked_files
+from app.tasks import run_bulk_upload_jobs
 from app.utils import filter_datasets_by_user_groups, get_current_user
 
 
@@ -430,11 +430,8 @@ def test_fails_with_dupe_non_multiplex_fields(test_database):
 
     dataset = models.Dataset()
 
-    mock_request = Mock(spec=Request)
-    mock_request.content_type = "text/csv"
-
     with raises(Exception) as e:
-        link_files_to_dataset(mock_request, dataset, row)
+        link_files(dataset, parse_linked_files("text/csv", row), {file.path: file})
 
     assert "already linked" in str(e.value)
 
@@ -461,10 +458,9 @@ def test_can_add_existing_with_multiplex_flag(test_database):
 
     dataset = models.Dataset()
 
-    mock_request = Mock(spec=Request)
-    mock_request.content_type = "appliction/json"
-
-    result = link_files_to_dataset(mock_request, dataset, row)
+    result = link_files(
+        dataset, parse_linked_files("application/json", row), {file.path: file}
+    )
 
     assert len(result.linked_files) == 1
 
@@ -481,10 +477,7 @@ def test_can_mark_multiplex_with_asterisk(test_database):
 
     dataset = models.Dataset()
 
-    mock_request = Mock(spec=Request)
-    mock_request.content_type = "text/csv"
-
-    result = link_files_to_dataset(mock_request, dataset, row)
+    result = link_files(dataset, parse_linked_files("text/csv", row), {})
 
     assert len(result.linked_files) == 2
     assert len([f for f in result.linked_files if f.multiplexed]) == 1
@@ -517,6 +510,37 @@ def test_filter_datasets_by_user_groups(test_database):
     assert len(filtered_query.all()) == 1
 
 
+def test_dataset_visibility_follows_group_membership(test_database):
+    """is user_dataset_visibility kept in sync when users and datasets join or leave groups?"""
+
+    def visible(user):
+        return filter_datasets_by_user_groups(models.Dataset.query, user).count()
+
+    user = models.User.query.filter(models.User.user_id == 4).first()  # no groups
+    group = models.User.query.filter(models.User.user_id == 2).first().groups[0]
+    assert visible(user) == 0
+
+    user.groups.append(group)
+    db.session.commit()
+    assert visible(user) == 2
+
+    dataset = models.Dataset.query.filter(
+        ~models.Dataset.groups.contains(group)
+    ).first()
+    dataset.groups.append(group)
+    db.session.commit()
+    assert visible(user) == 3
+
+    # only the visibility of this dataset is refreshed
+    dataset.groups.remove(group)
+    db.session.commit()
+    assert visible(user) == 2
+
+    user.groups.remove(group)
+    db.session.commit()
+    assert visible(user) == 0
+
+
 def test_must_pass_in_user_arguement_if_login_disabled(application, test_database):
     """do we get a 400 if log in is disabled and no user argument is passed in?"""
     application.config["LOGIN_DISABLED"] = True
@@ -536,3 +560,131 @@ def test_must_pass_in_user_arguement_if_login_disabled(application, test_databas
         assert get_current_user().user_id == 1
 
     application.config["LOGIN_DISABLED"] = False
+
+
+def test_bulk_links_files_created_earlier_in_upload(test_database, client, login_as):
+    """files created by one row are subject to the multiplexing rules for later rows of the same upload"""
+    login_as("admin")
+
+    assert (
+        client.post(
+            "/api/_bulk?groups=ach",
+            json=[
+                {**DEFAULT_PAYLOAD, "linked_files": [{"path": "/path/foo"}]},
+                {
+                    **DEFAULT_PAYLOAD,
+                    "tissue_sample_type": "Saliva",
+                    "linked_files": [{"path": "/path/foo"}],
+                },
+            ],
+        ).status_code
+        == 400
+    )
+    assert models.Dataset.query.count() == 6
+    assert models.File.query.count() == 0
+
+    assert (
+        client.post(
+            "/api/_bulk?groups=ach",
+            data="""family_codename,participant_codename,tissue_sample_type,dataset_type,condition,sequencing_date,linked_files
+HOOD,HERO,Saliva,WGS,GermLine,2020-12-17,*/path/foo
+HOOD,HERO,Saliva,WES,GermLine,2020-12-17,*/path/foo
+""",
+            headers={"Content-Type": "text/csv"},
+        ).status_code
+        == 200
+    )
+    assert models.Dataset.query.count() == 8
+    assert models.File.query.count() == 1
+    assert models.Participant.query.count() == 4
+
+
+def test_post_bulk_async(test_database, client, login_as, application):
+    """async uploads are queued, run by the scheduler task, and report their result"""
+    login_as("admin")
+
+    response = client.post(
+        "/api/_bulk?groups=ach&async=true",
+        json=[DEFAULT_PAYLOAD, {**DEFAULT_PAYLOAD, "tissue_sample_type": "Saliva"}],
+    )
+    assert response.status_code == 202
+    job_id = response.get_json()["bulk_upload_job_id"]
+    assert response.headers["location"] == f"/api/_bulk/{job_id}"
+    assert models.Dataset.query.count() == 6
+
+    job = client.get(f"/api/_bulk/{job_id}").get_json()
+    assert job["status"] == "Queued"
+    assert job["rows_total"] == 2
+
+    run_bulk_upload_jobs(application)
+
+    job = client.get(f"/api/_bulk/{job_id}").get_json()
+    assert job["status"] == "Done"
+    assert job["rows_processed"] == 2
+    assert len(job["dataset_ids"]) == 2
+    assert models.Dataset.query.count() == 8
+
+    # a failed upload records the error a synchronous upload would have responded with
+    response = client.post("/api/_bulk?groups=ach&async=true", json=[DEFAULT_PAYLOAD])
+    job_id = response.get_json()["bulk_upload_job_id"]
+    run_bulk_upload_jobs(application)
+    job = client.get(f"/api/_bulk/{job_id}").get_json()
+    assert job["status"] == "Error"
+    assert "duplicate" in job["errors"][0]
+    assert models.Dataset.query.count() == 8
+
+    login_as("user")
+    assert client.get(f"/api/_bulk/{job_id}").status_code == 404
+
+
+def test_interrupted_bulk_job_fails(test_database, client, login_as, application):
+    """a job left Running by a crash or restart is marked as failed once it times out"""
+    login_as("admin")
+    response = client.post(
+        "/api/_bulk?groups=ach&async=true",
+        json=[{**DEFAULT_PAYLOAD, "tissue_sample_type": "Saliva"}],
+    )
+    job_id = response.get_json()["bulk_upload_job_id"]
+    job = models.BulkUploadJob.query.get(job_id)
+    job.status = models.BulkUploadStatus.Running
+    job.started = datetime.utcnow()
+    db.session.commit()
+
+    # still within the timeout, so it may be running elsewhere
+    run_bulk_upload_jobs(application)
+    assert client.get(f"/api/_bulk/{job_id}").get_json()["status"] == "Running"
+
+    job = models.BulkUploadJob.query.get(job_id)
+    job.started -= timedelta(seconds=application.config["JOB_TIMEOUT_SECONDS"] + 1)
+    db.session.commit()
+    run_bulk_upload_jobs(application)
+    job = client.get(f"/api/_bulk/{job_id}").get_json()
+    assert job["status"] == "Error"
+    assert "interrupted" in job["errors"][0]
+    assert job["finished"] is not None
+    # it isn't run again
+    assert models.Dataset.query.count() == 6
+
+
+# ?profile= and X-Stager-Profile
+def test_profile_request(test_database, client, login_as):
+    login_as("user")
+    assert client.get("/api/datasets?profile=json").status_code == 401
+    assert (
+        client.get("/api/datasets", headers={"X-Stager-Profile": "json"}).status_code
+        == 401
+    )
+
+    login_as("admin")
+    response = client.get("/api/datasets?profile=json")
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["endpoint"] == "datasets.list_datasets"
+    assert body["status"] == 200
+    assert any("list_datasets" in function["function"] for function in body["profile"])
+    assert body["sql"]["count"] == len(body["sql"]["statements"]) > 0
+    assert any("FROM dataset" in s["statement"] for s in body["sql"]["statements"])
+
+    response = client.get("/api/datasets", headers={"X-Stager-Profile": "pstats"})
+    assert response.status_code == 200
+    assert response.mimetype == "application/octet-stream"
@@ -152,6 +152,29 @@ def test_get_participants_user(test_database, client, login_as):
     assert client.get("/api/participants/1?user=1").status_code == 404
 
 
+def test_participant_fields(test_database, client, login_as):
+    """?fields= limits the keys of each participant, and skipping tissue samples still respects groups"""
+    login_as("user")
+
+    response = client.get("/api/participants?fields=participant_id,family_codename")
+    assert response.status_code == 200
+    assert response.get_json()["total_count"] == 2
+    participants = response.get_json()["data"]
+    assert len(participants) == 2
+    for participant in participants:
+        assert participant.keys() == {"participant_id", "family_codename"}
+
+    assert client.get("/api/participants?fields=nonsense").status_code == 400
+
+    login_as("user_c")
+    response = client.get("/api/participants/3?fields=participant_codename,institution")
+    assert response.status_code == 200
+    assert response.get_json().keys() == {"participant_codename", "institution"}
+    assert (
+        client.get("/api/participants/1?fields=participant_codename").status_code == 404
+    )
+
+
 # DELETE /api/participants/:id
 
 
@@ -190,8 +213,8 @@ def test_delete_participant(test_database, client, login_as):
                 for genotype in analysis.genotype:
                     db.session.delete(genotype)
                 db.session.commit()
-                for variant in analysis.variants:
-                    db.session.delete(variant)
+                for call in analysis.variant_calls:
+                    db.session.delete(call)
                 db.session.delete(analysis)
             db.session.delete(dataset)
         db.session.delete(sample)
@@ -0,0 +1,98 @@
+""" the number of SQL statements each read endpoint makes, to catch N+1 lazy loads """
+import pytest
+
+# username, url of the endpoints whose statements are budgeted in tests/query_budgets.json, see the query_budgets
+# fixture. Every endpoint needs a budget there.
+# Every request also loads the logged in user, paged lists read the metadata generation for the count cache,
+# and non-admin lists load the user's groups for it.
+ENDPOINTS = [
+    # count, datasets, institutions, groups, files, analyses
+    ("admin", "/api/datasets"),
+    ("user", "/api/datasets"),
+    # dataset with its sample, participant, family and analyses, then files, groups
+    ("admin", "/api/datasets/2"),
+    ("user", "/api/datasets/2"),
+    # count, participants joined with everything
+    ("admin", "/api/participants"),
+    ("user", "/api/participants"),
+    # participant, then samples, datasets, files for admins; participant with its datasets, files otherwise
+    ("admin", "/api/participants/1"),
+    ("user", "/api/participants/1"),
+    # count, analyses, datasets, samples, participants, families
+    ("admin", "/api/analyses"),
+    ("user", "/api/analyses"),
+    # analysis, datasets with their sample, participant and family, files, groups
+    ("admin", "/api/analyses/2"),
+    ("user", "/api/analyses/2"),
+    ("admin", "/api/families"),
+    ("user", "/api/families"),
+    ("admin", "/api/families/1"),
+    ("user", "/api/families/1"),
+    ("admin", "/api/tissue_samples/1"),
+    ("user", "/api/tissue_samples/1"),
+    ("admin", "/api/groups"),
+    ("user", "/api/groups"),
+]
+
+
+@pytest.mark.parametrize("username,url", ENDPOINTS)
+def test_query_budget(
+    request,
+    client,
+    login_as,
+    add_bulk_data,
+    count_queries,
+    query_budgets,
+    username,
+    url,
+):
+    """an endpoint makes as many statements for a few rows as for many, and stays within its measured budget"""
+    login_as(username)
+
+    add_bulk_data(2)
+    with count_queries() as few:
+        assert client.get(url).status_code == 200
+
+    add_bulk_data(10)
+    with count_queries() as many:
+        assert client.get(url).status_code == 200
+    assert len(many) == len(
+        few
+    ), f"statements grew from {len(few)} to {len(many)} with more rows:\n{many}"
+
+    key = f"{username} {url}"
+    if request.config.getoption("--record-query-budgets"):
+        query_budgets[key] = len(few)
+    else:
+        assert (
+            key in query_budgets
+        ), f"no budget for {key} in tests/query_budgets.json, see --record-query-budgets"
+        budget = query_budgets[key]
+        assert len(few) <= budget, f"{len(few)} statements over budget:\n{few}"
+
+
+def test_create_analysis_query_budget(client, login_as, add_bulk_data, count_queries):
+    """creating an analysis makes as many statements for a few datasets as for many"""
+    login_as("admin")
+
+    def create(datasets):
+        with count_queries() as queries:
+            response = client.post(
+                "/api/analyses", json={"datasets": datasets, "notes": "budget"}
+            )
+        assert response.status_code == 201
+        assert len(response.get_json()["datasets"]) == len(datasets)
+        return queries
+
+    add_bulk_data(3)
+    datasets = [
+        dataset["dataset_id"]
+        for dataset in client.get("/api/datasets?dataset_type=WES").get_json()["data"]
+    ]
+    assert len(datasets) >= 9
+
+    few = create(datasets[:3])
+    many = create(datasets)
+    assert len(many) == len(
+        few
+    ), f"statements grew from {len(few)} to {len(many)} with more datasets:\n{many}"
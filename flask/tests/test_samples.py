@@ -57,8 +57,8 @@ def test_delete_tissue_sample(test_database, client, login_as):
             for genotype in analysis.genotype:
                 db.session.delete(genotype)
             db.session.commit()
-            for variant in analysis.variants:
-                db.session.delete(variant)
+            for call in analysis.variant_calls:
+                db.session.delete(call)
             db.session.delete(analysis)
         db.session.delete(dataset)
 
@@ -1,5 +1,22 @@
 from io import BytesIO
+import os
+
 import pandas as pd
+import pytest
+from minio import Minio
+
+from app import models
+from app.generations import bump_generations
+from app.mapping_utils import (
+    assign_variant_ids,
+    build_variant_rows,
+    replace_variant_rsids,
+    upsert_variants,
+)
+from app.models import db
+from app.report_cache import DiskReportCache
+from app.tasks import run_summary_report_jobs
+from conftest import TestConfig
 
 
 def test_variant_wise_json_single_search(test_database, client, login_as):
@@ -130,6 +147,32 @@ def test_variant_wise_csv_multiple_search(test_database, client, login_as):
         assert df.shape[0] == 6
 
 
+def test_variant_wise_json_rsid_search(test_database, client, login_as):
+    login_as("admin")
+
+    urls = [
+        ("/api/summary/variants?rsids=rs123", 1),
+        ("/api/summary/variants?rsids=rs12", 1),  # no substring matches
+        ("/api/summary/variants?rsids=rs1234", 1),
+        ("/api/summary/variants?rsids=rs12,rs123,rs1234", 2),
+    ]
+
+    for url in urls:
+        print(url)
+        response = client.get(url[0], headers={"Accept": "application/json"})
+        assert response.status_code == 200
+        assert len(response.get_json()) == url[1]
+
+    response = client.get(
+        "/api/summary/variants?rsids=rs1", headers={"Accept": "application/json"}
+    )
+    assert response.status_code == 404
+    response = client.get(
+        "/api/summary/variants?rsids=123", headers={"Accept": "application/json"}
+    )
+    assert response.status_code == 400
+
+
 def test_variant_wise_invalid_accept(test_database, client, login_as):
     login_as("admin")
     response = client.get(
@@ -269,6 +312,68 @@ def test_participant_wise_csv_multiple_genes(test_database, client, login_as):
     assert df.shape[0] == 9
 
 
+def test_participant_wise_csv_stream(test_database, client, login_as):
+    login_as("admin")
+
+    urls = [
+        ("/api/summary/participants?genes=ENSG00000138131&stream=true", 5),
+        (
+            "/api/summary/participants?genes=ENSG00000138131,ENSG00000258366&stream=true",
+            9,
+        ),
+        ("/api/summary/participants?positions=chr10:100010909&stream=true", 2),
+    ]
+
+    for url in urls:
+        print(url)
+        response = client.get(url[0], headers={"Accept": "text/csv"})
+        assert response.status_code == 200
+        df = pd.read_csv(BytesIO(response.get_data()), encoding="utf8")
+        assert df.shape[0] == url[1]
+
+        buffered = client.get(
+            url[0][: -len("&stream=true")], headers={"Accept": "text/csv"}
+        )
+        assert response.get_data() == buffered.get_data()
+
+
+def test_participant_wise_csv_stream_columns(test_database, client, login_as):
+    login_as("admin")
+    response = client.get(
+        "/api/summary/participants?genes=ENSG00000138131&stream=true&columns=position,zygosity,foo",
+        headers={"Accept": "text/csv"},
+    )
+    assert response.status_code == 200
+    df = pd.read_csv(BytesIO(response.get_data()), encoding="utf8")
+    assert list(df.columns) == ["position", "zygosity"]
+
+
+def test_participant_wise_ndjson(test_database, client, login_as):
+    login_as("admin")
+
+    urls = [
+        ("/api/summary/participants?genes=ENSG00000138131", 6),
+        ("/api/summary/participants?genes=ENSG00000138131,ENSG00000258366", 12),
+    ]
+
+    for url in urls:
+        print(url)
+        response = client.get(url[0], headers={"Accept": "application/x-ndjson"})
+        assert response.status_code == 200
+        assert response.mimetype == "application/x-ndjson"
+        df = pd.read_json(BytesIO(response.get_data()), lines=True)
+        assert df.shape[0] == url[1]
+
+
+def test_variant_wise_ndjson_not_acceptable(test_database, client, login_as):
+    login_as("admin")
+    response = client.get(
+        "/api/summary/variants?genes=ENSG00000138131",
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert response.status_code == 406
+
+
 def test_participant_wise_invalid_accept(test_database, client, login_as):
     login_as("admin")
     response = client.get(
@@ -286,3 +391,205 @@ def test_participant_wise_json_permissions(test_database, client, login_as):
     )
     assert response.status_code == 200
     assert len(response.get_json()) == 6
+
+
+def test_summary_report_cache(test_database, client, login_as, tmp_path):
+    login_as("admin")
+    app = client.application
+    app.extensions["report_cache"] = DiskReportCache(str(tmp_path), 1 << 20)
+    try:
+        url = "/api/summary/variants?genes=ENSG00000138131"
+        first = client.get(url, headers={"Accept": "text/csv"})
+        assert first.status_code == 200
+        assert len(os.listdir(tmp_path)) == 1
+        # the same genes in another order are the same report
+        second = client.get(
+            "/api/summary/variants?genes=ENSG00000138131,ENSG00000138131",
+            headers={"Accept": "text/csv"},
+        )
+        assert second.get_data() == first.get_data()
+        assert len(os.listdir(tmp_path)) == 1
+        client.get(url, headers={"Accept": "application/json"})
+        assert len(os.listdir(tmp_path)) == 2
+
+        # deleting genotypes, as an ingest does before bumping the generation, builds the report again
+        models.Genotype.query.filter(models.Genotype.zygosity == "Het").delete()
+        db.session.commit()
+        client.get(url, headers={"Accept": "text/csv"})
+        assert len(os.listdir(tmp_path)) == 2
+        bump_generations("variants")
+        client.get(url, headers={"Accept": "text/csv"})
+        assert len(os.listdir(tmp_path)) == 3
+
+        # as does a metadata write, once it has committed
+        models.Family.query.first().family_aliases = "renamed"
+        db.session.commit()
+        client.get(url, headers={"Accept": "text/csv"})
+        assert len(os.listdir(tmp_path)) == 4
+    finally:
+        del app.extensions["report_cache"]
+
+
+def test_summary_report_job(test_database, client, login_as, application):
+    """report jobs are queued, run by the scheduler task, and written to the group's results bucket"""
+    minio_client = Minio(
+        TestConfig.MINIO_ENDPOINT,
+        access_key=TestConfig.MINIO_ACCESS_KEY,
+        secret_key=TestConfig.MINIO_SECRET_KEY,
+        secure=False,
+    )
+    if not minio_client.bucket_exists("results-ach"):
+        minio_client.make_bucket("results-ach")
+
+    # user_a belongs to two groups
+    login_as("user_a")
+    response = client.post(
+        "/api/summary/jobs",
+        json={"type": "participants", "genes": "ENSG00000138131"},
+    )
+    assert response.status_code == 400
+    response = client.post(
+        "/api/summary/jobs",
+        json={"type": "participants", "genes": "ENSG00000138131", "group": "nope"},
+    )
+    assert response.status_code == 404
+
+    login_as("user")
+    assert (
+        client.post(
+            "/api/summary/jobs", json={"type": "participants", "genes": "BADGENENAME"}
+        ).status_code
+        == 400
+    )
+    response = client.post(
+        "/api/summary/jobs",
+        json={"type": "participants", "genes": "ENSG00000138131"},
+    )
+    assert response.status_code == 202
+    job_id = response.get_json()["summary_report_job_id"]
+    assert response.headers["location"] == f"/api/summary/jobs/{job_id}"
+    job = client.get(f"/api/summary/jobs/{job_id}").get_json()
+    assert job["status"] == "Queued"
+    assert job["url"] is None
+
+    run_summary_report_jobs(application)
+
+    job = client.get(f"/api/summary/jobs/{job_id}").get_json()
+    assert job["status"] == "Done"
+    assert job["url"]
+    report = minio_client.get_object("results-ach", job["object_name"]).read()
+    expected = client.get(
+        "/api/summary/participants?genes=ENSG00000138131",
+        headers={"Accept": "text/csv"},
+    ).get_data()
+    assert report == expected
+    minio_client.remove_object("results-ach", job["object_name"])
+
+    # a failed report records the error a synchronous report would have responded with
+    response = client.post(
+        "/api/summary/jobs", json={"type": "variants", "regions": "chr1:1-2"}
+    )
+    job_id = response.get_json()["summary_report_job_id"]
+    run_summary_report_jobs(application)
+    job = client.get(f"/api/summary/jobs/{job_id}").get_json()
+    assert job["status"] == "Error"
+    assert job["errors"] == ["No variants found"]
+
+    login_as("user_a")
+    assert client.get(f"/api/summary/jobs/{job_id}").status_code == 404
+
+
+def test_summary_report_job_formats(test_database, client, login_as, application):
+    """report jobs can be written as parquet, with the same rows as the synchronous report"""
+    pytest.importorskip("pyarrow")
+    minio_client = Minio(
+        TestConfig.MINIO_ENDPOINT,
+        access_key=TestConfig.MINIO_ACCESS_KEY,
+        secret_key=TestConfig.MINIO_SECRET_KEY,
+        secure=False,
+    )
+    if not minio_client.bucket_exists("results-ach"):
+        minio_client.make_bucket("results-ach")
+
+    login_as("user")
+    response = client.post(
+        "/api/summary/jobs",
+        json={"type": "variants", "genes": "ENSG00000138131", "format": "xlsx"},
+    )
+    assert response.status_code == 400
+    response = client.post(
+        "/api/summary/jobs",
+        json={"type": "variants", "genes": "ENSG00000138131", "format": "parquet"},
+    )
+    assert response.status_code == 202
+    job_id = response.get_json()["summary_report_job_id"]
+
+    run_summary_report_jobs(application)
+
+    job = client.get(f"/api/summary/jobs/{job_id}").get_json()
+    assert job["status"] == "Done"
+    assert job["object_name"].endswith(".parquet")
+    report = minio_client.get_object("results-ach", job["object_name"]).read()
+    expected = client.get(
+        "/api/summary/variants?genes=ENSG00000138131",
+        headers={"Accept": "application/vnd.apache.parquet"},
+    ).get_data()
+    assert pd.read_parquet(BytesIO(report)).equals(pd.read_parquet(BytesIO(expected)))
+    minio_client.remove_object("results-ach", job["object_name"])
+
+
+def test_summary_columnar(test_database, client, login_as):
+    """the reports keep their types as parquet, and have the same rows as the csv"""
+    pytest.importorskip("pyarrow")
+
+    login_as("admin")
+    for type, count in (("variants", 3), ("participants", 5)):
+        response = client.get(
+            f"/api/summary/{type}?genes=ENSG00000138131",
+            headers={"Accept": "application/vnd.apache.parquet"},
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "application/vnd.apache.parquet"
+        df = pd.read_parquet(BytesIO(response.get_data()))
+        assert df.shape[0] == count
+        assert df["position"].dtype.kind == "i"
+        assert df["participant_codename"].dtype == "category"
+
+
+def test_ingest_upsert_replaces_rsids(client):
+    """reingesting an allele replaces its annotations and its rsIDs, rather than adding to them"""
+
+    def ingest(rsids: str, gnomad_af: float) -> int:
+        rows = build_variant_rows(
+            [
+                {
+                    "chromosome": 1,
+                    "position": "5000",
+                    "reference_allele": "A",
+                    "alt_allele": "T",
+                    "variation": "SNV",
+                    "rsids": rsids,
+                    "gnomad_af": gnomad_af,
+                }
+            ]
+        )
+        next_variant_id = (
+            db.session.query(db.func.max(models.Variant.variant_id)).scalar() or 0
+        ) + 1
+        assign_variant_ids(rows, next_variant_id, batch_size=100)
+        upsert_variants(rows, batch_size=100)
+        replace_variant_rsids(rows, batch_size=100)
+        db.session.commit()
+        return rows[0]["variant_id"]
+
+    variant_id = ingest("rs1,rs2", 0.1)
+    assert ingest("rs3", 0.2) == variant_id
+
+    variant = models.Variant.query.one()
+    assert variant.rsids == "rs3"
+    assert variant.gnomad_af == 0.2
+    assert db.session.execute(
+        db.select(
+            models.variant_rsid_table.c.variant_id, models.variant_rsid_table.c.rsid
+        )
+    ).all() == [(variant_id, "rs3")]
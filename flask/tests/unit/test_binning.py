@@ -0,0 +1,36 @@
+""" test the UCSC binning scheme used to index variants and genes """
+from pytest import raises
+from app.binning import BIN_MAX_END, bin_for_interval, overlapping_bins
+
+
+def test_bins_are_the_smallest_containing_bin():
+    """intervals within a 128 kb bin get a finest-level bin, larger ones a coarser bin"""
+    assert bin_for_interval(1, 1) == 585
+    assert bin_for_interval(1, 1 << 17) == 585
+    assert bin_for_interval(1 << 17, (1 << 17) + 1) == 73
+    assert bin_for_interval(100_010_909, 100_010_909) == 585 + (100_010_908 >> 17)
+    assert bin_for_interval(1, BIN_MAX_END) == 0
+
+
+def test_overlapping_bins_contain_every_overlapping_interval():
+    """any interval overlapping a region must be binned into one of the region's overlapping bins"""
+    region = (100_007_447, 100_027_951)
+    bins = set(overlapping_bins(*region))
+    for interval in [
+        (100_007_447, 100_007_447),
+        (100_027_951, 100_027_951),
+        (100_000_000, 100_010_000),
+        (100_020_000, 101_000_000),
+        (1, 200_000_000),
+    ]:
+        assert bin_for_interval(*interval) in bins
+    assert bin_for_interval(100_500_000, 100_500_000) not in bins
+
+
+def test_invalid_intervals_raise():
+    """intervals must be 1-based, ordered, and within the binned coordinate space"""
+    for interval in [(0, 5), (10, 5), (1, BIN_MAX_END + 1)]:
+        with raises(ValueError):
+            bin_for_interval(*interval)
+        with raises(ValueError):
+            overlapping_bins(*interval)
@@ -0,0 +1,109 @@
+""" test the parquet and arrow serialization of reports and list exports """
+from datetime import datetime
+from io import BytesIO
+
+from flask import Flask
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.parquet as pq
+
+from app.blueprints.variants import VARIANT_KEYS, get_report_df
+from app.columnar import (
+    ARROW_MIMETYPE,
+    PARQUET_MIMETYPE,
+    frame_to_table,
+    records_to_table,
+    stream_records,
+    table_to_bytes,
+)
+from app.models import DatasetCondition
+from test_report_aggregation import make_genotypes
+
+
+@pytest.mark.parametrize("type", ["participants", "variants"])
+def test_typed_report_round_trip(type):
+    """the typed reports keep their numeric columns, and have the same values as the csv report otherwise"""
+    df = make_genotypes(1000)
+    with Flask(__name__).app_context():
+        typed = get_report_df(df, type, typed=True)
+        strings = get_report_df(df, type)
+    assert list(typed.columns) == list(strings.columns)
+    assert typed["position"].dtype.kind == "i"
+    assert typed["gnomad_af"].dtype.kind == "f"
+    data = table_to_bytes(frame_to_table(typed), PARQUET_MIMETYPE)
+    table = pq.read_table(BytesIO(data))
+    assert pa.types.is_dictionary(table.schema.field("participant_codename").type)
+    assert pa.types.is_integer(table.schema.field("position").type)
+    assert table.num_rows == len(typed)
+
+    # variants are ordered by the numeric rather than the string positions
+    typed, strings = (
+        report.fillna("")
+        .astype(str)
+        .sort_values(VARIANT_KEYS, kind="stable")
+        .reset_index(drop=True)
+        for report in (typed, strings)
+    )
+    assert typed.equals(strings)
+
+
+def test_records_to_table():
+    """enums, models and lists are written as their values, and mixed columns as strings"""
+    rows = [
+        {
+            "dataset_id": 1,
+            "condition": DatasetCondition.GermLine,
+            "updated": datetime(2022, 1, 1),
+            "group_code": ["ach", "bcch"],
+            "notes": "a",
+        },
+        {
+            "dataset_id": 2,
+            "condition": DatasetCondition.Somatic,
+            "updated": datetime(2022, 1, 2),
+            "group_code": [],
+            "notes": 5,
+        },
+    ]
+    colnames = ["dataset_id", "condition", "group_code", "updated", "notes"]
+    data = table_to_bytes(records_to_table(rows, colnames), ARROW_MIMETYPE)
+    table = pa.ipc.open_stream(data).read_all()
+    assert table.column_names == colnames
+    assert table.column("dataset_id").to_pylist() == [1, 2]
+    assert pa.types.is_dictionary(table.schema.field("condition").type)
+    assert table.column("condition").to_pylist() == ["GermLine", "Somatic"]
+    assert table.column("group_code").to_pylist() == [["ach", "bcch"], []]
+    assert pa.types.is_timestamp(table.schema.field("updated").type)
+    assert table.column("notes").to_pylist() == ["a", "5"]
+
+    empty = records_to_table(iter(()), colnames)
+    assert empty.column_names == colnames and empty.num_rows == 0
+
+
+@pytest.mark.parametrize("mimetype", [PARQUET_MIMETYPE, ARROW_MIMETYPE])
+def test_stream_records(mimetype):
+    """records are written a batch at a time, with the types of the first batch"""
+    rows = (
+        {
+            "dataset_id": i,
+            "condition": DatasetCondition.GermLine,
+            "group_code": ["ach"] if i > 2 else [],
+            "notes": None if i < 2 else i,
+        }
+        for i in range(5)
+    )
+    colnames = ["dataset_id", "condition", "group_code", "notes"]
+    chunks = list(stream_records(rows, colnames, mimetype, batch_size=2))
+    # one per batch, and the parquet footer
+    assert len(chunks) == 4
+    data = BytesIO(b"".join(chunks))
+    if mimetype == PARQUET_MIMETYPE:
+        table = pq.read_table(data)
+    else:
+        table = pa.ipc.open_stream(data).read_all()
+    assert table.column("dataset_id").to_pylist() == [0, 1, 2, 3, 4]
+    assert table.column("condition").to_pylist() == ["GermLine"] * 5
+    assert table.column("group_code").to_pylist() == [[], [], [], ["ach"], ["ach"]]
+    # all null in the first batch, so written as strings
+    assert table.column("notes").to_pylist() == [None, None, "2", "3", "4"]
@@ -0,0 +1,73 @@
+""" test the cache of total_count for the paged list endpoints """
+from types import SimpleNamespace
+
+from flask import Flask
+from sqlalchemy import event
+
+from app.models import Institution, cache_generation_table, db
+from app.utils import CountCache, get_total_count
+
+
+def test_count_cache_invalidation():
+    """entries are fresh until the generation changes or their max age, and stale entries are still estimates"""
+    cache = CountCache()
+    key = ("/api/datasets", (("dataset_type", "WGS"),), "admin")
+    assert cache.get(key) is None
+
+    cache.set(key, 42, 3)
+    assert cache.get(key, 3, max_age=60) == 42
+    assert cache.get(key, 3, max_age=0) is None
+
+    assert cache.get(key, 4, max_age=60) is None
+    assert cache.get(key, None, max_age=60) is None
+    assert cache.get(key) == 42
+
+
+def test_count_cache_evicts_least_recently_used():
+    cache = CountCache(max_entries=2)
+    cache.set("a", 1, 0)
+    cache.set("b", 2, 0)
+    cache.get("a")
+    cache.set("c", 3, 0)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_estimate_counts_after_the_response(tmp_path):
+    """on a miss, ?count=estimate responds with null without counting, and the count is cached for the next request"""
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'counts.db'}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["COUNT_CACHE_SECONDS"] = 60
+    db.init_app(app)
+    admin = SimpleNamespace(is_admin=True)
+
+    @app.route("/api/institutions")
+    def institutions():
+        query = Institution.query
+        return {
+            "total_count": get_total_count(query, Institution.institution_id, admin)
+        }
+
+    with app.app_context():
+        cache_generation_table.create(db.engine)
+        Institution.__table__.create(db.engine)
+        db.session.add_all([Institution(institution="a"), Institution(institution="b")])
+        db.session.commit()
+
+        statements = []
+
+        @event.listens_for(db.engine, "before_cursor_execute")
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        client = app.test_client()
+        response = client.get("/api/institutions?count=estimate")
+        assert response.get_json()["total_count"] is None
+        assert not any("count(" in statement.lower() for statement in statements)
+
+        response.close()
+        assert any("count(" in statement.lower() for statement in statements)
+        response = client.get("/api/institutions?count=estimate")
+        assert response.get_json()["total_count"] == 2
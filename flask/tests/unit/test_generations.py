@@ -0,0 +1,48 @@
+""" test bumping the shared cache generations after writes commit """
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, select
+
+from app.models import cache_generation_table
+
+
+def test_generation_is_bumped_once_the_writer_commits(tmp_path):
+    # a file so that the bump is visible from a separate connection
+    engine = create_engine(f"sqlite:///{tmp_path / 'generations.db'}")
+    # created from the app's metadata, which seeds its rows
+    cache_generation_table.create(engine)
+    metadata = MetaData()
+    institution = Table(
+        "institution", metadata, Column("institution_id", Integer, primary_key=True)
+    )
+    other = Table("other", metadata, Column("other_id", Integer, primary_key=True))
+    metadata.create_all(engine)
+
+    def generation():
+        with engine.connect() as conn:
+            return conn.execute(
+                select(cache_generation_table.c.generation).where(
+                    cache_generation_table.c.name == "metadata"
+                )
+            ).scalar()
+
+    assert generation() == 0
+    with engine.begin() as conn:
+        conn.execute(
+            institution.insert(), [{"institution_id": 1}, {"institution_id": 2}]
+        )
+        conn.execute(institution.delete().where(institution.c.institution_id == 2))
+    # bumped once for the whole transaction
+    assert generation() == 1
+
+    with engine.begin() as conn:
+        conn.execute(other.insert().values(other_id=1))
+    assert generation() == 1
+
+    with engine.connect() as conn:
+        with conn.begin():
+            conn.execute(institution.delete())
+            # not until the connection is back in the pool
+            assert generation() == 1
+        transaction = conn.begin()
+        conn.execute(institution.insert().values(institution_id=3))
+        transaction.rollback()
+    assert generation() == 2
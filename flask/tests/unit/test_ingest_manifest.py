@@ -0,0 +1,48 @@
+""" test how --incremental decides whether a report changed since it was ingested """
+import os
+
+from app.mapping_utils import check_report_unchanged, hash_report, report_stat
+from app.models import IngestedReport
+
+
+def make_report(tmp_path, content: bytes) -> str:
+    report = tmp_path / "1.wes.csv"
+    report.write_bytes(content)
+    return str(report)
+
+
+def ingested_entry(report: str) -> IngestedReport:
+    size, mtime = report_stat(report)
+    return IngestedReport(
+        path=report, size=size, mtime=mtime, content_hash=hash_report(report)
+    )
+
+
+def test_same_size_and_mtime_is_not_read(tmp_path, monkeypatch):
+    report = make_report(tmp_path, b"a,b\n1,2\n")
+    ingested = ingested_entry(report)
+    monkeypatch.setattr("app.mapping_utils.hash_report", None)
+    assert check_report_unchanged(report, ingested) == (True, None)
+
+
+def test_touched_report_is_hashed_and_its_entry_updated(tmp_path):
+    report = make_report(tmp_path, b"a,b\n1,2\n")
+    ingested = ingested_entry(report)
+    ingested.size = None  # recorded before sizes were
+    stat = os.stat(report)
+    os.utime(report, (stat.st_atime, stat.st_mtime + 60))
+    assert check_report_unchanged(report, ingested) == (True, ingested.content_hash)
+    assert (ingested.size, ingested.mtime) == report_stat(report)
+
+
+def test_changed_report(tmp_path):
+    report = make_report(tmp_path, b"a,b\n1,2\n")
+    ingested = ingested_entry(report)
+    stat = os.stat(report)
+    with open(report, "wb") as handle:
+        handle.write(b"a,b\n1,3\n")
+    os.utime(report, (stat.st_atime, stat.st_mtime + 60))
+    unchanged, content_hash = check_report_unchanged(report, ingested)
+    assert not unchanged
+    assert content_hash == hash_report(report) != ingested.content_hash
+    assert ingested.mtime != report_stat(report)[1]
@@ -0,0 +1,12 @@
+""" test the in-memory equivalent of the LIKE matching used to map reports to participants """
+from app.mapping_utils import matches_like
+
+
+def test_matches_like():
+    """% and _ are wildcards, everything else is literal and case-insensitive"""
+    assert matches_like("%CH0567%", "141584,ch0567")
+    assert matches_like("9_3", "933")
+    assert matches_like("933R", "933r")
+    assert not matches_like("933", "933R")
+    assert not matches_like("9.3", "933")
+    assert not matches_like("%CH0567%", None)
@@ -0,0 +1,32 @@
+""" test the call tree of a request profile """
+import cProfile
+import pstats
+
+from app.profiling import call_tree
+
+
+def leaf():
+    return sum(range(1000))
+
+
+def branch():
+    return leaf() + leaf()
+
+
+def test_call_tree():
+    """functions are ordered by cumulative time and list what they called"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    branch()
+    profiler.disable()
+
+    tree = call_tree(pstats.Stats(profiler))
+    functions = [function["function"] for function in tree]
+    branch_index = next(i for i, name in enumerate(functions) if "(branch)" in name)
+    leaf_index = next(i for i, name in enumerate(functions) if "(leaf)" in name)
+    assert branch_index < leaf_index
+    assert tree[leaf_index]["calls"] == 2
+    assert [callee["function"] for callee in tree[branch_index]["callees"]] == [
+        functions[leaf_index]
+    ]
+    assert call_tree(pstats.Stats(profiler), limit=1) == tree[:1]
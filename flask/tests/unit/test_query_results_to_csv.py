@@ -1,8 +1,9 @@
 """ test query_results_to_csv function """
 from csv import reader
 from dataclasses import dataclass
+from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from app.utils import query_results_to_csv
+from app.utils import csv_response, iter_csv, query_results_to_csv
 
 db = SQLAlchemy()
 
@@ -40,3 +41,32 @@ def test_can_pass_a_dictionary():
                 assert item in test_dict.keys()
         else:
             assert len(row) == len(test_dict.keys())
+
+
+def test_iter_csv_chunks_match_whole_csv():
+    """is a csv written out in chunks the same as one written all at once?"""
+    rows = [{"foo": f"bar,{i}", "baz": i} for i in range(10)]
+    chunks = list(iter_csv(iter(rows), chunk_rows=3))
+    assert len(chunks) == 4
+    assert "".join(chunks) == query_results_to_csv(rows)
+    assert list(reader("".join(chunks).splitlines()))[1] == ["bar,0", "0"]
+
+
+def test_iter_csv_header_without_rows():
+    """does an empty csv still get a header when the columns are known?"""
+    assert "".join(iter_csv([], ["foo", "baz"])) == "foo,baz\r\n"
+    assert "".join(iter_csv([])) == ""
+
+
+def test_csv_response_filters_and_reorders_columns():
+    """is a generator of rows streamed with only the requested columns, in order?"""
+    app = Flask(__name__)
+    rows = ({"foo": i, "bar": "x", "baz": i * 2} for i in range(3))
+    with app.test_request_context():
+        response = csv_response(rows, "report.csv", ["baz", "foo"])
+        assert response.is_streamed
+        assert response.headers["Content-Type"] == "text/csv; charset=utf-8"
+        assert (
+            response.headers["Content-Disposition"] == "attachment; filename=report.csv"
+        )
+        assert response.get_data(as_text=True) == "baz,foo\r\n0,0\r\n2,1\r\n4,2\r\n"
@@ -0,0 +1,55 @@
+""" test the summary report cache """
+import os
+from time import time
+
+from app.report_cache import DiskReportCache, cache_key
+
+
+def test_disk_report_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskReportCache(str(tmp_path), max_bytes=10)
+    assert cache.get("a") is None
+
+    cache.set("a", b"aaaa")
+    cache.set("b", b"bbbb")
+    # the least recently read entry, until it is read again
+    now = time()
+    os.utime(tmp_path / "a", (now - 2, now))
+    os.utime(tmp_path / "b", (now - 1, now))
+    assert cache.get("a") == b"aaaa"
+    cache.set("c", b"cccc")
+
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("b") is None
+    assert cache.get("c") == b"cccc"
+    assert sorted(os.listdir(tmp_path)) == ["a", "c"]
+
+
+def test_disk_report_cache_expires_by_write_time(tmp_path):
+    """entries expire max_age after they were written, however often they are read"""
+    cache = DiskReportCache(str(tmp_path), max_bytes=10, max_age=60)
+    cache.set("a", b"aaaa")
+    cache.set("b", b"bbbb")
+    now = time()
+    os.utime(tmp_path / "a", (now, now - 30))
+    os.utime(tmp_path / "b", (now, now - 90))
+
+    assert cache.get("a") == b"aaaa"
+    # reading doesn't make an entry any younger
+    assert os.stat(tmp_path / "a").st_mtime == now - 30
+    assert cache.get("b") is None
+
+    cache.set("b", b"bbbb")
+    assert cache.get("b") == b"bbbb"
+
+
+def test_cache_key_depends_on_every_part():
+    key = cache_key(3, "genes", ["ENSG00000138131"], "variants", "csv", None, "admin")
+    assert key == cache_key(
+        3, "genes", ["ENSG00000138131"], "variants", "csv", None, "admin"
+    )
+    assert key != cache_key(
+        4, "genes", ["ENSG00000138131"], "variants", "csv", None, "admin"
+    )
+    assert key != cache_key(
+        3, "genes", ["ENSG00000138131"], "variants", "csv", None, [1, 2]
+    )
@@ -0,0 +1,52 @@
+""" test the JSON serialization of models for responses """
+from dataclasses import asdict
+from datetime import date, datetime
+import json
+
+from app import models
+from app.serializers import dumps, to_dict
+
+
+def test_to_dict_matches_asdict():
+    """to_dict has the same keys and values as dataclasses.asdict"""
+    participant = models.Participant(
+        participant_id=1,
+        participant_codename="HERO",
+        sex=models.Sex.Female,
+        month_of_birth=date(2020, 1, 1),
+        updated=datetime(2021, 2, 3, 4, 5, 6),
+    )
+    assert to_dict(participant) == asdict(participant)
+    dataset = models.RNASeqDataset(dataset_id=2, candidate_genes="LOXL4")
+    assert to_dict(dataset) == asdict(dataset)
+
+
+def test_dumps_encodes_like_datetime_encoder():
+    """dates are ISO formatted, enums become their values, and nested models are serialized"""
+    file = models.File(path="/path/foo", multiplexed=True)
+    body = json.loads(
+        dumps(
+            {
+                "sex": models.Sex.Female,
+                "updated": datetime(2021, 2, 3, 4, 5, 6),
+                "month_of_birth": date(2020, 1, 1),
+                "linked_files": [file],
+            }
+        )
+    )
+    assert body == {
+        "sex": "Female",
+        "updated": "2021-02-03T04:05:06",
+        "month_of_birth": "2020-01-01",
+        "linked_files": [to_dict(file)],
+    }
+
+
+def test_to_dict_only_keeps_field_order():
+    """only limits the fields without reordering them, and ignores unknown ones"""
+    participant = models.Participant(participant_id=1, participant_codename="HERO")
+    assert list(to_dict(participant, {"participant_codename", "participant_id"})) == [
+        "participant_id",
+        "participant_codename",
+    ]
+    assert to_dict(participant, {"RIN"}) == {}
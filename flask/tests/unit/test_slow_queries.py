@@ -0,0 +1,105 @@
+""" test the slow query log """
+import json
+import logging
+
+from flask import Flask
+import pytest
+from sqlalchemy import create_engine, text
+
+from app import slow_queries
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.entries = []
+
+    def emit(self, record):
+        self.entries.append(json.loads(record.getMessage()))
+
+
+@pytest.fixture
+def entries():
+    handler = ListHandler()
+    slow_queries.logger.addHandler(handler)
+    yield handler.entries
+    slow_queries.logger.removeHandler(handler)
+
+
+def make_app(threshold, per_minute):
+    app = Flask(__name__)
+    app.config.update(
+        SLOW_QUERY_SECONDS=threshold, SLOW_QUERY_LOG_PER_MINUTE=per_minute
+    )
+    slow_queries.init_app(app)
+    engine = create_engine("sqlite://")
+
+    @app.route("/slow")
+    def slow():
+        with engine.connect() as connection:
+            connection.execute(text("SELECT :value"), {"value": 42})
+        return ""
+
+    @app.route("/codename")
+    def codename():
+        with engine.connect() as connection:
+            connection.execute(
+                text("SELECT :codename, :id"), {"codename": "AA0001", "id": 7}
+            )
+        return ""
+
+    return app
+
+
+def test_slow_query_logged_with_endpoint(entries):
+    """statements over the threshold are logged with their parameters and endpoint"""
+    make_app(0, 10).test_client().get("/slow")
+    assert len(entries) == 1
+    assert entries[0]["endpoint"] == "slow"
+    assert entries[0]["statement"] == "SELECT ?"
+    assert entries[0]["parameters"] == [42]
+    # EXPLAIN FORMAT=JSON is MySQL only
+    assert "plan" not in entries[0]
+
+
+def test_slow_query_parameters_redacted(entries):
+    """strings are logged as their length, since the parameters include codenames and emails"""
+    make_app(0, 10).test_client().get("/codename")
+    assert entries[0]["parameters"] == ["<6 characters>", 7]
+
+
+def test_slow_query_path_without_query_string(entries):
+    """query strings are left out of the path, since list filters include codenames"""
+    make_app(0, 10).test_client().get("/codename?participant_codename=AA0001")
+    assert entries[0]["path"] == "/codename"
+    assert "AA0001" not in json.dumps(entries[0])
+
+
+def test_redact_truncates_executemany():
+    rows = [{"participant_codename": "AA0001"}] * (slow_queries.LOGGED_ROWS + 5)
+    redacted = slow_queries.redact(rows)
+    assert len(redacted) == slow_queries.LOGGED_ROWS + 1
+    assert redacted[0] == {"participant_codename": "<6 characters>"}
+    assert redacted[-1] == "<5 more>"
+
+
+def test_fast_query_not_logged(entries):
+    """statements under the threshold aren't logged"""
+    make_app(60, 10).test_client().get("/slow")
+    assert entries == []
+
+
+def test_slow_query_rate_limit(entries):
+    """entries over the rate limit are counted and reported with the next one"""
+    app = make_app(0, 2)
+    client = app.test_client()
+    for _ in range(4):
+        client.get("/slow")
+    assert len(entries) == 2
+    assert "suppressed" not in entries[1]
+
+    slow_query_log = app.extensions["slow_queries"]
+    assert slow_query_log.suppressed == 2
+    slow_query_log._tokens = 1
+    client.get("/slow")
+    assert entries[2]["suppressed"] == 2
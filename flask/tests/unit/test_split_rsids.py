@@ -0,0 +1,11 @@
+""" test splitting report rsIDs for the variant_rsid table """
+from app.mapping_utils import split_rsids
+
+
+def test_split_rsids():
+    """rsIDs are split on commas, normalized, deduplicated, and non-rsIDs are dropped"""
+    assert split_rsids("rs123") == ["rs123"]
+    assert split_rsids("rs12, RS123,rs12") == ["rs12", "rs123"]
+    assert split_rsids("rs123,.,COSM1234") == ["rs123"]
+    assert split_rsids(None) == []
+    assert split_rsids("") == []
@@ -0,0 +1,65 @@
+""" test the per-endpoint SQL metrics """
+from flask import Flask
+from prometheus_client import REGISTRY
+import pytest
+from sqlalchemy import create_engine, exc, text
+
+from app import sql_metrics
+
+
+@pytest.fixture
+def metrics_app():
+    engine = create_engine("sqlite://", poolclass=sql_metrics.TimedQueuePool)
+    app = Flask(__name__)
+    sql_metrics.init_app(app)
+
+    @app.route("/numbers")
+    def numbers():
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            rows = connection.execute(
+                text("SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3")
+            ).all()
+            with pytest.raises(exc.OperationalError):
+                connection.execute(text("SELECT * FROM nothing"))
+        return str(len(rows))
+
+    @app.route("/nothing")
+    def nothing():
+        return ""
+
+    yield app
+    engine.dispose()
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_sql_metrics_per_endpoint(metrics_app):
+    """the statements of a request are counted, timed, and observed once under its endpoint"""
+    before = {
+        name: sample(f"stager_sql_{name}_per_request_{suffix}", endpoint="numbers")
+        for name, suffix in [("statements", "sum"), ("statements", "count")]
+    }
+    checkouts = sample("stager_sql_pool_checkout_seconds_count")
+
+    assert metrics_app.test_client().get("/numbers").data == b"3"
+
+    assert (
+        sample("stager_sql_statements_per_request_count", endpoint="numbers")
+        == before["statements"] + 1
+    )
+    assert (
+        sample("stager_sql_statements_per_request_sum", endpoint="numbers")
+        == before["statements"] + 2
+    )
+    assert sample("stager_sql_seconds_per_request_sum", endpoint="numbers") > 0
+    assert sample("stager_sql_pool_checkout_seconds_count") == checkouts + 1
+    assert sample("stager_sql_pool_checked_out") == 0
+
+
+def test_sql_metrics_without_statements(metrics_app):
+    """requests that don't touch the database aren't observed"""
+    metrics_app.test_client().get("/nothing")
+    assert sample("stager_sql_statements_per_request_count", endpoint="nothing") == 0
@@ -0,0 +1,65 @@
+""" test building the variant and variant_call rows of a report, where variants are shared across analyses """
+from flask import Flask
+
+from app.mapping_utils import (
+    assign_variant_ids,
+    build_variant_call_rows,
+    build_variant_rows,
+)
+from app.models import Variant, db
+
+
+def make_record(position: int, alt: str, depth: int) -> dict:
+    return {
+        "chromosome": 1,
+        "position": str(position),
+        "reference_allele": "A",
+        "alt_allele": alt,
+        "variation": "SNV",
+        "depth": depth,
+        "quality": 100,
+        "number_of_callers": "2",
+        "ensembl_gene_id": "ENSG00000138131",
+    }
+
+
+def test_variant_and_call_rows():
+    """annotations go to the variant rows and what the analysis called to the variant_call rows"""
+    records = [make_record(5000, "T", 10), make_record(5000, "G", 20)]
+    variant_rows = build_variant_rows(records)
+    assert variant_rows[0]["chromosome"] == "1"
+    assert variant_rows[0]["position"] == 5000
+    assert variant_rows[0]["report_ensembl_gene_id"] == "ENSG00000138131"
+    assert "depth" not in variant_rows[0]
+    for row, variant_id in zip(variant_rows, [7, 8]):
+        row["variant_id"] = variant_id
+    assert build_variant_call_rows(records, variant_rows, 3) == [
+        {
+            "variant_id": variant_id,
+            "analysis_id": 3,
+            "depth": depth,
+            "quality": 100,
+            "number_of_callers": 2,
+            "old_multiallelic": None,
+        }
+        for variant_id, depth in [(7, 10), (8, 20)]
+    ]
+
+
+def test_assign_variant_ids_reuses_existing_alleles():
+    """an allele already in the variant table keeps its id, and new ones are allocated in order"""
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    with app.app_context():
+        Variant.__table__.create(db.engine)
+        existing = build_variant_rows([make_record(5000, "G", 20)])
+        existing[0]["variant_id"] = 4
+        db.session.execute(Variant.__table__.insert(), existing)
+
+        rows = build_variant_rows(
+            [make_record(5000, "T", 10), make_record(5000, "G", 30)]
+        )
+        assert assign_variant_ids(rows, 5, batch_size=1) == 6
+        assert [row["variant_id"] for row in rows] == [5, 4]